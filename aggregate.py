@@ -3,12 +3,14 @@
 import sys
 import os
 import csv
+import json
 import argparse
 import scipy.stats
 import numpy as np
 import math
 
 from agg_setup import group_tests, get_paired, preprocess_samples
+from resstore import ResStore
 
 def percent_speedup_ref_denom(test_res, ref_res):
     return '%.2f' % ((ref_res - test_res) / (1.0 * ref_res) * 100)
@@ -27,19 +29,108 @@ def t_ci(samples):
     return ci
 
 
-# read samples in res/tname/exectime.txt, assumes we are in res/
+# read samples in res/tname/exectime.txt, assumes we are in res/, or of the
+# latest run with results dir tname from the store, if it is given
 # returns, well, numpy array, not usual list
-def get_samples(tname):
+def get_samples(tname, store=None):
+    if store is not None:
+        return np.array(store.samples(store.run_by_resdir(tname)["id"]))
     et_path = os.path.join(tname, 'exectime.txt')
     assert os.path.isfile(et_path)
     return np.loadtxt(et_path)
 
 
+def test_exists(tname, store=None):
+    if store is not None:
+        return store.run_by_resdir(tname) is not None
+    return os.path.isdir(tname)
+
+
+# plan fingerprint of test tname from res/tname/plan.fingerprint or from the
+# store, None if the plan wasn't captured
+def get_plan_fingerprint(tname, store=None):
+    if store is not None:
+        return store.plan_fingerprint(store.run_by_resdir(tname)["id"])
+    fp_path = os.path.join(tname, 'plan.fingerprint')
+    if not os.path.isfile(fp_path):
+        return None
+    with open(fp_path) as f:
+        return f.read().strip()
+
+
+# time limit at which test tname was cancelled from res/tname/timeout.txt or
+# from the store, None if it didn't time out
+def get_timeout(tname, store=None):
+    if store is not None:
+        return store.timeout(store.run_by_resdir(tname)["id"])
+    timeout_path = os.path.join(tname, 'timeout.txt')
+    if not os.path.isfile(timeout_path):
+        return None
+    with open(timeout_path) as f:
+        return float(f.readline())
+
+
+# physical layout of the tables test tname was run on, see layout.py, from
+# res/tname/layout.txt or from the store, None if unknown
+def get_layout(tname, store=None):
+    if store is not None:
+        return run_layout(store.run_by_resdir(tname))
+    layout_path = os.path.join(tname, 'layout.txt')
+    if not os.path.isfile(layout_path):
+        return None
+    with open(layout_path) as f:
+        return f.read().strip()
+
+
+def run_layout(run):
+    return json.loads(run["env"] or '{}').get("layout")
+
+
+# layouts column of the pair: the layout if they are the same, 'test vs ref'
+# otherwise
+def layouts_cell(test_name, reftest_name, store=None):
+    test_layout = get_layout(test_name, store)
+    ref_layout = get_layout(reftest_name, store)
+    if test_layout is None and ref_layout is None:
+        return ''
+    if test_layout == ref_layout:
+        return test_layout
+    return "{0} vs {1}".format(test_layout, ref_layout)
+
+
+# (median, min, avg, ci low, ci high) of samples, for the store summaries
+def summarize(samples):
+    samples = np.array(samples)
+    ci = t_ci(samples) if samples.size > 1 else [float('nan')] * 2
+    return (float(np.median(samples)), float(np.min(samples)),
+            float(np.average(samples)), float(ci[0]), float(ci[1]))
+
+
 # Process pair of tests test_name and reftest_name, assumes we are in res/ dir.
-def process_pair(csvwriter, test_name, reftest_name, percent_speedup_func):
+def process_pair(csvwriter, test_name, reftest_name, percent_speedup_func,
+                 store=None):
     csvrow = [test_name]
-    test_samples = preprocess_samples(get_samples(test_name))
-    reftest_samples = preprocess_samples(get_samples(reftest_name))
+    # timed out test has no meaningful stats; report the limit instead of
+    # its median, i.e. its time is more than that
+    test_timeout = get_timeout(test_name, store)
+    ref_timeout = get_timeout(reftest_name, store)
+    if test_timeout is not None or ref_timeout is not None:
+        timed_out = []
+        for tname, timeout, who in ((test_name, test_timeout, 'test'),
+                                    (reftest_name, ref_timeout, 'ref')):
+            if timeout is None:
+                csvrow.append(np.median(preprocess_samples(get_samples(tname, store))))
+            else:
+                csvrow.append('>{:g}'.format(timeout))
+                timed_out.append(who)
+        print("WARN: {0} timed out in pair {1} - {2}".format(
+            ' and '.join(timed_out), test_name, reftest_name))
+        csvrow.extend([''] * 10 + [' '.join(timed_out)])
+        csvrow.append(layouts_cell(test_name, reftest_name, store))
+        csvwriter.writerow(csvrow)
+        return
+    test_samples = preprocess_samples(get_samples(test_name, store))
+    reftest_samples = preprocess_samples(get_samples(reftest_name, store))
 
     t_median, r_median = np.median(test_samples), np.median(reftest_samples)
     csvrow.extend([t_median, r_median, percent_speedup_func(t_median, r_median)])
@@ -54,10 +145,26 @@ def process_pair(csvwriter, test_name, reftest_name, percent_speedup_func):
                    r_avg, "{0:.2f}, {1:.2f}\n".format(ref_ci[0], ref_ci[1]),
                    percent_speedup_func(t_avg, r_avg)])
 
+    # speedup is meaningless if the plans differ
+    test_plan = get_plan_fingerprint(test_name, store)
+    ref_plan = get_plan_fingerprint(reftest_name, store)
+    if test_plan is None or ref_plan is None:
+        csvrow.append('')
+    elif test_plan == ref_plan:
+        csvrow.append('same')
+    else:
+        print("WARN: {0} and {1} used different plans ({2} vs {3}), compare "
+              "plan.json files".format(test_name, reftest_name, test_plan, ref_plan))
+        csvrow.append('DIFFERENT')
+    csvrow.append('')
+    csvrow.append(layouts_cell(test_name, reftest_name, store))
+
     csvwriter.writerow(csvrow)
 
 
-def aggregate(percent_speedup_func, resdir):
+# tests is list of names of results dirs to consider, all dirs in resdir if
+# None
+def aggregate(percent_speedup_func, resdir, store=None, tests=None):
     if not os.path.isdir('res'):
         print('res directory not found')
         sys.exit(1)
@@ -68,22 +175,40 @@ def aggregate(percent_speedup_func, resdir):
         header = ['test name',
                   'test median', 'ref median', '% speedup median',
                   'test min', 'ref min', '% speedup min',
-                  'test avg', 'test 0.95 CI', 'ref avg', 'ref 0.95 CI', '% speedup avg']
+                  'test avg', 'test 0.95 CI', 'ref avg', 'ref 0.95 CI', '% speedup avg',
+                  'plans', 'timeout', 'layouts']
         csvwriter.writerow(header)
-        tests = next(os.walk('.'))[1]  # list of dirs in res/
+        if tests is None:
+            tests = next(os.walk('.'))[1]  # list of dirs in res/
         test_groups = group_tests(tests)
         for test_group in test_groups:
             print("\nProcessing new group")
             test_group.sort()
             for test_name in test_group:
                  reftest_name = get_paired(test_name)
-                 if os.path.isdir(reftest_name):
+                 if test_exists(reftest_name, store):
                      print("Processing pair {0} - {1}".format(test_name, reftest_name))
                      process_pair(csvwriter, test_name, reftest_name,
-                                  percent_speedup_func)
+                                  percent_speedup_func, store)
             csvwriter.writerow([])
 
 
+# Print summaries of runs found in the store, computing missing ones
+def list_runs(store, runs):
+    updated = store.update_summaries(summarize)
+    print("{} summaries updated".format(updated))
+    print('\t'.join(["prefix", "test name", "query", "scale", "runs",
+                     "median", "min", "avg", "0.95 CI", "stop reason", "layout"]))
+    for run in runs:
+        sm = store.summary(run["id"])
+        if sm is None:
+            continue
+        print("{0}\t{1}\t{2}\t{3}\t{4}\t{5:.4f}\t{6:.4f}\t{7:.4f}\t{8:.4f}, {9:.4f}\t{10}\t{11}".format(
+            run["prefix"], run["testname"], run["query"], run["scale"],
+            sm["nsamples"], sm["median"], sm["min"], sm["avg"], sm["ci_low"],
+            sm["ci_high"], run["stopreason"], run_layout(run) or ''))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="""
     Quick-and-dirty script to calc some stats after using run.py.
@@ -102,9 +227,52 @@ if __name__ == "__main__":
                         help="""
                         Directory with results, 'res' is default
                         """)
+    parser.add_argument('-s', '--store',
+                        help="""
+                        Take samples from results store, e.g. res/results.db,
+                        instead of exectime.txt files; see resstore.py. Tests
+                        can be selected with the options below, and they are
+                        still grouped and paired by agg_setup.py functions,
+                        by results dir names.
+                        """)
+    parser.add_argument('--test', help="test name, LIKE pattern (store only)")
+    parser.add_argument('--query', help="query, LIKE pattern (store only)")
+    parser.add_argument('--scale', help="scale (store only)")
+    parser.add_argument('--prefix',
+                        help="beginning of run.py start timestamp, e.g. 2017-04 (store only)")
+    parser.add_argument('--conf', action='append', default=[],
+                        help="key=value, config option value; may be repeated (store only)")
+    parser.add_argument('--layout',
+                        help="""
+                        physical layout of the tables, see layout.py; the
+                        selected tests are still paired with get_paired, so
+                        e.g. brin tests can be compared to heap ones (store
+                        only)
+                        """)
+    parser.add_argument('--list', action='store_true',
+                        help="""
+                        Just print summaries of selected runs instead of
+                        writing res.csv; summaries are computed once per run
+                        and stored (store only)
+                        """)
     args = parser.parse_args()
     if args.d == 'rd':
         percent_speedup_func = percent_speedup_ref_denom
     else:
         percent_speedup_func = percent_speedup_test_denom
-    aggregate(percent_speedup_func, args.r)
+    if args.store is None:
+        aggregate(percent_speedup_func, args.r)
+        sys.exit(0)
+
+    store = ResStore(os.path.abspath(args.store))
+    conf = dict(kv.split('=', 1) for kv in args.conf)
+    runs = store.find_runs(testname=args.test, query=args.query,
+                           scale=args.scale, prefix=args.prefix, conf=conf)
+    if args.layout is not None:
+        runs = [run for run in runs if run_layout(run) == args.layout]
+    if args.list:
+        list_runs(store, runs)
+    else:
+        tests = sorted({os.path.basename(run["resdir"]) for run in runs})
+        aggregate(percent_speedup_func, args.r, store, tests)
+    store.close()
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+
+# Capture of query answers and their verification against the reference
+# answers shipped with dbgen.
+#
+# Answers are written by runners in batches, as they are fetched from a
+# server-side cursor, to answer.out: header line with column names followed by
+# rows with values separated by '|', the same format as dbgen's answers/qN.out.
+# sha256 of the file contents, which depends on the order of rows, and the
+# number of rows are written to answer.sum, so two answers can be compared
+# without reading them.
+#
+# References are taken from <dbgenpath>/answers for scale 1 and from
+# <dbgenpath>/check_answers/RefQueryOutput_100g for scale 100. They are
+# computed with the default substitution parameters, so queries must be
+# generated with qgen -d, see prepare.sh -V. Columns are compared according
+# to check_answers/colprecision.txt, with the spec's tolerances, as cmpq.pl
+# does, but all rows of a column at once.
+
+import os
+import re
+import sys
+import hashlib
+import argparse
+
+try:
+    import numpy as np
+    numpy_loaded = True
+except ImportError:
+    numpy_loaded = False
+
+
+class AnswerWriter(object):
+    def __init__(self, res_dir):
+        self.path = os.path.join(res_dir, "answer.out")
+        self.sum_path = os.path.join(res_dir, "answer.sum")
+        self.f = open(self.path, 'w')
+        self.sha = hashlib.sha256()
+        self.rows = 0
+        self.header_written = False
+
+    def write_line(self, line):
+        line += "\n"
+        self.f.write(line)
+        self.sha.update(line.encode())
+
+    # description is cursor.description, rows is list of tuples
+    def write(self, description, rows):
+        if not self.header_written and description is not None:
+            self.write_line('|'.join(col[0] for col in description))
+            self.header_written = True
+        for row in rows:
+            self.write_line('|'.join('' if v is None else str(v) for v in row))
+        self.rows += len(rows)
+
+    def close(self, description=None):
+        # header of an empty answer
+        self.write([] if description is None else description, [])
+        self.f.close()
+        with open(self.sum_path, 'w') as f:
+            f.write("{0} {1}\n".format(self.sha.hexdigest(), self.rows))
+        return self.sha.hexdigest(), self.rows
+
+
+# Returns path to reference answer for query qnum at scale, or None
+def reference_path(dbgen_dir, qnum, scale):
+    scale = float(scale)
+    if scale == 1:
+        path = os.path.join(dbgen_dir, "answers", "q{}.out".format(qnum))
+    elif scale == 100:
+        path = os.path.join(dbgen_dir, "check_answers", "RefQueryOutput_100g",
+                            "Query{}_100.ref".format(qnum))
+    else:
+        return None
+    return path if os.path.isfile(path) else None
+
+
+# Column types of query qnum, see check_answers/README
+def column_types(dbgen_dir, qnum):
+    with open(os.path.join(dbgen_dir, "check_answers", "colprecision.txt")) as f:
+        lines = f.read().splitlines()
+    return lines[qnum - 1].split()
+
+
+# Read answer with '|'-separated values and header, returns list of rows
+def read_piped(path):
+    with open(path) as f:
+        lines = [l.rstrip('\n') for l in f if l.strip()]
+    return [[v.strip() for v in l.split('|')] for l in lines[1:]]
+
+
+# Read fixed-width answer without header, like RefQueryOutput_100g/*.ref.
+# Columns are separated by runs of positions which are blank in all lines; if
+# there are more of them than needed (values with spaces in a single-row
+# answer), the widest ones are taken.
+def read_fixed(path, ncols):
+    with open(path) as f:
+        lines = [l.rstrip('\n') for l in f if l.strip()]
+    if not lines:
+        return []
+    width = max(len(l) for l in lines)
+    padded = [l.ljust(width) for l in lines]
+    blank = np.all(np.array([list(l) for l in padded]) == ' ', axis=0)
+    runs = []
+    pos = 0
+    while pos < width:
+        if blank[pos]:
+            start = pos
+            while pos < width and blank[pos]:
+                pos += 1
+            # leading blanks are not separators
+            if start > 0 and pos < width:
+                runs.append((start, pos))
+        else:
+            pos += 1
+    runs = sorted(sorted(runs, key=lambda r: r[1] - r[0], reverse=True)[:ncols - 1])
+    bounds = [0] + [r[1] for r in runs] + [width]
+    return [[l[bounds[i]:bounds[i + 1]].strip() for i in range(len(bounds) - 1)]
+            for l in padded]
+
+
+# Compare column of answer with reference column of type coltype. Returns
+# boolean numpy array, True for mismatching rows.
+def column_mismatch(coltype, ans, ref):
+    if coltype == "str":
+        return np.array(ans) != np.array(ref)
+    a = np.array([float(v) for v in ans])
+    r = np.array([float(v) for v in ref])
+    if coltype in ("cnt", "int"):
+        return a != r
+    a, r = np.round(a, 2), np.round(r, 2)
+    if coltype == "sum":
+        return np.abs(a - r) > 100
+    if coltype == "avg":
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.abs(a - r) / np.abs(a) * 100 > 1
+    if coltype == "num":
+        return a != r
+    if coltype == "rat":
+        return np.abs(a - r) > 1
+    raise ValueError("unknown column type {}".format(coltype))
+
+
+# Compare answer.out with the reference answer for query qnum. Returns list
+# of mismatch descriptions, empty if answer is fine, or None if there is no
+# reference for this scale.
+def verify(answer_path, dbgen_dir, qnum, scale):
+    ref_path = reference_path(dbgen_dir, qnum, scale)
+    if ref_path is None:
+        return None
+    types = column_types(dbgen_dir, qnum)
+    ans = read_piped(answer_path)
+    if ref_path.endswith(".ref"):
+        ref = read_fixed(ref_path, len(types))
+    else:
+        ref = read_piped(ref_path)
+    if len(ans) != len(ref):
+        return ["{0} rows in answer, {1} in reference {2}".format(
+            len(ans), len(ref), ref_path)]
+    if not ans:
+        return []
+    for name, rows in (("answer", ans), ("reference", ref)):
+        if any(len(row) != len(types) for row in rows):
+            return ["{0} doesn't have {1} columns".format(name, len(types))]
+    mismatches = []
+    for col, coltype in enumerate(types):
+        try:
+            bad = column_mismatch(coltype, [row[col] for row in ans],
+                                  [row[col] for row in ref])
+        except ValueError as e:
+            mismatches.append("column {0}: {1}".format(col, e))
+            continue
+        for rownum in np.nonzero(bad)[0]:
+            mismatches.append("row {0} column {1} ({2}): {3} vs reference {4}".format(
+                rownum + 1, col, coltype, ans[rownum][col], ref[rownum][col]))
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""
+    Compare answer.out written by run_single.py with the reference answer from
+    dbgen, using the spec's precision for each column.
+    """)
+    parser.add_argument("answer", help="answer.out file")
+    parser.add_argument("query", help="query, e.g. q01 or 1")
+    parser.add_argument("-s", "--scale", required=True, help="scale of the data")
+    parser.add_argument("-g", "--dbgen", required=True,
+                        help="dbgen directory with the reference answers")
+    args = parser.parse_args()
+
+    if not numpy_loaded:
+        print("numpy is not available, can't compare answers")
+        sys.exit(2)
+    qnum = int(re.sub(r'\D', '', args.query))
+    mismatches = verify(args.answer, args.dbgen, qnum, args.scale)
+    if mismatches is None:
+        print("No reference answer for scale {}".format(args.scale))
+        sys.exit(2)
+    for m in mismatches:
+        print(m)
+    print("{} mismatches".format(len(mismatches)))
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,127 @@
+# Durable work queue of a run.py campaign, so that a campaign interrupted by
+# a crash or reboot can be continued with run.py --resume <prefix>, losing
+# only the unfinished work. The queue is SQLite database
+# res/<prefix>-campaign.db:
+#   * meta: run.py options the campaign was started with;
+#   * jobs: merged config of each run_single.py invocation; finished is set
+#     when all its queries are done;
+#   * queries: (job, test name, query) which are done, with the stop reason;
+#   * units: every finished run of a query, with its times, see
+#     StandardRunner.record_exectime.
+# On resume, finished jobs and queries are skipped, and a query interrupted in
+# the middle continues from the first run not recorded here; its results dir
+# is kept and the recorded runs are restored from the queue.
+
+import json
+import time
+import sqlite3
+
+SCHEMA = """
+create table if not exists meta (
+    key text primary key,
+    value text
+);
+
+create table if not exists jobs (
+    id integer primary key,
+    testname text,
+    conf text,
+    finished real
+);
+
+create table if not exists queries (
+    job integer references jobs (id),
+    testname text,
+    query text,
+    stopreason text,
+    finished real,
+    primary key (job, testname, query)
+);
+
+create table if not exists units (
+    job integer references jobs (id),
+    testname text,
+    query text,
+    runnum integer,
+    exec real,
+    fetch real,
+    finished real,
+    primary key (job, testname, query, runnum)
+);
+"""
+
+
+class Campaign(object):
+    def __init__(self, path):
+        self.path = path
+        # run.py and all run_single.py of the campaign write here
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    # Record confs as jobs and run.py options (dict) the campaign is run with
+    def create(self, confs, options):
+        with self.conn:
+            self.conn.execute("insert or replace into meta values ('options', ?)",
+                              (json.dumps(options),))
+            for conf in confs:
+                self.conn.execute("insert into jobs (testname, conf) values (?, ?)",
+                                  (conf["testname"], json.dumps(conf)))
+
+    def options(self):
+        rows = self.conn.execute("select value from meta where key = 'options'").fetchall()
+        return json.loads(rows[0][0]) if rows else {}
+
+    def started(self):
+        return self.conn.execute("select count(*) from jobs").fetchone()[0] > 0
+
+    # Confs of jobs not finished yet, with campaign and campaign_job options
+    # set for run_single.py
+    def pending_confs(self):
+        confs = []
+        for row in self.conn.execute("select * from jobs where finished is null order by id"):
+            conf = json.loads(row["conf"])
+            conf["campaign"] = self.path
+            conf["campaign_job"] = str(row["id"])
+            confs.append(conf)
+        return confs
+
+    def finish_job(self, job):
+        with self.conn:
+            self.conn.execute("update jobs set finished = ? where id = ?", (time.time(), job))
+
+    # Stop reason of the query if it is done, None otherwise
+    def query_stopreason(self, job, testname, query):
+        rows = self.conn.execute(
+            "select stopreason from queries where job = ? and testname = ? and query = ?",
+            (job, testname, query)).fetchall()
+        return rows[0][0] if rows else None
+
+    def finish_query(self, job, testname, query, stopreason):
+        with self.conn:
+            self.conn.execute("insert or replace into queries values (?, ?, ?, ?, ?)",
+                              (job, testname, query, stopreason, time.time()))
+
+    # exec and fetch are secs
+    def add_unit(self, job, testname, query, runnum, exec_time, fetch_time):
+        with self.conn:
+            self.conn.execute(
+                "insert or replace into units (job, testname, query, runnum, exec, fetch, finished)"
+                " values (?, ?, ?, ?, ?, ?, ?)",
+                (job, testname, query, runnum, exec_time, fetch_time, time.time()))
+
+    # Finished runs of the query, (runnum, exec, fetch) in order
+    def units(self, job, testname, query):
+        return [tuple(r) for r in self.conn.execute(
+            "select runnum, exec, fetch from units"
+            " where job = ? and testname = ? and query = ? order by runnum",
+            (job, testname, query))]
+
+    # Summary for the log: (jobs, finished jobs, done queries, finished runs)
+    def progress(self):
+        return tuple(self.conn.execute("""
+        select (select count(*) from jobs), (select count(*) from jobs where finished is not null),
+               (select count(*) from queries), (select count(*) from units)""").fetchone())
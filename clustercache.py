@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+
+# Content-addressed cache of prepared TPC-H clusters. Preparing a cluster
+# (initdb, data generation and loading, keys, indexes, vacuum and analyze,
+# queries) is expensive, and the result depends only on a few inputs: dbgen
+# sources and DDL, scale, Postgres major version, postgresql.conf applied by
+# prepare.sh, index set, physical layout, database name, query generation
+# options and number of update sets. The cluster is stored in
+# <clustercache>/<key>, key being a hash of these inputs, and built with
+# prepare.sh on a miss; see resolve().
+#
+# Each entry has <key>.json with its inputs, size and last use time,
+# <key>.lock and <key>.build. Processes using or building an entry hold a
+# shared lock on <key>.lock, which is only ever locked exclusively by
+# eviction; the builder also holds an exclusive lock on <key>.build, so that
+# the entry is built once. When the total size exceeds the budget, least
+# recently used entries which are not in use are removed.
+
+import os
+import re
+import sys
+import json
+import time
+import glob
+import fcntl
+import shutil
+import hashlib
+import argparse
+import subprocess
+
+from postload import INDEXES
+
+BASEDIR = os.path.dirname(os.path.realpath(__file__))
+
+# key -> open lock file of entries used by this process; the locks are
+# released when the process exits
+held_locks = {}
+
+
+class CacheError(Exception):
+    pass
+
+
+# sha256 of the files matching patterns in directory, by name and content
+def files_hash(directory, patterns):
+    h = hashlib.sha256()
+    paths = sorted({p for pattern in patterns for p in glob.glob(os.path.join(directory, pattern))})
+    for path in paths:
+        h.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+# 9.6, 10, 16...
+def pg_major_version(pginstdir):
+    out = subprocess.check_output([os.path.join(pginstdir, "bin", "postgres"), "--version"],
+                                  universal_newlines=True)
+    # e.g. 'postgres (PostgreSQL) 9.6.5' or '... 17devel'
+    match = re.search(r'\(PostgreSQL\)\s+(\d+)(?:\.(\d+))?', out)
+    if match is None:
+        raise CacheError("can't parse Postgres version: {}".format(out))
+    if int(match.group(1)) < 10:
+        return "{0}.{1}".format(match.group(1), match.group(2))
+    return match.group(1)
+
+
+# Inputs determining the prepared cluster of conf; dict
+def cluster_inputs(conf):
+    dbgen_dir = os.path.abspath(conf.get("dbgenpath", "."))
+    indexes = conf.get("createindexes", "true") == "true"
+    pgconf = os.path.join(BASEDIR, "postgresql.conf")
+    return {
+        "scale": str(conf["scale"]),
+        "pgmajor": pg_major_version(conf["pginstdir"]),
+        "dbgen": os.path.basename(os.path.normpath(dbgen_dir)),
+        "dbgen_sources": files_hash(dbgen_dir, ["*.c", "*.h", "dists.dss"]),
+        "ddl": files_hash(dbgen_dir, ["dss.ddl", "dss.ri"]),
+        "postgresql_conf": files_hash(BASEDIR, ["postgresql.conf"])
+        if os.path.isfile(pgconf) else None,
+        "indexes": [list(i) for i in INDEXES] if indexes else [],
+        "tpchdbname": conf["tpchdbname"],
+        "qgendefault": conf.get("qgendefault", "false") == "true",
+        "refreshsets": int(conf.get("refreshsets", 0)),
+        "layout": conf.get("layout", "heap"),
+    }
+
+
+def cluster_key(inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class ClusterCache(object):
+    def __init__(self, cachedir):
+        self.cachedir = os.path.abspath(cachedir)
+        os.makedirs(self.cachedir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cachedir, key)
+
+    def meta_path(self, key):
+        return os.path.join(self.cachedir, "{}.json".format(key))
+
+    def read_meta(self, key):
+        try:
+            with open(self.meta_path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_meta(self, key, meta):
+        tmp = self.meta_path(key) + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.meta_path(key))
+
+    def entries(self):
+        res = []
+        for path in glob.glob(os.path.join(self.cachedir, "*.json")):
+            key = os.path.basename(path)[:-len(".json")]
+            meta = self.read_meta(key)
+            if meta is not None:
+                res.append((key, meta))
+        return res
+
+    # Returns (pgdatadir, key) of the cluster for conf, building it with
+    # prepare.sh on a miss; the entry stays locked as in use until the
+    # process exits. Then evicts other entries if budget (bytes) is exceeded.
+    def resolve(self, conf, budget=0):
+        inputs = cluster_inputs(conf)
+        key = cluster_key(inputs)
+        # the shared lock keeps the entry from eviction while we build or use
+        # it; it is never upgraded, as flock upgrade is not atomic
+        lock = open(os.path.join(self.cachedir, "{}.lock".format(key)), 'w')
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        if self.read_meta(key) is None:
+            with open(os.path.join(self.cachedir, "{}.build".format(key)), 'w') as build_lock:
+                fcntl.flock(build_lock, fcntl.LOCK_EX)
+                # somebody might have built it while we waited
+                if self.read_meta(key) is None:
+                    self.build(key, inputs, conf)
+        held_locks[key] = lock
+        meta = self.read_meta(key)
+        meta["last_used"] = time.time()
+        self.write_meta(key, meta)
+        print("Using cached cluster {0} at {1}".format(key, self.path(key)))
+        if budget > 0:
+            self.evict(budget)
+        return self.path(key), key
+
+    def build(self, key, inputs, conf):
+        tmpdir = self.path(key) + ".building"
+        print("Cluster {} is not cached, preparing it".format(key))
+        cmd = [os.path.join(BASEDIR, "prepare.sh"), "-s", str(conf["scale"]),
+               "-i", conf["pginstdir"], "-d", tmpdir, "-p", str(conf["pgport"]),
+               "-n", conf["tpchdbname"], "-g", os.path.abspath(conf.get("dbgenpath", "."))]
+        if not inputs["indexes"]:
+            cmd.append("-x")
+        if inputs["qgendefault"]:
+            cmd.append("-V")
+        if inputs["refreshsets"] > 0:
+            cmd.extend(["-U", str(inputs["refreshsets"])])
+        cmd.extend(["-L", inputs["layout"]])
+        start = time.time()
+        if subprocess.call(["bash"] + cmd, cwd=BASEDIR) != 0:
+            shutil.rmtree(tmpdir, True)
+            raise CacheError("preparing cluster {} failed".format(key))
+        shutil.rmtree(self.path(key), True)
+        os.rename(tmpdir, self.path(key))
+        self.write_meta(key, {"inputs": inputs, "size": dir_size(self.path(key)),
+                              "created": time.time(), "build_time": time.time() - start,
+                              "last_used": time.time()})
+
+    # Remove least recently used entries not in use until the total size is
+    # within budget bytes
+    def evict(self, budget):
+        with open(os.path.join(self.cachedir, ".lock"), 'w') as glock:
+            fcntl.flock(glock, fcntl.LOCK_EX)
+            entries = sorted(self.entries(), key=lambda e: e[1].get("last_used", 0))
+            total = sum(meta.get("size", 0) for key, meta in entries)
+            for key, meta in entries:
+                if total <= budget:
+                    break
+                if key in held_locks:
+                    continue
+                with open(os.path.join(self.cachedir, "{}.lock".format(key)), 'w') as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue  # in use
+                    print("Evicting cached cluster {0}, {1} bytes".format(key, meta.get("size", 0)))
+                    os.remove(self.meta_path(key))
+                    shutil.rmtree(self.path(key), True)
+                    os.remove(os.path.join(self.cachedir, "{}.lock".format(key)))
+                    if os.path.exists(os.path.join(self.cachedir, "{}.build".format(key))):
+                        os.remove(os.path.join(self.cachedir, "{}.build".format(key)))
+                total -= meta.get("size", 0)
+            if total > budget:
+                print("WARN: cluster cache is {0} bytes, over budget {1}, but the rest "
+                      "is in use".format(total, budget))
+
+
+# budget option in GB to bytes; 0 is unlimited
+def budget_bytes(conf):
+    return int(float(conf.get("clustercachebudget", 0)) * 1024 ** 3)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""
+    Inspect the cache of prepared clusters, see the top of this file.
+    """)
+    parser.add_argument("cachedir", help="cache directory, <clustercache> option")
+    sub = parser.add_subparsers(dest="cmd")
+    sub.add_parser("list", help="list cached clusters, least recently used first")
+    evict_p = sub.add_parser("evict", help="evict clusters not in use down to budget")
+    evict_p.add_argument("budget", type=float, help="budget in GB, 0 removes everything")
+    args = parser.parse_args()
+
+    cache = ClusterCache(args.cachedir)
+    if args.cmd == "list":
+        print("key\tsize GB\tlast used\tscale\tpg\tdbgen\tindexes\tlayout")
+        for key, meta in sorted(cache.entries(), key=lambda e: e[1].get("last_used", 0)):
+            inputs = meta["inputs"]
+            print("{0}\t{1:.2f}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7}".format(
+                key, meta.get("size", 0) / 1024 ** 3,
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(meta.get("last_used", 0))),
+                inputs["scale"], inputs["pgmajor"], inputs["dbgen"], len(inputs["indexes"]),
+                inputs.get("layout", "heap")))
+    elif args.cmd == "evict":
+        cache.evict(int(args.budget * 1024 ** 3))
+    else:
+        parser.print_help()
+        sys.exit(1)
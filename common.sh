@@ -46,6 +46,11 @@ read_conf() {
     # values for prepare.sh
     TPCHTMP=$(echo "$CONFS" | awk -F' *= *' '/^tpchtmp/{print $2}')
     DBGENPATH=$(echo "$CONFS" | awk -F' *= *' '/^dbgenpath/{print $2}')
+    LOADJOBS=$(echo "$CONFS" | awk -F' *= *' '/^loadjobs/{print $2}')
+    POSTLOADJOBS=$(echo "$CONFS" | awk -F' *= *' '/^postloadjobs/{print $2}')
+    MAINTMEM=$(echo "$CONFS" | awk -F' *= *' '/^maintmem/{print $2}')
+    REFRESHSETS=$(echo "$CONFS" | awk -F' *= *' '/^refreshsets/{print $2}')
+    LAYOUT=$(echo "$CONFS" | awk -F' *= *' '/^layout/{print $2}')
     # values for run.sh
     EXTCONFFILE=$(echo "$CONFS" | awk -F' *= *' '/^extconffile/{print $2}')
     COPYDIR=$(echo "$CONFS" | awk -F' *= *' '/^copydir/{print $2}')
@@ -159,7 +164,8 @@ postgres_stop() {
 
 # Generate queries and put them to $1/queries/qxx.sql, where xx is a number
 # of the query. Also generates qxx.explain.sql and qxx.analyze.sql.
-# Requires DBGENABSPATH set with path to dbgen
+# Requires DBGENABSPATH set with path to dbgen. QGENOPTS, if set, is passed to
+# qgen, e.g. -d for the default substitution parameters.
 gen_queries() {
     cd "$DBGENABSPATH"
     make -j # build dbgen
@@ -171,7 +177,7 @@ gen_queries() {
 	ii=$(printf "%02d" $i)
 	# DSS_QUERY points to dir with queries that qgen uses to build the actual
 	# queries
-	DSS_QUERY="$DBGENABSPATH/queries" ./qgen $i > "$1/queries/q${ii}.sql"
+	DSS_QUERY="$DBGENABSPATH/queries" ./qgen $QGENOPTS $i > "$1/queries/q${ii}.sql"
 	sed 's/^select/explain select/' "$1/queries/q${ii}.sql" > \
 	    "$1/queries/q${ii}.explain.sql"
 	sed 's/^select/explain analyze select/' "$1/queries/q${ii}.sql" > \
@@ -179,3 +185,18 @@ gen_queries() {
     done
     echo "Queries generated"
 }
+
+# Generate $2 update sets for the refresh functions and put them to
+# $1/updates: orders.tbl.uN and lineitem.tbl.uN with rows to insert and
+# delete.N with keys to delete. Requires DBGENABSPATH and SCALE set.
+gen_updates() {
+    cd "$DBGENABSPATH"
+    make -j # build dbgen
+    if ! [ -x "$DBGENABSPATH/dbgen" ]; then
+        die "Can't find dbgen.";
+    fi
+    rm -rf "$1/updates"
+    mkdir -p "$1/updates"
+    DSS_PATH="$1/updates" ./dbgen -s $SCALE -U $2 -b dists.dss -f
+    echo "$2 update sets generated"
+}
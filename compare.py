@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+
+# Compare several builds (test names) against several baselines across all
+# queries at once, taking samples from the results store, see resstore.py.
+#
+# For each (test, baseline) pair and each query, ratio is mean exec time of the
+# test divided by mean exec time of the baseline, so values below 1 are
+# speedups. Its 0.95 CI is computed with bootstrap, resampling both sides;
+# p-value is of two-sided Mann-Whitney U test (normal approximation). The
+# resampling is done for all queries of the pair at once, samples of different
+# length are padded with NaN. Geometric mean of the ratios over the queries,
+# with bootstrap CI, summarizes the pair. A query or geomean is flagged as
+# regression if the whole CI is above 1 + threshold, and as improvement if it
+# is below 1 - threshold.
+#
+# Runs cancelled by the query timeout have incomplete samples; such queries
+# are not compared and are flagged as timeout. In fixed mode all runs are
+# kept in the store, so the first <warmups> samples of such runs are dropped
+# here, like adaptive mode discards them; queries left with less than 2
+# samples on either side are flagged as few samples instead of being judged.
+
+import os
+import sys
+import csv
+import json
+import argparse
+
+import numpy as np
+import scipy.stats
+
+from resstore import ResStore
+
+
+# Drop samples whose distance to the median is more than k times the median
+# distance, like preprocess_samples in agg_setup.py.example
+def mad_filter(samples, k):
+    dis_to_median = np.abs(samples - np.median(samples))
+    d = np.median(dis_to_median)
+    if d == 0:
+        return samples
+    return samples[dis_to_median / d < k]
+
+
+# Whether run was cancelled by the query timeout, see querytimeout in
+# pgtpch.conf.example
+def timed_out(store, run):
+    return store.timeout(run["id"]) is not None or \
+        (run["stopreason"] or '').startswith("timeout")
+
+
+# Number of warmup samples still kept in the store for run: in adaptive mode
+# they are already discarded, in fixed mode all runs are kept
+def kept_warmups(run):
+    conf = json.loads(run["conf"] or '{}')
+    if conf.get("adaptive") == "true":
+        return 0
+    return int(conf.get("warmups", 0))
+
+
+# Latest samples of each (test, query), returns dict test -> query -> numpy
+# array and dict test -> set of queries whose latest run timed out. filters
+# are passed to ResStore.find_runs. Unless keep_warmups, warmups of fixed mode
+# runs are dropped.
+def load_samples(store, tests, mad, filters, keep_warmups=False):
+    res, timeouts = {}, {}
+    for test in tests:
+        for run in store.find_runs(testname=test, **filters):
+            # runs are ordered by start time, so the latest wins
+            query = run["query"]
+            if timed_out(store, run):
+                res.get(test, {}).pop(query, None)
+                timeouts.setdefault(test, set()).add(query)
+                continue
+            samples = np.array(store.samples(run["id"]))
+            if not keep_warmups:
+                samples = samples[kept_warmups(run):]
+            if mad is not None and samples.size > 0:
+                samples = mad_filter(samples, mad)
+            if samples.size > 0:
+                res.setdefault(test, {})[query] = samples
+                timeouts.get(test, set()).discard(query)
+    return res, timeouts
+
+
+# Pack list of 1-d arrays into 2-d array padded with NaN, returns it and the
+# lengths
+def pad(arrays):
+    lens = np.array([a.size for a in arrays])
+    packed = np.full((len(arrays), lens.max()), np.nan)
+    for i, a in enumerate(arrays):
+        packed[i, :a.size] = a
+    return packed, lens
+
+
+# Bootstrap means of each row of padded samples: returns array (rows, nboot)
+def bootstrap_means(packed, lens, nboot, rng):
+    idx = np.floor(rng.random((packed.shape[0], nboot, packed.shape[1])) *
+                   lens[:, None, None]).astype(int)
+    resampled = np.take_along_axis(packed[:, None, :].repeat(nboot, axis=1), idx, axis=2)
+    # positions beyond the row length are padding
+    mask = np.arange(packed.shape[1])[None, None, :] < lens[:, None, None]
+    return np.where(mask, resampled, 0).sum(axis=2) / lens[:, None]
+
+
+# Two-sided Mann-Whitney U test p-values of each pair of rows, normal
+# approximation with tie correction ignored
+def mannwhitney_p(x, xlens, y, ylens):
+    # compare every sample of x with every sample of y, NaN comparisons are
+    # false and don't count
+    xx, yy = x[:, :, None], y[:, None, :]
+    u = (xx > yy).sum(axis=(1, 2)) + 0.5 * (xx == yy).sum(axis=(1, 2))
+    mu = xlens * ylens / 2
+    sigma = np.sqrt(xlens * ylens * (xlens + ylens + 1) / 12)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (np.abs(u - mu) - 0.5) / sigma
+    return np.clip(2 * scipy.stats.norm.sf(z), 0, 1)
+
+
+# Compare test against baseline over queries both have. Returns list of rows
+# for the output, the last one is geomean.
+def compare_pair(test, baseline, test_samples, base_samples, nboot, threshold, rng):
+    queries = sorted(set(test_samples) & set(base_samples))
+    if not queries:
+        return []
+    t_packed, t_lens = pad([test_samples[q] for q in queries])
+    b_packed, b_lens = pad([base_samples[q] for q in queries])
+    t_means, b_means = np.nanmean(t_packed, axis=1), np.nanmean(b_packed, axis=1)
+    ratios = t_means / b_means
+    boot = bootstrap_means(t_packed, t_lens, nboot, rng) / \
+        bootstrap_means(b_packed, b_lens, nboot, rng)
+    ci = np.percentile(boot, [2.5, 97.5], axis=1)
+    pvalues = mannwhitney_p(t_packed, t_lens, b_packed, b_lens)
+
+    geomean = np.exp(np.mean(np.log(ratios)))
+    geo_ci = np.percentile(np.exp(np.mean(np.log(boot), axis=0)), [2.5, 97.5])
+
+    rows = []
+    for i, query in enumerate(queries):
+        if min(t_lens[i], b_lens[i]) < 2:
+            qflag = "few samples"
+        else:
+            qflag = flag(ci[0][i], ci[1][i], threshold)
+        rows.append([test, baseline, query, t_lens[i], b_lens[i], t_means[i],
+                     b_means[i], ratios[i], ci[0][i], ci[1][i], pvalues[i], qflag])
+    rows.append([test, baseline, "geomean", '', '', '', '', geomean, geo_ci[0],
+                 geo_ci[1], '', flag(geo_ci[0], geo_ci[1], threshold)])
+    return rows
+
+
+def flag(ci_low, ci_high, threshold):
+    if ci_low > 1 + threshold:
+        return "regression"
+    if ci_high < 1 - threshold:
+        return "improvement"
+    return ''
+
+
+def compare(store, tests, baselines, filters, nboot, threshold, mad, seed, out,
+            keep_warmups=False):
+    samples, timeouts = load_samples(store, sorted(set(tests) | set(baselines)), mad,
+                                     filters, keep_warmups)
+    rng = np.random.default_rng(seed)
+    header = ["test", "baseline", "query", "test runs", "baseline runs",
+              "test avg", "baseline avg", "ratio", "ratio 0.95 CI low",
+              "ratio 0.95 CI high", "Mann-Whitney p", "flag"]
+    with open(out, 'w', newline='') as csvfile:
+        csvwriter = csv.writer(csvfile, delimiter='\t')
+        csvwriter.writerow(header)
+        for baseline in baselines:
+            for test in tests:
+                if test == baseline:
+                    continue
+                # timed out on either side, while the other side has results
+                t_all = set(samples.get(test, {})) | timeouts.get(test, set())
+                b_all = set(samples.get(baseline, {})) | timeouts.get(baseline, set())
+                for query in sorted(t_all & b_all):
+                    if query in timeouts.get(test, set()) or \
+                       query in timeouts.get(baseline, set()):
+                        print("WARN: {0} vs {1}, {2}: timed out, not compared".format(
+                            test, baseline, query))
+                        csvwriter.writerow([test, baseline, query] + [''] * 8 + ["timeout"])
+                if test not in samples or baseline not in samples:
+                    continue
+                rows = compare_pair(test, baseline, samples[test], samples[baseline],
+                                    nboot, threshold, rng)
+                for row in rows:
+                    csvwriter.writerow([round(v, 6) if isinstance(v, float) else v
+                                        for v in row])
+                    if row[-1]:
+                        print("{0} vs {1}, {2}: {3}, ratio {4:.3f} [{5:.3f}, {6:.3f}]".format(
+                            test, baseline, row[2], row[-1], row[7], row[8], row[9]))
+                if rows:
+                    geo = rows[-1]
+                    print("{0} vs {1}: geomean ratio {2:.3f} [{3:.3f}, {4:.3f}] over {5} queries".format(
+                        test, baseline, geo[7], geo[8], geo[9], len(rows) - 1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""
+    Compare each of the tests against each of the baselines over all queries,
+    with bootstrap CIs of mean exec time ratios, Mann-Whitney p-values and
+    geometric mean per pair; see the header of this script. Samples are taken
+    from the results store written by the runners. Writes compare.tsv.
+    """)
+    parser.add_argument("-s", "--store", default=os.path.join("res", "results.db"),
+                        help="results store, res/results.db by default")
+    parser.add_argument("-t", "--tests", nargs='+',
+                        help="test names to compare, all in the store by default")
+    parser.add_argument("-b", "--baselines", nargs='+',
+                        help="test names to compare against, --tests by default")
+    parser.add_argument("--scale", help="take only runs with this scale")
+    parser.add_argument("--prefix",
+                        help="take only runs with timestamp starting with this")
+    parser.add_argument("--conf", action='append', default=[],
+                        help="key=value, take only runs with this config value; may be repeated")
+    parser.add_argument("--threshold", type=float, default=0.02,
+                        help="""flag pairs whose ratio CI is entirely beyond 1 +- this,
+                        0.02 by default""")
+    parser.add_argument("--bootstrap", type=int, default=2000,
+                        help="number of bootstrap resamples, 2000 by default")
+    parser.add_argument("--mad", type=float,
+                        help="""filter out samples farther from the median than
+                        this number of median absolute deviations, not filtered
+                        by default; preprocess_samples in
+                        agg_setup.py.example uses 100""")
+    parser.add_argument("--keep-warmups", action="store_true",
+                        help="""don't drop the first <warmups> samples of runs in
+                        fixed mode""")
+    parser.add_argument("--seed", type=int, help="seed for bootstrap")
+    parser.add_argument("-o", "--out", default="compare.tsv",
+                        help="output file, compare.tsv by default")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.store):
+        print("results store {} not found".format(args.store))
+        sys.exit(1)
+    store = ResStore(args.store)
+    filters = {"scale": args.scale, "prefix": args.prefix,
+               "conf": dict(kv.split('=', 1) for kv in args.conf)}
+    tests = args.tests
+    if tests is None:
+        tests = sorted({run["testname"] for run in store.find_runs(**filters)})
+    baselines = args.baselines if args.baselines is not None else tests
+    compare(store, tests, baselines, filters, args.bootstrap, args.threshold,
+            args.mad, args.seed, args.out, args.keep_warmups)
+    store.close()
@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+
+# Folded stacks: 'frame;frame;...;frame count' lines, as produced by
+# stackcollapse-perf.pl and consumed by flamegraph.pl. perf script output is
+# folded here while it is being read, so no intermediate perf-script file is
+# needed; PerfRunner runs this in a background pool. Folded profiles of
+# several runs can be merged, and two profiles can be turned into the input of
+# differential flamegraph ('stack count_ref count_test' lines, like
+# difffolded.pl does).
+
+import os
+import re
+import sys
+import argparse
+import tempfile
+import subprocess
+
+# first line of a sample: comm, pid[/tid], ...
+HEADER_RE = re.compile(r'^(\S.*?)\s+\d+(/\d+)?\s')
+# stack frame: address, symbol with offset, (dso)
+FRAME_RE = re.compile(r'^\s+[0-9a-fA-F]+\s+(.*?)(\s+\((.*)\))?$')
+OFFSET_RE = re.compile(r'\+0x[0-9a-fA-F]+$')
+
+
+# Fold perf script output given as iterable of lines, returns dict
+# stack -> number of samples. Stacks start with the process name, like
+# stackcollapse-perf.pl does, or with root, if given.
+def fold_lines(lines, root=None):
+    counts = {}
+    comm = None
+    frames = []
+
+    def flush():
+        if comm is not None:
+            stack = ';'.join([comm] + frames[::-1])
+            counts[stack] = counts.get(stack, 0) + 1
+
+    for line in lines:
+        line = line.rstrip('\n')
+        if not line.strip():
+            flush()
+            comm, frames = None, []
+            continue
+        if line.startswith('#'):
+            continue
+        if not line[0].isspace():
+            # new sample, the previous one might lack the empty line
+            flush()
+            match = HEADER_RE.match(line)
+            if root is not None:
+                comm = root
+            else:
+                comm = match.group(1).replace(' ', '_') if match else line.split()[0]
+            frames = []
+            continue
+        match = FRAME_RE.match(line)
+        if match is None:
+            continue
+        sym = OFFSET_RE.sub('', match.group(1))
+        if sym == "[unknown]" and match.group(3):
+            sym = "[{}]".format(os.path.basename(match.group(3)))
+        # ';' separates frames and spaces separate the count
+        frames.append(sym.replace(';', ':').replace(' ', '_'))
+    flush()
+    return counts
+
+
+def write_folded(counts, path):
+    with open(path, 'w') as f:
+        for stack in sorted(counts):
+            f.write("{0} {1}\n".format(stack, counts[stack]))
+
+
+def read_folded(path):
+    counts = {}
+    with open(path) as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack:
+                counts[stack] = counts.get(stack, 0) + int(count)
+    return counts
+
+
+# Run perf script on perfdata and fold its output, stacks start with root if
+# it is given. If script_path is given, perf script output is saved there as
+# well. Removes perfdata if rmperfdata is true. Returns (dict stack -> count,
+# perf script stderr). stderr goes to a temp file, as perf script may write
+# more of it than a pipe holds while we are reading stdout.
+def fold_perfdata(perfdata, script_path=None, rmperfdata=False, root=None):
+    stderr_f = tempfile.TemporaryFile('w+', errors="replace")
+    perf_script = subprocess.Popen(["perf", "script", "-i", perfdata],
+                                   stdout=subprocess.PIPE, stderr=stderr_f,
+                                   universal_newlines=True, errors="replace")
+    script_f = open(script_path, 'w') if script_path is not None else None
+
+    def lines():
+        for line in perf_script.stdout:
+            if script_f is not None:
+                script_f.write(line)
+            yield line
+
+    try:
+        counts = fold_lines(lines(), root)
+    finally:
+        if script_f is not None:
+            script_f.close()
+    perf_script.wait()
+    stderr_f.seek(0)
+    stderr = stderr_f.read()
+    stderr_f.close()
+    if rmperfdata:
+        os.remove(perfdata)
+    return counts, stderr
+
+
+# Sum dicts stack -> count
+def add_counts(counts, more):
+    for stack, count in more.items():
+        counts[stack] = counts.get(stack, 0) + count
+    return counts
+
+
+# Sum folded profiles in paths into out
+def merge_folded(paths, out):
+    counts = {}
+    for path in paths:
+        add_counts(counts, read_folded(path))
+    write_folded(counts, out)
+    return out
+
+
+# Write input of differential flamegraph of test against ref to out. If
+# normalize is true, ref counts are scaled to the test total, so profiles of
+# runs of different length are comparable.
+def diff_folded(ref_path, test_path, out, normalize=True):
+    ref, test = read_folded(ref_path), read_folded(test_path)
+    scale = 1.0
+    if normalize and ref and test:
+        scale = sum(test.values()) / sum(ref.values())
+    with open(out, 'w') as f:
+        for stack in sorted(set(ref) | set(test)):
+            f.write("{0} {1} {2}\n".format(stack, int(round(ref.get(stack, 0) * scale)),
+                                           test.get(stack, 0)))
+    return out
+
+
+# Render folded (or diff) file with flamegraph.pl from fg_path. Returns
+# flamegraph.pl stderr, or raises CalledProcessError.
+def render_flamegraph(fg_path, folded, svg, title=None):
+    cmd = [os.path.join(fg_path, "flamegraph.pl")]
+    if title is not None:
+        cmd.extend(["--title", title])
+    cmd.append(folded)
+    with open(svg, 'w') as f:
+        res = subprocess.run(cmd, stdout=f, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    if res.returncode != 0:
+        raise subprocess.CalledProcessError(res.returncode, cmd, stderr=res.stderr)
+    return res.stderr
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""
+    Fold perf script output, merge folded profiles and build differential
+    flamegraphs.
+    """)
+    sub = parser.add_subparsers(dest="cmd")
+    fold_p = sub.add_parser("fold", help="fold perf script output read from stdin")
+    fold_p.add_argument("out", help="folded file to write")
+    merge_p = sub.add_parser("merge", help="sum several folded profiles")
+    merge_p.add_argument("out", help="folded file to write")
+    merge_p.add_argument("folded", nargs='+', help="folded files")
+    diff_p = sub.add_parser("diff", help="""
+    differential flamegraph of test against ref: red frames got more samples,
+    blue ones less""")
+    diff_p.add_argument("ref", help="folded profile of the reference build")
+    diff_p.add_argument("test", help="folded profile of the test build")
+    diff_p.add_argument("out", help="svg to write")
+    diff_p.add_argument("-g", "--fg-path", required=True,
+                        help="directory with flamegraph.pl")
+    diff_p.add_argument("--no-normalize", action="store_true",
+                        help="don't scale ref counts to the test total")
+    args = parser.parse_args()
+
+    if args.cmd == "fold":
+        write_folded(fold_lines(sys.stdin), args.out)
+    elif args.cmd == "merge":
+        merge_folded(args.folded, args.out)
+    elif args.cmd == "diff":
+        diff_path = args.out + ".diff-folded"
+        diff_folded(args.ref, args.test, diff_path, not args.no_normalize)
+        render_flamegraph(args.fg_path, diff_path, args.out)
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+
+# Physical layouts of lineitem and orders, the big tables, selected by layout
+# option of pgtpch.conf (prepare.sh -L):
+#   * heap: plain tables in dbgen order with B-tree indexes, as in dss.ddl;
+#   * partitioned: both tables are range partitioned by year of l_shipdate
+#     and o_orderdate. Unique constraints on partitioned tables must include
+#     the partition key, so their primary keys from dss.ri become plain
+#     indexes on the same columns and foreign keys referencing orders are not
+#     created. Needs Postgres 11 or later, for indexes on partitioned tables;
+#   * clustered: both tables are rewritten in date order after the load, so
+#     the dates are physically correlated, like after CLUSTER on the date
+#     indexes, but without needing them;
+#   * brin: clustered, with BRIN indexes instead of the date B-trees.
+# The partitioned tables are created before the load by SQL this script
+# prints, the rest is done by postload.py, which finally records the layout
+# in the comment on lineitem. Runners read it back and record it with each
+# run, see detect().
+
+import sys
+import argparse
+
+LAYOUTS = ["heap", "partitioned", "clustered", "brin"]
+
+# table -> column it is partitioned or sorted by
+DATE_KEYS = {"lineitem": "l_shipdate", "orders": "o_orderdate"}
+
+# B-tree indexes of postload.INDEXES replaced with BRIN in brin layout
+BRIN_INDEXES = ["i_l_shipdate", "i_l_receiptdate", "i_l_commitdate", "i_o_orderdate"]
+
+# years of the partitions; dbgen dates are between 1992 and 1998, the first
+# and the last partitions are open-ended anyway
+PARTITION_YEARS = range(1992, 1999)
+
+# pg_stats correlation of the date above which a table is considered sorted
+SORTED_CORRELATION = 0.9
+
+# comment on lineitem recording the layout the cluster was prepared with
+COMMENT_PREFIX = "pgtpch layout: "
+
+
+class LayoutError(Exception):
+    pass
+
+
+def check(layout):
+    if layout not in LAYOUTS:
+        raise LayoutError("unknown layout {0}, must be one of {1}".format(
+            layout, ', '.join(LAYOUTS)))
+
+
+# Tables partitioned in layout
+def partitioned_tables(layout):
+    return list(DATE_KEYS) if layout == "partitioned" else []
+
+
+# dict table -> column of tables rewritten in date order in layout
+def sorted_tables(layout):
+    return dict(DATE_KEYS) if layout in ("clustered", "brin") else {}
+
+
+def index_method(layout, index):
+    return "brin" if layout == "brin" and index in BRIN_INDEXES else "btree"
+
+
+# SQL replacing empty table created by dss.ddl with the same one partitioned
+# by year
+def partition_sql(table):
+    key = DATE_KEYS[table]
+    stmts = ["ALTER TABLE {0} RENAME TO {0}_heap".format(table),
+             "CREATE TABLE {0} (LIKE {0}_heap INCLUDING ALL) PARTITION BY RANGE ({1})".format(
+                 table, key),
+             "DROP TABLE {0}_heap".format(table)]
+    for year in PARTITION_YEARS:
+        lower = "MINVALUE" if year == PARTITION_YEARS[0] else "'{}-01-01'".format(year)
+        upper = "MAXVALUE" if year == PARTITION_YEARS[-1] else "'{}-01-01'".format(year + 1)
+        stmts.append("CREATE TABLE {0}_{1} PARTITION OF {0} FOR VALUES FROM ({2}) TO ({3})".format(
+            table, year, lower, upper))
+    return ";\n".join(stmts) + ";\n"
+
+
+# SQL rewriting loaded table in date order; must run before any keys and
+# indexes are created
+def sort_sql(table):
+    return ("CREATE TABLE {0}_sorted (LIKE {0} INCLUDING ALL); "
+            "INSERT INTO {0}_sorted SELECT * FROM {0} ORDER BY {1}; "
+            "DROP TABLE {0}; "
+            "ALTER TABLE {0}_sorted RENAME TO {0}").format(table, DATE_KEYS[table])
+
+
+# SQL recording layout in the cluster; run when the tables are final, after
+# postload.py rewrote them
+def comment_sql(layout):
+    return "COMMENT ON TABLE lineitem IS '{0}{1}'".format(COMMENT_PREFIX, layout)
+
+
+# SQL to run after dss.ddl and before the load
+def preload_sql(layout):
+    return ''.join(partition_sql(table) for table in partitioned_tables(layout))
+
+
+# Layout of the TPC-H database conn is connected to: the one recorded by
+# postload.py, or, for clusters prepared before it recorded one, guessed from
+# the catalog. Returns one of LAYOUTS, or None if there is no lineitem.
+def detect(conn):
+    with conn.cursor() as curs:
+        curs.execute("select relkind::text, obj_description(oid, 'pg_class') from pg_class "
+                     "where oid = to_regclass('lineitem')")
+        row = curs.fetchone()
+        if row is None:
+            return None
+        if row[1] is not None and row[1].startswith(COMMENT_PREFIX) and \
+           row[1][len(COMMENT_PREFIX):] in LAYOUTS:
+            return row[1][len(COMMENT_PREFIX):]
+        if row[0] == 'p':
+            return "partitioned"
+        curs.execute("""
+        select count(*) from pg_index i
+        join pg_class c on c.oid = i.indexrelid
+        join pg_am a on a.oid = c.relam
+        where i.indrelid = to_regclass('lineitem') and a.amname = 'brin'""")
+        if curs.fetchone()[0] > 0:
+            return "brin"
+        curs.execute("select correlation from pg_stats where tablename = 'lineitem' "
+                     "and attname = %s", (DATE_KEYS["lineitem"],))
+        row = curs.fetchone()
+        if row is not None and row[0] is not None and row[0] > SORTED_CORRELATION:
+            return "clustered"
+        return "heap"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""
+    Print SQL to run after dss.ddl and before loading the data for the
+    layout, see the top of this file; prepare.sh pipes it to psql.
+    """)
+    parser.add_argument("layout", choices=LAYOUTS, help="layout")
+    args = parser.parse_args()
+    sys.stdout.write(preload_sql(args.layout))
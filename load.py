@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+
+# Generate TPC-H data and load it into Postgres without intermediate *.tbl
+# files. Invoked from prepare.sh after the tables are created, but can be run
+# by hand as well, see --help.
+#
+# Each big table is split into chunks with dbgen's own -C/-S options. For each
+# chunk we create a named pipe in a private temporary directory, point dbgen
+# there via DSS_PATH and feed the pipe to COPY FROM STDIN over a separate
+# connection. Chunks are processed by a pool of worker processes, so all cores
+# are busy generating and loading and no scratch disk space is needed.
+#
+# Proper libpq.so must be in runtime linker search path when you invoke this
+# script, as with run_single.py.
+
+import os
+import sys
+import time
+import shutil
+import getpass
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+import psycopg2
+
+# (dbgen -T letter, table name, whether it is big enough to be split into
+# chunks). Bigger tables come first, so that the pool picks them up early and
+# doesn't end up waiting for the single lineitem chunk at the very end.
+TABLES = [
+    ("L", "lineitem", True),
+    ("O", "orders", True),
+    ("S", "partsupp", True),
+    ("P", "part", True),
+    ("c", "customer", True),
+    ("s", "supplier", True),
+    ("n", "nation", False),
+    ("r", "region", False),
+]
+
+
+class DbgenError(Exception):
+    pass
+
+
+# File-like wrapper counting bytes passing through it, copy_expert only needs
+# read()
+class CountingReader(object):
+    def __init__(self, f):
+        self.f = f
+        self.nbytes = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.nbytes += len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.f.readline(size)
+        self.nbytes += len(data)
+        return data
+
+
+# Open the pipe for reading without waiting for dbgen. Also keeps our own
+# write end open until dbgen exits: otherwise reads would return EOF before
+# dbgen opened the pipe, and if dbgen died before opening it, a plain blocking
+# open() would hang forever. Returns (reader file object, write end fd).
+def open_fifo(fifo_path):
+    rfd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+    wfd = os.open(fifo_path, os.O_WRONLY)
+    os.set_blocking(rfd, True)
+    return os.fdopen(rfd, "rb"), wfd
+
+
+# close our write end of the pipe once dbgen is gone, so the reader gets EOF
+def close_when_done(dbgen, wfd):
+    dbgen.wait()
+    os.close(wfd)
+
+
+# Generate chunk number chunk out of nchunks of the table and COPY it. Runs in
+# worker process. Returns (table name, bytes loaded, start time, end time).
+def load_chunk(unit):
+    letter, table, chunk, nchunks, opts = unit
+    start = time.time()
+    fifo_dir = tempfile.mkdtemp(prefix="pgtpch-{0}-{1}-".format(table, chunk))
+    try:
+        # that's how dbgen names the output files
+        if nchunks == 1:
+            fifo_name = "{}.tbl".format(table)
+        else:
+            fifo_name = "{0}.tbl.{1}".format(table, chunk)
+        fifo_path = os.path.join(fifo_dir, fifo_name)
+        os.mkfifo(fifo_path)
+
+        dbgen_cmd = [os.path.join(opts["dbgen"], "dbgen"), "-s", opts["scale"],
+                     "-b", os.path.join(opts["dbgen"], "dists.dss"),
+                     "-f", "-T", letter]
+        if nchunks > 1:
+            dbgen_cmd.extend(["-C", str(nchunks), "-S", str(chunk)])
+        env = dict(os.environ, DSS_PATH=fifo_dir)
+        dbgen = subprocess.Popen(dbgen_cmd, env=env, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE)
+        # drain stderr in background so dbgen never blocks on it
+        stderr_chunks = []
+        stderr_reader = threading.Thread(
+            target=lambda: stderr_chunks.append(dbgen.stderr.read()))
+        stderr_reader.start()
+        fifo, wfd = open_fifo(fifo_path)
+        waker = threading.Thread(target=close_when_done, args=(dbgen, wfd))
+        waker.start()
+
+        conn = psycopg2.connect(opts["dsn"])
+        try:
+            with conn.cursor() as curs, fifo:
+                reader = CountingReader(fifo)
+                # Tables with a single chunk can be truncated in the same
+                # transaction to let Postgres skip WAL-logging. See
+                # http://www.postgresql.org/docs/current/static/populate.html#POPULATE-PITR
+                # For chunked ones it would serialize the loaders on the lock,
+                # which is much worse.
+                if nchunks == 1:
+                    curs.execute("truncate {}".format(table))
+                curs.copy_expert(
+                    "COPY {} FROM STDIN WITH DELIMITER AS '|'".format(table),
+                    reader)
+            waker.join()
+            stderr_reader.join()
+            if dbgen.returncode != 0:
+                conn.rollback()
+                raise DbgenError("{0} failed with code {1}: {2}".format(
+                    ' '.join(dbgen_cmd), dbgen.returncode,
+                    b''.join(stderr_chunks).decode(errors="replace")))
+            conn.commit()
+        finally:
+            conn.close()
+    finally:
+        shutil.rmtree(fifo_dir, True)
+    return table, reader.nbytes, start, time.time()
+
+
+# Returns list of work units for the pool
+def make_units(opts, chunks, tables):
+    units = []
+    for letter, table, chunkable in TABLES:
+        if table not in tables:
+            continue
+        nchunks = chunks if chunkable else 1
+        for chunk in range(1, nchunks + 1):
+            units.append((letter, table, chunk, nchunks, opts))
+    return units
+
+
+def load(opts, jobs, chunks, tables):
+    units = make_units(opts, chunks, tables)
+    print("Loading {0} in {1} chunks with {2} workers".format(
+        ' '.join(tables), len(units), jobs))
+
+    # per table: [bytes, first chunk start, last chunk end, chunks done]
+    stats = {}
+    load_start = time.time()
+    with multiprocessing.Pool(jobs) as pool:
+        for table, nbytes, start, end in pool.imap_unordered(load_chunk, units):
+            st = stats.setdefault(table, [0, start, end, 0])
+            st[0] += nbytes
+            st[1] = min(st[1], start)
+            st[2] = max(st[2], end)
+            st[3] += 1
+    total_bytes = 0
+    for letter, table, chunkable in TABLES:
+        if table not in stats:
+            continue
+        nbytes, start, end, nchunks = stats[table]
+        total_bytes += nbytes
+        elapsed = max(end - start, 1e-6)
+        print("{0:>10}: {1} chunk(s), {2:.1f} MB in {3:.1f} s, {4:.1f} MB/s".format(
+            table, nchunks, nbytes / 1e6, elapsed, nbytes / 1e6 / elapsed))
+    elapsed = max(time.time() - load_start, 1e-6)
+    print("{0:>10}: {1:.1f} MB in {2:.1f} s, {3:.1f} MB/s".format(
+        "total", total_bytes / 1e6, elapsed, total_bytes / 1e6 / elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""
+    Generate TPC-H data with dbgen and stream it straight to COPY FROM STDIN,
+    splitting big tables into chunks loaded in parallel. Tables must already
+    exist. Reports per-table load throughput.
+    """)
+    parser.add_argument("-s", "--scale", required=True,
+                        help="scale passed to dbgen")
+    parser.add_argument("-g", "--dbgen", required=True,
+                        help="directory with built dbgen and dists.dss")
+    parser.add_argument("-p", "--port", required=True, help="Postgres port")
+    parser.add_argument("-n", "--dbname", required=True,
+                        help="database with TPC-H tables")
+    parser.add_argument("-H", "--host", default="/tmp",
+                        help="host or socket directory, /tmp by default")
+    parser.add_argument("-U", "--user", default=getpass.getuser(),
+                        help="user to connect as, `whoami` by default")
+    parser.add_argument("-j", "--jobs", type=int, default=0,
+                        help="number of parallel loaders, number of cores by default")
+    parser.add_argument("-C", "--chunks", type=int, default=0,
+                        help="number of chunks for big tables, --jobs by default")
+    parser.add_argument("-t", "--tables", default=' '.join(t[1] for t in TABLES),
+                        help="space separated list of tables to load, all by default")
+    args = parser.parse_args()
+
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    chunks = args.chunks if args.chunks > 0 else jobs
+    dbgen_dir = os.path.abspath(args.dbgen)
+    if not os.access(os.path.join(dbgen_dir, "dbgen"), os.X_OK):
+        print("Can't find dbgen in {}".format(dbgen_dir))
+        sys.exit(1)
+    opts = {
+        "scale": args.scale,
+        "dbgen": dbgen_dir,
+        "dsn": "host={0} port={1} user={2} dbname={3}".format(
+            args.host, args.port, args.user, args.dbname),
+    }
+    load(opts, jobs, chunks, args.tables.split())
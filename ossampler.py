@@ -0,0 +1,181 @@
+# Sampler of OS resource usage of a query run: a thread which every interval
+# reads /proc/<pid>/{stat,io,status} of the backend and its parallel workers,
+# and system-wide /proc/vmstat and /proc/diskstats. Parallel workers are found
+# among the children of postmaster by their process title, 'parallel worker
+# for PID <backend pid>', so no database connection is needed. Time series is
+# written as tsv, and aggregates of the run are returned by stop().
+#
+# Counters of processes are cumulative; for the backend the values at the
+# start are subtracted, workers are born during the run. Values of workers
+# which have exited are kept as last seen, so the tail of their work between
+# the last sample and exit is lost; make interval shorter if it matters.
+
+import os
+import time
+import threading
+
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+SECTOR_SIZE = 512
+
+TS_COLUMNS = ["time", "procs", "cpu_user", "cpu_sys", "read_bytes", "write_bytes",
+              "rss_bytes", "major_faults", "sys_major_faults", "disk_read_bytes",
+              "disk_write_bytes"]
+
+
+# Returns dict with counters of process pid, or None if it is gone
+def read_proc(pid):
+    res = {}
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            # comm in parentheses might contain spaces
+            fields = f.read().rsplit(')', 1)[1].split()
+        # fields are numbered from 1 in proc(5), and the first two are cut
+        res["minflt"] = int(fields[7])
+        res["majflt"] = int(fields[9])
+        res["utime"] = int(fields[11]) / CLK_TCK
+        res["stime"] = int(fields[12]) / CLK_TCK
+        res["rss"] = int(fields[21]) * PAGE_SIZE
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    res["hwm"] = int(line.split()[1]) * 1024
+        res["read_bytes"] = res["write_bytes"] = 0
+        try:
+            with open("/proc/{}/io".format(pid)) as f:
+                for line in f:
+                    key, value = line.split(':')
+                    if key in ("read_bytes", "write_bytes"):
+                        res[key] = int(value)
+        except PermissionError:
+            # io is readable only by the owner of the process
+            pass
+    except (FileNotFoundError, ProcessLookupError, IndexError):
+        return None
+    return res
+
+
+# pids of parallel workers of backend leader_pid
+def find_workers(leader_pid, postmaster_pid):
+    title = "parallel worker for PID {}".format(leader_pid)
+    children_path = "/proc/{0}/task/{0}/children".format(postmaster_pid)
+    try:
+        with open(children_path) as f:
+            candidates = f.read().split()
+    except OSError:
+        candidates = [p for p in os.listdir("/proc") if p.isdigit()]
+    workers = []
+    for pid in candidates:
+        try:
+            with open("/proc/{}/cmdline".format(pid), 'rb') as f:
+                if title in f.read().decode(errors="replace"):
+                    workers.append(int(pid))
+        except OSError:
+            pass
+    return workers
+
+
+def parent_pid(pid):
+    with open("/proc/{}/stat".format(pid)) as f:
+        return int(f.read().rsplit(')', 1)[1].split()[1])
+
+
+# system-wide major faults and bytes read and written by whole disks
+def read_system():
+    res = {"sys_major_faults": 0, "disk_read_bytes": 0, "disk_write_bytes": 0}
+    with open("/proc/vmstat") as f:
+        for line in f:
+            if line.startswith("pgmajfault "):
+                res["sys_major_faults"] = int(line.split()[1])
+    try:
+        disks = {d for d in os.listdir("/sys/block")
+                 if not d.startswith(("loop", "ram"))}
+    except OSError:
+        disks = None
+    with open("/proc/diskstats") as f:
+        for line in f:
+            fields = line.split()
+            if disks is not None and fields[2] not in disks:
+                continue
+            res["disk_read_bytes"] += int(fields[5]) * SECTOR_SIZE
+            res["disk_write_bytes"] += int(fields[9]) * SECTOR_SIZE
+    return res
+
+
+class OsSampler(threading.Thread):
+    def __init__(self, leader_pid, interval, ts_path):
+        super().__init__(daemon=True)
+        self.leader_pid = leader_pid
+        self.postmaster_pid = parent_pid(leader_pid)
+        self.interval = interval
+        self.ts_path = ts_path
+        self.stop_event = threading.Event()
+        # pid -> last seen counters
+        self.procs = {}
+        self.leader_start = read_proc(leader_pid)
+        self.system_start = read_system()
+        self.peak_rss = 0
+        self.start_time = time.monotonic()
+        self.error = None
+
+    def run(self):
+        try:
+            with open(self.ts_path, 'w') as f:
+                f.write('\t'.join(TS_COLUMNS) + '\n')
+                while True:
+                    f.write('\t'.join(str(v) for v in self.sample()) + '\n')
+                    if self.stop_event.wait(self.interval):
+                        break
+                # the final state
+                f.write('\t'.join(str(v) for v in self.sample()) + '\n')
+        except Exception as e:
+            self.error = e
+
+    # Read everything once, returns row of the time series
+    def sample(self):
+        now = time.monotonic() - self.start_time
+        for pid in [self.leader_pid] + find_workers(self.leader_pid, self.postmaster_pid):
+            counters = read_proc(pid)
+            if counters is not None:
+                self.procs[pid] = counters
+        totals = self.totals()
+        rss = sum(c["rss"] for c in self.procs.values())
+        self.peak_rss = max(self.peak_rss, rss)
+        system = read_system()
+        return ["{:.3f}".format(now), len(self.procs),
+                "{:.2f}".format(totals["utime"]), "{:.2f}".format(totals["stime"]),
+                totals["read_bytes"], totals["write_bytes"], rss, totals["majflt"],
+                system["sys_major_faults"] - self.system_start["sys_major_faults"],
+                system["disk_read_bytes"] - self.system_start["disk_read_bytes"],
+                system["disk_write_bytes"] - self.system_start["disk_write_bytes"]]
+
+    # counters summed over the processes, since the start of the run
+    def totals(self):
+        totals = {}
+        for key in ("utime", "stime", "read_bytes", "write_bytes", "majflt", "minflt"):
+            totals[key] = sum(c[key] for c in self.procs.values())
+            if self.leader_start is not None:
+                totals[key] -= self.leader_start[key]
+        return totals
+
+    # Stop sampling, returns dict with aggregates of the run
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        totals = self.totals()
+        system = read_system()
+        return {
+            "cpu_user": round(totals["utime"], 2),
+            "cpu_sys": round(totals["stime"], 2),
+            "cpu": round(totals["utime"] + totals["stime"], 2),
+            "read_bytes": totals["read_bytes"],
+            "write_bytes": totals["write_bytes"],
+            "major_faults": totals["majflt"],
+            "minor_faults": totals["minflt"],
+            "peak_rss": self.peak_rss,
+            "peak_hwm": max([c.get("hwm", 0) for c in self.procs.values()] or [0]),
+            "workers": len(self.procs) - 1,
+            "sys_major_faults": system["sys_major_faults"] - self.system_start["sys_major_faults"],
+            "disk_read_bytes": system["disk_read_bytes"] - self.system_start["disk_read_bytes"],
+            "disk_write_bytes": system["disk_write_bytes"] - self.system_start["disk_write_bytes"],
+        }
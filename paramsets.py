@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+
+# Substitution parameter sets of the TPC-H queries. prepare.sh generates each
+# query once, so every run of it uses the same parameters, i.e. touches the
+# same pages and gets the same plan. Here K variants of each query are
+# generated by qgen with seeds <seed>, <seed> + 1, ..., in parallel, and
+# cached as <query>-s<seed>.sql in
+# <pgdatadir>/queries/params-<dbgen>-<scale>-<hash>; hash covers dbgen's
+# query templates and dists.dss, so the files are regenerated whenever they
+# could differ. StandardRunner rotates through the variants across runs, see
+# paramsets option in pgtpch.conf.example.
+#
+# qgen is also used by the throughput runner to generate its streams, see
+# qgen_many.
+
+import os
+import re
+import argparse
+import subprocess
+import concurrent.futures
+
+from clustercache import files_hash
+
+
+class ParamsError(Exception):
+    pass
+
+
+# Run qgen from dbgen_dir to generate query number qnum; with seed, random
+# parameters are generated with it (qgen -r), with stream, qnum is a position
+# in the stream's permutation (qgen -p). Returns the query text.
+def qgen(dbgen_dir, scale, qnum, seed=None, stream=None):
+    cmd = [os.path.join(dbgen_dir, "qgen"), "-b", os.path.join(dbgen_dir, "dists.dss"),
+           "-s", str(scale)]
+    if stream is not None:
+        cmd.extend(["-p", str(stream)])
+    if seed is not None:
+        cmd.extend(["-r", str(seed)])
+    cmd.append(str(qnum))
+    return subprocess.check_output(
+        cmd, cwd=dbgen_dir,
+        env=dict(os.environ, DSS_QUERY=os.path.join(dbgen_dir, "queries")),
+        universal_newlines=True)
+
+
+# Run qgen for each dict of qgen() keyword args in calls, jobs at a time;
+# returns the texts in the same order
+def qgen_many(dbgen_dir, scale, calls, jobs=None):
+    with concurrent.futures.ThreadPoolExecutor(jobs or os.cpu_count()) as pool:
+        return list(pool.map(lambda kw: qgen(dbgen_dir, scale, **kw), calls))
+
+
+# TPC-H query number of query name like q05, or None
+def query_number(query):
+    match = re.match(r'^q(\d+)$', query)
+    if match is None or not 1 <= int(match.group(1)) <= 22:
+        return None
+    return int(match.group(1))
+
+
+# Directory with the cached variants of queries generated by dbgen_dir at scale
+def params_dir(queries_dir, dbgen_dir, scale):
+    dbgen_hash = files_hash(dbgen_dir, [os.path.join("queries", "*.sql"), "dists.dss"])
+    return os.path.join(queries_dir, "params-{0}-{1}-{2}".format(
+        os.path.basename(os.path.normpath(dbgen_dir)), scale, dbgen_hash[:12]))
+
+
+def variant_path(directory, query, seed):
+    return os.path.join(directory, "{0}-s{1}.sql".format(query, seed))
+
+
+# Make sure there are nvariants variants of each of queries with seeds
+# starting from seed in directory, generating the missing ones in parallel.
+# Returns dict query -> list of (seed, path).
+def ensure_variants(directory, dbgen_dir, scale, queries, nvariants, seed, jobs=None):
+    seeds = list(range(seed, seed + nvariants))
+    missing = []
+    for query in queries:
+        if query_number(query) is None:
+            raise ParamsError("{} is not a TPC-H query, qgen can't generate it".format(query))
+        missing.extend((query, s) for s in seeds
+                       if not os.path.isfile(variant_path(directory, query, s)))
+    if missing:
+        print("Generating {0} query variants in {1}".format(len(missing), directory))
+        os.makedirs(directory, exist_ok=True)
+        texts = qgen_many(dbgen_dir, scale,
+                          [{"qnum": query_number(q), "seed": s} for q, s in missing], jobs)
+        for (query, s), text in zip(missing, texts):
+            path = variant_path(directory, query, s)
+            # others might read the cache concurrently
+            with open(path + ".tmp", 'w') as f:
+                f.write(text)
+            os.rename(path + ".tmp", path)
+    return {query: [(s, variant_path(directory, query, s)) for s in seeds]
+            for query in queries}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""
+    Generate variants of TPC-H queries with different substitution parameters
+    in parallel, see the top of this file. Existing ones are kept.
+    """)
+    parser.add_argument("-d", "--pgdatadir", required=True,
+                        help="cluster directory, variants are put to its queries dir")
+    parser.add_argument("-g", "--dbgen", required=True, help="path to dbgen directory")
+    parser.add_argument("-s", "--scale", required=True, help="scale factor")
+    parser.add_argument("-k", "--variants", type=int, default=4,
+                        help="number of variants of each query, 4 by default")
+    parser.add_argument("-r", "--seed", type=int, default=1,
+                        help="seed of the first variant, 1 by default")
+    parser.add_argument("-q", "--queries", default="all",
+                        help="space separated queries, all by default")
+    parser.add_argument("-j", "--jobs", type=int, default=0,
+                        help="number of qgen processes at once, number of cores by default")
+    args = parser.parse_args()
+
+    dbgen_dir = os.path.abspath(args.dbgen)
+    if args.queries == "all":
+        queries = ["q{:02d}".format(q) for q in range(1, 23)]
+    else:
+        queries = args.queries.split()
+    directory = params_dir(os.path.join(args.pgdatadir, "queries"), dbgen_dir, args.scale)
+    ensure_variants(directory, dbgen_dir, args.scale, queries, args.variants, args.seed,
+                    args.jobs or None)
+    print("Query variants are in {}".format(directory))
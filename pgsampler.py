@@ -0,0 +1,133 @@
+# Postgres-side profile of a query run, without perf and sudo: a thread with
+# its own connection which
+#   * samples wait_event_type/wait_event of the backend and its parallel
+#     workers in pg_stat_activity every interval, counting samples per
+#     (role, wait event); active process without wait event counts as 'CPU';
+#   * takes deltas of pg_stat_database of the current database (buffer hits
+#     and reads, temp files...), pg_statio_user_tables summed over the tables,
+#     pg_stat_io (Postgres 16+) summed over all rows and per-statement
+#     pg_stat_statements (if the extension is installed) between the start
+#     and the end of the run.
+# Cumulative statistics are reported by backends with a delay (up to a second
+# or so, depending on the version), so the final snapshot is taken after
+# statdelay seconds.
+
+import time
+import decimal
+import threading
+
+import psycopg2
+
+
+# Sum numeric columns over the rows of the query result, returns dict
+def numeric_sums(curs, sql):
+    curs.execute(sql)
+    cols = [d[0] for d in curs.description]
+    sums = {}
+    for row in curs.fetchall():
+        for col, value in zip(cols, row):
+            if isinstance(value, (int, float, decimal.Decimal)) and not isinstance(value, bool):
+                sums[col] = sums.get(col, 0) + float(value)
+    return sums
+
+
+def delta(start, end):
+    return {key: end[key] - start.get(key, 0) for key in end}
+
+
+class PgSampler(threading.Thread):
+    # conn is new connection used only by the sampler
+    def __init__(self, conn, leader_pid, interval, statdelay):
+        super().__init__(daemon=True)
+        self.conn = conn
+        self.conn.autocommit = True
+        self.leader_pid = leader_pid
+        self.interval = interval
+        self.statdelay = statdelay
+        self.stop_event = threading.Event()
+        # (role, wait_event_type, wait_event) -> samples
+        self.waits = {}
+        self.error = None
+        with self.conn.cursor() as curs:
+            curs.execute("select count(*) from pg_extension where extname = 'pg_stat_statements'")
+            self.has_pgss = curs.fetchone()[0] > 0
+        self.start_stats = self.snapshot()
+        self.start_pgss = self.pgss_snapshot()
+
+    def snapshot(self):
+        stats = {}
+        with self.conn.cursor() as curs:
+            for kind, sql in [
+                    ("db", "select * from pg_stat_database where datname = current_database()"),
+                    ("statio", "select * from pg_statio_user_tables")] + \
+                    ([("io", "select * from pg_stat_io")]
+                     if self.conn.server_version >= 160000 else []):
+                for col, value in numeric_sums(curs, sql).items():
+                    if col not in ("datid", "relid"):
+                        stats["{0}_{1}".format(kind, col)] = value
+        return stats
+
+    # queryid -> (query text, dict of numeric columns)
+    def pgss_snapshot(self):
+        if not self.has_pgss:
+            return {}
+        res = {}
+        with self.conn.cursor() as curs:
+            curs.execute("select * from pg_stat_statements where dbid = "
+                         "(select oid from pg_database where datname = current_database())")
+            cols = [d[0] for d in curs.description]
+            for row in curs.fetchall():
+                row = dict(zip(cols, row))
+                nums = {c: float(v) for c, v in row.items()
+                        if isinstance(v, (int, float, decimal.Decimal))
+                        and not isinstance(v, bool)
+                        and c not in ("userid", "dbid", "queryid")}
+                res[row["queryid"]] = (row["query"], nums)
+        return res
+
+    def run(self):
+        if self.conn.server_version >= 130000:
+            sql = """select pid = %s, state, wait_event_type, wait_event
+            from pg_stat_activity where pid = %s or leader_pid = %s"""
+            params = (self.leader_pid, self.leader_pid, self.leader_pid)
+        else:
+            sql = """select pid = %s, state, wait_event_type, wait_event
+            from pg_stat_activity where pid = %s or backend_type = 'parallel worker'"""
+            params = (self.leader_pid, self.leader_pid)
+        try:
+            with self.conn.cursor() as curs:
+                while not self.stop_event.is_set():
+                    curs.execute(sql, params)
+                    for is_leader, state, wtype, wevent in curs.fetchall():
+                        if state != "active":
+                            continue
+                        key = ("leader" if is_leader else "worker",
+                               wtype if wtype is not None else "CPU",
+                               wevent if wevent is not None else "CPU")
+                        self.waits[key] = self.waits.get(key, 0) + 1
+                    self.stop_event.wait(self.interval)
+        except psycopg2.Error as e:
+            self.error = e
+
+    # Stop sampling; returns (dict of stats deltas, dict (role, wait event
+    # type, wait event) -> samples, list of pg_stat_statements deltas as
+    # (queryid, query, dict) for statements run meanwhile, except the
+    # sampler's own ones)
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        time.sleep(self.statdelay)
+        stats = delta(self.start_stats, self.snapshot())
+        hits = stats.get("db_blks_hit", 0)
+        reads = stats.get("db_blks_read", 0)
+        stats["db_hit_ratio"] = hits / (hits + reads) if hits + reads > 0 else 1.0
+        pgss = []
+        for queryid, (query, nums) in self.pgss_snapshot().items():
+            if "pg_stat" in query or "pg_extension" in query:
+                continue
+            start = self.start_pgss.get(queryid, (query, {}))[1]
+            d = delta(start, nums)
+            if d.get("calls", 0) > 0:
+                pgss.append((queryid, query, d))
+        self.conn.close()
+        return stats, self.waits, pgss
@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+
+# Query plans: capture with EXPLAIN (FORMAT JSON), optionally with ANALYZE and
+# BUFFERS, normalized fingerprints to tell whether two runs used the same plan,
+# and per-node time breakdown of analyzed plans, which can be diffed between
+# two builds.
+#
+# Fingerprint is a hash of the plan shape only: node types, join types and
+# strategies, relations and indexes, keys and join conditions, but not costs,
+# row estimates and conditions with constants, so queries generated with
+# different substitution parameters get the same fingerprint if their plans
+# have the same shape.
+
+import sys
+import json
+import hashlib
+import argparse
+
+# plan node fields describing the shape
+SHAPE_FIELDS = ["Node Type", "Strategy", "Partial Mode", "Parallel Aware",
+                "Join Type", "Relation Name", "Index Name", "Scan Direction",
+                "Parent Relationship", "Subplan Name", "Workers Planned",
+                "Hash Cond", "Merge Cond", "Sort Key", "Group Key"]
+
+
+# EXPLAIN main statement of the query; statements before it are executed
+# first (e.g. q15 creates a view) and everything is rolled back afterwards.
+# The statement is planned as a plain query, which is how runners time it, see
+# StandardRunner.execute_query; a cursor would get a different, never parallel
+# plan. Returns the plan as parsed json, i.e. list with one dict.
+def explain(conn, before, main, analyze=False):
+    opts = "analyze, buffers, format json" if analyze else "format json"
+    try:
+        with conn.cursor() as curs:
+            for stmt in before:
+                curs.execute(stmt)
+            curs.execute("explain ({0}) {1}".format(opts, main))
+            plan = curs.fetchone()[0]
+    finally:
+        conn.rollback()
+    # psycopg2 parses json, but not if the server returned it as text
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan
+
+
+def shape(node):
+    res = {f: node[f] for f in SHAPE_FIELDS if f in node}
+    res["Plans"] = [shape(child) for child in node.get("Plans", [])]
+    return res
+
+
+def fingerprint(plan):
+    canonical = json.dumps(shape(plan[0]["Plan"]), sort_keys=True)
+    return hashlib.sha1(canonical.encode()).hexdigest()[:16]
+
+
+# Fingerprint of a run of the query with several variants of substitution
+# parameters, fps being fingerprints of their plans in variant order: the
+# common one if all plans have the same shape, all of them joined by ','
+# otherwise
+def combine_fingerprints(fps):
+    if len(set(fps)) == 1:
+        return fps[0]
+    return ','.join(fps)
+
+
+def node_label(node):
+    label = node["Node Type"]
+    if "Join Type" in node and "Join" in label:
+        label = "{0} {1}".format(node["Join Type"], label)
+    if "Relation Name" in node:
+        label += " on {}".format(node["Relation Name"])
+    if "Index Name" in node:
+        label += " using {}".format(node["Index Name"])
+    return label
+
+
+# Flatten analyzed plan into list of (path, label, total ms, exclusive ms,
+# shared buffers hit, read). Path is position in the tree, e.g. 0.1.0 is the
+# first child of the second child of the root. Times are Actual Total Time
+# times loops, so for nodes run by parallel workers they are summed over the
+# processes; exclusive time is total minus totals of the children.
+def node_times(plan):
+    rows = []
+
+    def walk(node, path):
+        total = node.get("Actual Total Time", 0) * node.get("Actual Loops", 1)
+        children = node.get("Plans", [])
+        children_total = sum(c.get("Actual Total Time", 0) * c.get("Actual Loops", 1)
+                             for c in children)
+        rows.append((path, node_label(node), total, max(0.0, total - children_total),
+                     node.get("Shared Hit Blocks", 0), node.get("Shared Read Blocks", 0)))
+        for i, child in enumerate(children):
+            walk(child, "{0}.{1}".format(path, i))
+
+    walk(plan[0]["Plan"], "0")
+    return rows
+
+
+# Per-node diff of two analyzed plans, returns list of (path, ref label, test
+# label, ref exclusive ms, test exclusive ms). Nodes are matched by their
+# path, which is meaningful only if the plans have the same shape; unmatched
+# ones get None.
+def diff_nodes(ref_plan, test_plan):
+    ref = {r[0]: r for r in node_times(ref_plan)}
+    test = {r[0]: r for r in node_times(test_plan)}
+    res = []
+    for path in sorted(set(ref) | set(test), key=lambda p: [int(x) for x in p.split('.')]):
+        r, t = ref.get(path), test.get(path)
+        res.append((path, r[1] if r else None, t[1] if t else None,
+                    r[3] if r else None, t[3] if t else None))
+    return res
+
+
+def load_plan(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""
+    Print fingerprints of plans saved by run_single.py (plan.json) and, for
+    analyzed plans (plan-analyze.json), per-node exclusive time of the
+    reference and the test.
+    """)
+    parser.add_argument("ref", help="plan of the reference build")
+    parser.add_argument("test", help="plan of the test build")
+    args = parser.parse_args()
+
+    ref_plan, test_plan = load_plan(args.ref), load_plan(args.test)
+    ref_fp, test_fp = fingerprint(ref_plan), fingerprint(test_plan)
+    print("ref plan {0}, test plan {1}{2}".format(
+        ref_fp, test_fp, "" if ref_fp == test_fp else ", PLANS DIFFER"))
+    if "Actual Total Time" not in ref_plan[0]["Plan"] or \
+       "Actual Total Time" not in test_plan[0]["Plan"]:
+        sys.exit(0)
+    print("path\tref node\ttest node\tref ms\ttest ms\tdelta ms")
+    for path, r_label, t_label, r_ms, t_ms in diff_nodes(ref_plan, test_plan):
+        delta = "{:.3f}".format(t_ms - r_ms) if r_ms is not None and t_ms is not None else ''
+        print("{0}\t{1}\t{2}\t{3}\t{4}\t{5}".format(
+            path, r_label or '', t_label if t_label != r_label else '=',
+            '' if r_ms is None else "{:.3f}".format(r_ms),
+            '' if t_ms is None else "{:.3f}".format(t_ms), delta))
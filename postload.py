@@ -0,0 +1,339 @@
+#!/usr/bin/python3
+
+# Post-load phase of prepare.sh: primary and foreign keys from dss.ri,
+# indexes, vacuum freeze and analyze, shaped by the physical layout, see
+# layout.py. Invoked from prepare.sh, but can be run by hand as well, see
+# --help.
+#
+# Every statement is a step with dependencies and a set of tables it locks.
+# Steps are run in parallel, each on its own connection, as soon as their
+# dependencies are done and they don't conflict on locks with the running
+# ones: CREATE INDEX statements on the same table can run together, ALTER
+# TABLE and VACUUM need the table for themselves. Foreign keys wait for the
+# primary key they reference, and each table is vacuumed and analyzed right
+# after the last step touching it. In clustered and brin layouts lineitem and
+# orders are first rewritten in date order, and everything else on them waits
+# for it.
+#
+# Proper libpq.so must be in runtime linker search path when you invoke this
+# script, as with run_single.py.
+
+import os
+import re
+import sys
+import time
+import getpass
+import argparse
+import datetime
+import concurrent.futures
+
+import psycopg2
+
+import layout as layouts
+
+# Pg does not create indexes on foreign keys, so the first ones are created
+# manually; the rest are just useful for TPC-H queries.
+INDEXES = [
+    ("i_n_regionkey", "nation", "n_regionkey"),  # unused on 1GB
+    ("i_s_nationkey", "supplier", "s_nationkey"),
+    ("i_c_nationkey", "customer", "c_nationkey"),
+    ("i_ps_suppkey", "partsupp", "ps_suppkey"),
+    ("i_ps_partkey", "partsupp", "ps_partkey"),
+    ("i_o_custkey", "orders", "o_custkey"),
+    ("i_l_orderkey", "lineitem", "l_orderkey"),
+    ("i_l_suppkey_partkey", "lineitem", "l_partkey, l_suppkey"),
+    # other indexes
+    ("i_l_shipdate", "lineitem", "l_shipdate"),
+    ("i_l_partkey", "lineitem", "l_partkey"),
+    ("i_l_suppkey", "lineitem", "l_suppkey"),
+    ("i_l_receiptdate", "lineitem", "l_receiptdate"),
+    ("i_l_orderkey_quantity", "lineitem", "l_orderkey, l_quantity"),
+    ("i_o_orderdate", "orders", "o_orderdate"),
+    ("i_l_commitdate", "lineitem", "l_commitdate"),  # unused on 1GB
+]
+
+PK_RE = re.compile(r'ALTER\s+TABLE\s+(\w+)\s+ADD\s+PRIMARY\s+KEY\s*\(([^)]*)\)',
+                   re.IGNORECASE)
+FK_RE = re.compile(r'ALTER\s+TABLE\s+(\w+)\s+ADD\s+FOREIGN\s+KEY\s*\(([^)]*)\)'
+                   r'\s+references\s+(\w+)', re.IGNORECASE)
+
+# lock modes of steps, only their compatibility matters for us
+SHARE = "share"
+EXCLUSIVE = "exclusive"
+
+
+class PostloadError(Exception):
+    pass
+
+
+class Step(object):
+    # kind is one of 'sort', 'pk', 'fk', 'index', 'vacuum'; locks is dict
+    # table -> SHARE or EXCLUSIVE; deps is list of names of steps which must be
+    # finished before this one starts
+    def __init__(self, name, kind, sql, locks, deps=None):
+        self.name = name
+        self.kind = kind
+        self.sql = sql
+        self.locks = locks
+        self.deps = deps if deps is not None else []
+        self.priority = 0
+        self.start = None
+        self.end = None
+
+    def elapsed(self):
+        return self.end - self.start
+
+
+# Convert Postgres memory setting like '8GB' or '512MB' to kB
+def parse_mem_kb(value):
+    units = {"kb": 1, "mb": 1024, "gb": 1024 ** 2, "tb": 1024 ** 3}
+    match = re.match(r'^\s*(\d+)\s*([kKmMgGtT][bB])?\s*$', value)
+    if match is None:
+        raise PostloadError("can't parse memory size {}".format(value))
+    unit = match.group(2).lower() if match.group(2) else "kb"
+    return int(match.group(1)) * units[unit]
+
+
+def log(msg):
+    print('{0:%Y-%m-%d %H:%M:%S} '.format(datetime.datetime.now()) + msg)
+    sys.stdout.flush()
+
+
+# Parse primary and foreign keys from dss.ri, returns list of steps. Primary
+# keys of tables partitioned in layout become plain indexes, and foreign keys
+# referencing them are skipped, see layout.py.
+def ri_steps(ri_path, layout="heap"):
+    partitioned = layouts.partitioned_tables(layout)
+    with open(ri_path) as f:
+        # drop the comments, statements are separated by ';'
+        text = '\n'.join(line for line in f.read().splitlines()
+                         if not line.strip().startswith('--'))
+    steps = []
+    for stmt in text.split(';'):
+        stmt = ' '.join(stmt.split())
+        pk = PK_RE.search(stmt)
+        fk = FK_RE.search(stmt)
+        if pk is not None:
+            table = pk.group(1).lower()
+            if table in partitioned:
+                stmt = "CREATE INDEX i_{0}_pkey ON {0} ({1})".format(
+                    table, ', '.join(c.strip().lower() for c in pk.group(2).split(',')))
+            steps.append(Step("pk_{}".format(table), "pk", stmt,
+                              {table: EXCLUSIVE}))
+        elif fk is not None:
+            table, ref = fk.group(1).lower(), fk.group(3).lower()
+            if ref in partitioned:
+                log("Skipping foreign key of {0} referencing partitioned {1}".format(table, ref))
+                continue
+            cols = '_'.join(c.strip().lower() for c in fk.group(2).split(','))
+            steps.append(Step("fk_{0}_{1}".format(table, cols), "fk", stmt,
+                              {table: EXCLUSIVE, ref: EXCLUSIVE},
+                              ["pk_{}".format(ref)]))
+    return steps
+
+
+def index_steps(layout="heap"):
+    return [Step(name, "index",
+                 "CREATE INDEX {0} ON {1} USING {2} ({3})".format(
+                     name, table, layouts.index_method(layout, name), cols),
+                 {table: SHARE})
+            for name, table, cols in INDEXES]
+
+
+# rewrite tables in date order before all other steps touching them, which
+# are made to wait for it
+def sort_steps(steps, layout):
+    res = []
+    for table in sorted(layouts.sorted_tables(layout)):
+        sort = Step("sort_{}".format(table), "sort", layouts.sort_sql(table),
+                    {table: EXCLUSIVE})
+        for step in steps:
+            if table in step.locks:
+                step.deps.append(sort.name)
+        res.append(sort)
+    return res
+
+
+# vacuum freeze analyze each table after all other steps touching it
+def vacuum_steps(steps):
+    tables = sorted({table for step in steps for table in step.locks})
+    return [Step("vacuum_{}".format(table), "vacuum",
+                 "VACUUM (FREEZE, ANALYZE) {}".format(table),
+                 {table: EXCLUSIVE},
+                 [step.name for step in steps if table in step.locks])
+            for table in tables]
+
+
+class Scheduler(object):
+    # mem_kb is maintenance_work_mem budget for all running steps together, or
+    # None to leave the server setting as is
+    def __init__(self, dsn, steps, jobs, mem_kb):
+        self.dsn = dsn
+        self.steps = steps
+        self.jobs = jobs
+        self.mem_kb = mem_kb
+        # table -> [number of SHARE holders, EXCLUSIVE held]
+        self.held = {}
+        self.server_version = None
+
+    # per-statement settings, so that all running steps together fit into the
+    # memory budget and the cores
+    def step_settings(self):
+        settings = []
+        if self.mem_kb is not None:
+            settings.append(("maintenance_work_mem",
+                             "{}kB".format(max(1024, self.mem_kb // self.jobs))))
+        # parallel index build appeared in 11
+        if self.server_version >= 110000:
+            workers = max(0, os.cpu_count() // self.jobs - 1)
+            settings.append(("max_parallel_maintenance_workers", str(workers)))
+        return settings
+
+    def can_lock(self, step):
+        for table, mode in step.locks.items():
+            shares, exclusive = self.held.get(table, [0, False])
+            if exclusive or (mode == EXCLUSIVE and shares > 0):
+                return False
+        return True
+
+    def lock(self, step, delta):
+        for table, mode in step.locks.items():
+            held = self.held.setdefault(table, [0, False])
+            if mode == SHARE:
+                held[0] += delta
+            else:
+                held[1] = delta > 0
+
+    # bigger tables first, they take the longest
+    def set_priorities(self):
+        tables = sorted({table for step in self.steps for table in step.locks})
+        conn = psycopg2.connect(self.dsn)
+        try:
+            self.server_version = conn.server_version
+            with conn.cursor() as curs:
+                # partitioned tables are empty, their partitions count
+                curs.execute("select c.relname::text, pg_relation_size(c.oid) + "
+                             "coalesce(sum(pg_relation_size(i.inhrelid)), 0) "
+                             "from pg_class c left join pg_inherits i on i.inhparent = c.oid "
+                             "where c.relname = any(%s) group by c.oid, c.relname", (tables,))
+                sizes = dict(curs.fetchall())
+        finally:
+            conn.close()
+        for step in self.steps:
+            step.priority = max(sizes.get(table, 0) for table in step.locks)
+
+    # runs in the pool
+    def run_step(self, step):
+        conn = psycopg2.connect(self.dsn)
+        try:
+            # VACUUM can't run inside a transaction block
+            conn.autocommit = True
+            with conn.cursor() as curs:
+                for name, value in self.step_settings():
+                    curs.execute("SET {0} = %s".format(name), (value,))
+                log("Starting {0}: {1}".format(step.name, step.sql))
+                step.start = time.time()
+                curs.execute(step.sql)
+                step.end = time.time()
+            log("Finished {0} in {1:.1f} s".format(step.name, step.elapsed()))
+        finally:
+            conn.close()
+
+    def run(self):
+        self.set_priorities()
+        pending = sorted(self.steps, key=lambda s: s.priority, reverse=True)
+        done = set()
+        running = {}
+        log("Running {0} steps with {1} jobs, settings per step: {2}".format(
+            len(pending), self.jobs,
+            ', '.join("{0} = {1}".format(*s) for s in self.step_settings())))
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+            while pending or running:
+                for step in list(pending):
+                    if len(running) >= self.jobs:
+                        break
+                    if all(d in done for d in step.deps) and self.can_lock(step):
+                        self.lock(step, 1)
+                        pending.remove(step)
+                        running[pool.submit(self.run_step, step)] = step
+                if not running:
+                    raise PostloadError("unsatisfiable dependencies: {}".format(
+                        ', '.join(s.name for s in pending)))
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    self.lock(step, -1)
+                    # propagate the error, if any
+                    future.result()
+                    done.add(step.name)
+
+    # Print how long each step and each kind of steps took
+    def report(self, wall):
+        print("\nPost-load timing breakdown:")
+        by_kind = {}
+        for step in sorted(self.steps, key=lambda s: s.start):
+            by_kind[step.kind] = by_kind.get(step.kind, 0) + step.elapsed()
+            print("{0:>10.1f} s  {1}".format(step.elapsed(), step.name))
+        for kind, elapsed in sorted(by_kind.items()):
+            print("{0:>10.1f} s  all {1} steps".format(elapsed, kind))
+        print("{0:>10.1f} s  wall clock".format(wall))
+
+
+def postload(dsn, ri_path, indexes, jobs, mem_kb, layout="heap"):
+    layouts.check(layout)
+    steps = ri_steps(ri_path, layout)
+    if indexes:
+        steps.extend(index_steps(layout))
+    steps.extend(sort_steps(steps, layout))
+    steps.extend(vacuum_steps(steps))
+    scheduler = Scheduler(dsn, steps, jobs, mem_kb)
+    start = time.time()
+    scheduler.run()
+    conn = psycopg2.connect(dsn)
+    try:
+        conn.autocommit = True
+        with conn.cursor() as curs:
+            # runners record it with each run
+            curs.execute(layouts.comment_sql(layout))
+            # Checkpoint, so we have a "clean slate". Just in-case.
+            curs.execute("checkpoint")
+    finally:
+        conn.close()
+    scheduler.report(time.time() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""
+    Add primary and foreign keys from dss.ri, create indexes, vacuum freeze and
+    analyze the TPC-H tables, running independent steps in parallel.
+    """)
+    parser.add_argument("-r", "--ri", required=True,
+                        help="dss.ri file with primary and foreign keys")
+    parser.add_argument("-p", "--port", required=True, help="Postgres port")
+    parser.add_argument("-n", "--dbname", required=True,
+                        help="database with TPC-H tables")
+    parser.add_argument("-H", "--host", default="/tmp",
+                        help="host or socket directory, /tmp by default")
+    parser.add_argument("-U", "--user", default=getpass.getuser(),
+                        help="user to connect as, `whoami` by default")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="number of steps run at the same time, 4 by default")
+    parser.add_argument("-m", "--maintmem",
+                        help="""maintenance_work_mem budget shared by all running
+                        steps, e.g. 16GB; by default each step uses the server
+                        setting""")
+    parser.add_argument("-x", "--no-indexes", action="store_true",
+                        help="don't create indexes")
+    parser.add_argument("-L", "--layout", default="heap", choices=layouts.LAYOUTS,
+                        help="""physical layout of lineitem and orders, see
+                        layout.py; heap by default""")
+    args = parser.parse_args()
+
+    if args.jobs < 1:
+        print("jobs must be positive")
+        sys.exit(1)
+    mem_kb = parse_mem_kb(args.maintmem) if args.maintmem else None
+    dsn = "host={0} port={1} user={2} dbname={3}".format(
+        args.host, args.port, args.user, args.dbname)
+    postload(dsn, args.ri, not args.no_indexes, args.jobs, mem_kb, args.layout)
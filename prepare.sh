@@ -3,7 +3,8 @@
 show_help() {
     cat <<EOF
     Usage: bash ${0##*/} [-s scale] [-i pginstdir] [-d pgdatadir] [-t tpchtmp]
-    [-p pgport] [-n tpchdbname] [-g dbgenpath] [-e] [-x] [-h] [-a] [-q]
+    [-p pgport] [-n tpchdbname] [-g dbgenpath] [-j loadjobs] [-e] [-x] [-h]
+    [-a] [-q] [-V] [-U nsets] [-L layout]
 
     Prepare Postgres cluster for running TPC-H queries:
       * Remove everything inside <pgdatadir>
@@ -11,25 +12,38 @@ show_help() {
       * Add configuration from postgresql.conf to default configuration at
         <pgdatadir>/postgresql.conf, if the former exists
       * Run the cluster on port <pgport>
-      * Generate *.tbl files with TPC-H data, if needed
-      * Create database with TPC-H tables named <tpchdbname>
-      * Fill these tables with generated (or existing) data
-      * Remove generated data, if needed
-      * Create indexes, if needed
-      * Reset Postgres state (vacuum-analyze-checkpoint)
+      * Create database with TPC-H tables named <tpchdbname>, partitioned
+        if the layout says so
+      * Fill these tables with data generated by dbgen on the fly, see
+        load.py, or with existing *.tbl files from <tpchtmp>
+      * Remove existing *.tbl files, if needed
+      * Rewrite big tables in date order, if the layout says so, add primary
+        and foreign keys and create indexes, if needed, and reset Postgres
+        state (vacuum-analyze-checkpoint); independent steps run in
+        parallel, see postload.py
       * Generate the TPC-H queries, if needed, and put them
         to <pgdatadir>/queries
+      * Generate update sets for the refresh functions, if needed, and put
+        them to <pgdatadir>/updates
 
     Options
-    The first seven options are read from $CONFIGFILE file, but you can override
+    The first eight options are read from $CONFIGFILE file, but you can override
     them in command line args. See their meaning in that file. The rest are:
 
-    -e don't generate *.tbl files, use the existing ones
-    -r don't remove generated files after use, they are removed by default
+    -e don't generate data, load the existing *.tbl files from <tpchtmp>
+    -r don't remove *.tbl files after use, they are removed by default
     -x don't create indexes, they are created by default
     -a disable sanity checks: using Postgres built with assertions and
        wal_level_minimal
     -q don't generate queries, they are generated by default
+    -V generate queries with the default substitution parameters (qgen -d),
+       for which dbgen has reference answers, see answers.py; by default
+       the parameters are random
+    -U generate nsets update sets for the refresh functions RF1 and RF2, see
+       refresh.py; each refresh pair consumes one set. Read from refreshsets
+       option, none by default
+    -L physical layout of lineitem and orders: heap, partitioned, clustered
+       or brin, see layout.py. Read from layout option, heap by default
     -h display this help and exit
 
     Example:
@@ -45,8 +59,9 @@ REMOVEGENDATA=true
 CREATEINDEXES=true
 SANITYCHECKS=true
 GENQUERIES=true
+QGENOPTS=""
 OPTIND=1
-while getopts "s:i:d:t:p:n:g:erxaqh" opt; do
+while getopts "s:i:d:t:p:n:g:j:erxaqVU:L:h" opt; do
     case $opt in
 	h)
 	    show_help
@@ -73,6 +88,9 @@ while getopts "s:i:d:t:p:n:g:erxaqh" opt; do
 	g)
 	    DBGENPATH="$OPTARG"
 	    ;;
+	j)
+	    LOADJOBS="$OPTARG"
+	    ;;
 	e)
 	    GENDATA=false
 	    ;;
@@ -88,6 +106,15 @@ while getopts "s:i:d:t:p:n:g:erxaqh" opt; do
 	q)
 	    GENQUERIES=false
 	    ;;
+	V)
+	    QGENOPTS="-d"
+	    ;;
+	U)
+	    REFRESHSETS="$OPTARG"
+	    ;;
+	L)
+	    LAYOUT="$OPTARG"
+	    ;;
 	\?)
 	    show_help >&2
 	    exit 1
@@ -98,12 +125,17 @@ done
 if [ -z "$SCALE" ]; then die "scale is empty"; fi
 if [ -z "$PGINSTDIR" ]; then die "pginstdir is empty"; fi
 if [ -z "$PGDATADIR" ]; then die "pgdatadir is empty"; fi
-if [ -z "$TPCHTMP" ]; then die "tpchtmp is empty"; fi
+if [ "$GENDATA" = false ] && [ -z "$TPCHTMP" ]; then die "tpchtmp is empty"; fi
 if [ -z "$PGPORT" ]; then die "pgport is empty"; fi
 if [ -z "$TPCHDBNAME" ]; then die "tpchdbname is empty"; fi
 # We need dbgenpath even if we don't generate *.tbl files because we always
 # generate queries
 if [ -z "$DBGENPATH" ]; then die "dbgenpath is empty"; fi
+if [ -z "$LAYOUT" ]; then LAYOUT=heap; fi
+case "$LAYOUT" in
+    heap|partitioned|clustered|brin) ;;
+    *) die "unknown layout $LAYOUT" ;;
+esac
 
 # directory with this script
 BASEDIR=`dirname "$(readlink -f "$0")"`
@@ -117,6 +149,7 @@ echo "Using Postgres at $PGINSTDIR"
 echo "Using datadir at $PGDATADIR"
 echo "Scale is $SCALE"
 echo "Using dbgen at $DBGENABSPATH"
+echo "Layout is $LAYOUT"
 
 # ========================== Preparing DB =========================
 # Current time
@@ -159,30 +192,6 @@ if [ "$SANITYCHECKS" = true ]; then
     if [ $DEBUG_ASSERTIONS = 1 ] ; then die "Option debug_assertions is enabled"; fi
 fi
 
-# generate *.tbl files, if needed
-if [ "$GENDATA" = true ]; then
-    make -j # build dbgen
-    if ! [ -x "$DBGENABSPATH/dbgen" ] || ! [ -x "$DBGENABSPATH/qgen" ]; then
-	die "Can't find dbgen or qgen.";
-    fi
-    mkdir -p "$TPCHTMP" || die "Failed to create temporary directory: '$TPCHTMP'"
-    cd "$TPCHTMP"
-    # needed by ./dbgen
-    cp "$DBGENABSPATH/dists.dss" . || die "dists.dss not found"
-    cp "$DBGENABSPATH/dss.ddl" . || die "dss.ddl not found" # table definitions
-    # foreign & primary keys
-    cp "$DBGENABSPATH/dss.ri" . || die "dss.ri not found"
-
-    # Create table files separately to have better IO throughput
-    # -v is verbose, -f for overwrtiting existing files, -T <letter> is
-    # "generate only table <letter>"
-    for TABLENAME in c s n r O L P s S; do
-	"$DBGENABSPATH/dbgen" -s $SCALE -f -T $TABLENAME &
-    done
-    wait_jobs
-    echo "TPC-H data *.tbl files generated at $TPCHTMP"
-fi
-
 LD_LIBRARY_PATH="$LD_LIBRARY_PATH":"$PGLIBDIR" $PGBINDIR/createdb -h /tmp \
 	       -p $PGPORT $TPCHDBNAME --encoding=UTF-8 --locale=C
 if [ $? != 0 ]; then die "Error: Can't proceed without database"; fi
@@ -193,78 +202,66 @@ $TPCHDBNAME is 'TPC-H data, created at $TIME'"
 echo "TPC-H database created"
 
 LD_LIBRARY_PATH="$LD_LIBRARY_PATH":"$PGLIBDIR" $PGBINDIR/psql -h /tmp -p $PGPORT \
-	       -d $TPCHDBNAME < "$TPCHTMP/dss.ddl"
+	       -d $TPCHDBNAME < "$DBGENABSPATH/dss.ddl"
+if [ "$LAYOUT" = partitioned ]; then
+    "$BASEDIR/layout.py" $LAYOUT |
+	LD_LIBRARY_PATH="$LD_LIBRARY_PATH":"$PGLIBDIR" $PGBINDIR/psql -h /tmp -p $PGPORT \
+		       -d $TPCHDBNAME -v ON_ERROR_STOP=1
+fi
 echo "TPCH-H tables created"
 
-cd "$TPCHTMP"
-TBLFILESNUM=`find . -maxdepth 1 -type f -name '*.tbl' | wc -l`
-if [ "$TBLFILESNUM" -eq "0" ]; then
-    die "No *.tbl files found"
+if [ "$GENDATA" = true ]; then
+    make -j # build dbgen
+    if ! [ -x "$DBGENABSPATH/dbgen" ] || ! [ -x "$DBGENABSPATH/qgen" ]; then
+	die "Can't find dbgen or qgen.";
+    fi
+    # Generate the data in chunks and pipe it directly to COPY, no *.tbl files
+    # are written
+    LOADOPTS=""
+    if [ -n "$LOADJOBS" ]; then LOADOPTS="-j $LOADJOBS"; fi
+    LD_LIBRARY_PATH="$LD_LIBRARY_PATH":"$PGLIBDIR" "$BASEDIR/load.py" \
+		   -s $SCALE -g "$DBGENABSPATH" -p $PGPORT -n $TPCHDBNAME $LOADOPTS
+else
+    cd "$TPCHTMP" || die "tpchtmp directory not found"
+    TBLFILESNUM=`find . -maxdepth 1 -type f -name '*.tbl' | wc -l`
+    if [ "$TBLFILESNUM" -eq "0" ]; then
+	die "No *.tbl files found"
+    fi
+    for f in *.tbl; do
+	# bf is f without .tbl extensions. Since unquoted names are case insensitive
+	# in Postgres, bf is basically a table name.
+	bf="$(basename $f .tbl)"
+	# We truncate the empty table in the sames transaction to enable Postgres to
+	# safely skip WAL-logging. See
+	# http://www.postgresql.org/docs/current/static/populate.html#POPULATE-PITR
+	echo "truncate $bf;
+	      COPY $bf FROM '$(pwd)/$f' WITH DELIMITER AS '|'" |
+	    LD_LIBRARY_PATH="$LD_LIBRARY_PATH":"$PGLIBDIR" $PGBINDIR/psql -h /tmp \
+			   -p $PGPORT -d $TPCHDBNAME &
+    done
+    wait_jobs
+    if [ "$REMOVEGENDATA" = true ]; then
+	cd && rm -rf "$TPCHTMP"
+	echo "tpch tmp directory removed"
+    fi
 fi
-for f in *.tbl; do
-    # bf is f without .tbl extensions. Since unquoted names are case insensitive
-    # in Postgres, bf is basically a table name.
-    bf="$(basename $f .tbl)"
-    # We truncate the empty table in the sames transaction to enable Postgres to
-    # safely skip WAL-logging. See
-    # http://www.postgresql.org/docs/current/static/populate.html#POPULATE-PITR
-    echo "truncate $bf;
-    	  COPY $bf FROM '$(pwd)/$f' WITH DELIMITER AS '|'" |
-	LD_LIBRARY_PATH="$LD_LIBRARY_PATH":"$PGLIBDIR" $PGBINDIR/psql -h /tmp \
-		       -p $PGPORT -d $TPCHDBNAME &
-done
-wait_jobs
 echo "TPC-H tables are populated with data"
 
-LD_LIBRARY_PATH="$LD_LIBRARY_PATH":"$PGLIBDIR" $PGBINDIR/psql -h /tmp -p $PGPORT \
-	       -d $TPCHDBNAME < "dss.ri"
-echo "primary and foreign keys added"
-
-if [ "$REMOVEGENDATA" = true ]; then
-    cd && rm -rf "$TPCHTMP"
-    echo "tpch tmp directory removed"
-fi
-
+# Keys, indexes, vacuum freeze and analyze, run in parallel where possible.
+# Always analyze after bulk-loading; when hacking Postgres, typically Postgres
+# is run with autovacuum turned off.
+POSTLOADOPTS=""
+if [ -n "$POSTLOADJOBS" ]; then POSTLOADOPTS="$POSTLOADOPTS -j $POSTLOADJOBS"; fi
+if [ -n "$MAINTMEM" ]; then POSTLOADOPTS="$POSTLOADOPTS -m $MAINTMEM"; fi
+POSTLOADOPTS="$POSTLOADOPTS -L $LAYOUT"
 if [ "$CREATEINDEXES" = true ]; then
-    declare -a INDEXCMDS=(
-	# Pg does not create indexed on foreign keys, create them manually
-	"CREATE INDEX i_n_regionkey ON nation (n_regionkey);"	#& #unused on 1GB
-	"CREATE INDEX i_s_nationkey ON supplier (s_nationkey);"	#&
-	"CREATE INDEX i_c_nationkey ON customer (c_nationkey);"	#&
-	"CREATE INDEX i_ps_suppkey ON partsupp (ps_suppkey);"	#&
-	"CREATE INDEX i_ps_partkey ON partsupp (ps_partkey);"	#&
-	"CREATE INDEX i_o_custkey ON orders (o_custkey);"	#&
-	"CREATE INDEX i_l_orderkey ON lineitem (l_orderkey);"	#&
-	"CREATE INDEX i_l_suppkey_partkey ON lineitem (l_partkey, l_suppkey);"	#&
-        # other indexes
-	"CREATE INDEX i_l_shipdate ON lineitem (l_shipdate);"	#&
-	"CREATE INDEX i_l_partkey ON lineitem (l_partkey);"	#&
-	"CREATE INDEX i_l_suppkey ON lineitem (l_suppkey);"	#&
-	"CREATE INDEX i_l_receiptdate ON lineitem (l_receiptdate);"	#&
-	"CREATE INDEX i_l_orderkey_quantity ON lineitem (l_orderkey, l_quantity);"	#&
-	"CREATE INDEX i_o_orderdate ON orders (o_orderdate);"	#&
-	"CREATE INDEX i_l_commitdate ON lineitem (l_commitdate);"	#& #unused on 1GB
-    )
-    for cmd in "${INDEXCMDS[@]}"; do
-	LD_LIBRARY_PATH="$LD_LIBRARY_PATH":"$PGLIBDIR" $PGBINDIR/psql -h /tmp \
-		       -p $PGPORT -d $TPCHDBNAME -c "$cmd"
-    done
-    wait_jobs
-    echo "Indexes created"
+    echo "Keys and indexes will be created"
 else
+    POSTLOADOPTS="$POSTLOADOPTS -x"
     echo "Indexes will not be created"
 fi
-
-# Always analyze after bulk-loading; when hacking Postgres, typically Postgres
-# is run with autovacuum turned off.
-echo "Running vacuum freeze analyze checkpoint..."
-LD_LIBRARY_PATH="$LD_LIBRARY_PATH":"$PGLIBDIR" $PGBINDIR/psql -h /tmp -p $PGPORT \
-	       -d $TPCHDBNAME -c "vacuum freeze"
-LD_LIBRARY_PATH="$LD_LIBRARY_PATH":"$PGLIBDIR" $PGBINDIR/psql -h /tmp -p $PGPORT \
-	       -d $TPCHDBNAME -c "analyze"
-# Checkpoint, so we have a "clean slate". Just in-case.
-LD_LIBRARY_PATH="$LD_LIBRARY_PATH":"$PGLIBDIR" $PGBINDIR/psql -h /tmp -p $PGPORT \
-	       -d $TPCHDBNAME -c "checkpoint"
+LD_LIBRARY_PATH="$LD_LIBRARY_PATH":"$PGLIBDIR" "$BASEDIR/postload.py" \
+	       -r "$DBGENABSPATH/dss.ri" -p $PGPORT -n $TPCHDBNAME $POSTLOADOPTS
 
 postgres_stop 0
 
@@ -272,4 +269,8 @@ if [ "$GENQUERIES" = true ]; then
     gen_queries $PGDATADIR
 fi
 
+if [ -n "$REFRESHSETS" ] && [ "$REFRESHSETS" != 0 ]; then
+    gen_updates $PGDATADIR $REFRESHSETS
+fi
+
 printf 'Preparing elapsed time: %s\n' $(timer $CURRTIME)
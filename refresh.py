@@ -0,0 +1,83 @@
+# TPC-H refresh functions. Update sets are generated by dbgen -U <n> (see
+# prepare.sh -U) into <pgdatadir>/updates: set k consists of orders.tbl.u<k>
+# and lineitem.tbl.u<k> with new orders, and delete.<k> with keys of old ones.
+#   * RF1 loads new orders and their lineitems with COPY, in one transaction;
+#   * RF2 COPYs the keys to delete into a temp table and deletes lineitems and
+#     orders with them by two set-based DELETEs, in one transaction.
+# Each function is timed including commit, so WAL flush, index maintenance
+# and FK checks are all counted.
+#
+# Applying the same set twice fails on the primary keys, so each refresh
+# pair needs its own set, unless the cluster is reset meanwhile; see
+# RefreshSets.
+
+import os
+import time
+
+
+class RefreshError(Exception):
+    pass
+
+
+# Update sets in updates_dir, handed out one after another starting from
+# first
+class RefreshSets(object):
+    def __init__(self, updates_dir, first=1):
+        self.updates_dir = updates_dir
+        self.first = first
+        self.next_set = first
+
+    def paths(self, num):
+        return (os.path.join(self.updates_dir, "orders.tbl.u{}".format(num)),
+                os.path.join(self.updates_dir, "lineitem.tbl.u{}".format(num)),
+                os.path.join(self.updates_dir, "delete.{}".format(num)))
+
+    def available(self, num):
+        return all(os.path.isfile(p) for p in self.paths(num))
+
+    # Returns number of the next unused set; raises RefreshError if it
+    # wasn't generated
+    def take(self):
+        num = self.next_set
+        if not self.available(num):
+            raise RefreshError("update set {0} not found in {1}, generate more sets "
+                               "with prepare.sh -U".format(num, self.updates_dir))
+        self.next_set += 1
+        return num
+
+    # The cluster was reset to the pristine state, sets can be reused
+    def reset(self):
+        self.next_set = self.first
+
+
+def copy_from(curs, table, path):
+    with open(path) as f:
+        curs.copy_expert("COPY {} FROM STDIN WITH DELIMITER AS '|'".format(table), f)
+    return curs.rowcount
+
+
+# Run RF1 with update set num; returns (secs, rows inserted)
+def rf1(conn, sets, num):
+    orders, lineitem, delete = sets.paths(num)
+    start = time.perf_counter()
+    with conn.cursor() as curs:
+        rows = copy_from(curs, "orders", orders)
+        rows += copy_from(curs, "lineitem", lineitem)
+    conn.commit()
+    return time.perf_counter() - start, rows
+
+
+# Run RF2 with update set num; returns (secs, rows deleted)
+def rf2(conn, sets, num):
+    orders, lineitem, delete = sets.paths(num)
+    start = time.perf_counter()
+    with conn.cursor() as curs:
+        curs.execute("create temp table rf2_keys (orderkey integer) on commit drop")
+        copy_from(curs, "rf2_keys", delete)
+        curs.execute("delete from lineitem using rf2_keys where l_orderkey = orderkey")
+        rows = curs.rowcount
+        curs.execute("delete from orders using rf2_keys where o_orderkey = orderkey")
+        rows += curs.rowcount
+    conn.commit()
+    return time.perf_counter() - start, rows
+
@@ -0,0 +1,288 @@
+# Results store: SQLite database with every run of every query, its merged
+# config, environment metadata and samples, so results can be found by test
+# name, timestamp, scale or any config key without walking res/ directories.
+# Runners write to it as they go, see StandardRunner; aggregate.py reads it
+# and keeps per-run summaries up to date.
+#
+# Tables:
+#   * runs: one row per query run by a runner, i.e. per results directory;
+#     prefix is run.py start timestamp (resdir_prefix), conf and env are json,
+#     env includes the physical layout of the tables, see layout.py;
+#   * conf: the same config as key-value pairs, for indexed search;
+#   * samples: time of each run of the query in secs, with phases; kept is 0
+#     for discarded warmups, i.e. samples not in exectime.txt;
+#   * summaries: stats over kept samples of finished runs, computed by
+#     aggregate.py;
+#   * metrics: other numbers describing each run of the query, e.g. CPU
+#     seconds and bytes read from ossampler.py; 'timeout' is the limit the
+#     run was cancelled at, see querytimeout in pgtpch.conf.example;
+#   * plans: EXPLAIN (FORMAT JSON) of the query and its fingerprint, see
+#     plans.py; analyzed is 1 for EXPLAIN ANALYZE output.
+
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import subprocess
+import sqlite3
+
+import layout
+import plans
+
+SCHEMA = """
+create table if not exists runs (
+    id integer primary key,
+    prefix text,
+    testname text,
+    query text,
+    scale text,
+    runner text,
+    resdir text,
+    started real,
+    finished real,
+    stopreason text,
+    conf text,
+    env text
+);
+create index if not exists runs_test on runs (testname, query, scale);
+create index if not exists runs_prefix on runs (prefix);
+create index if not exists runs_resdir on runs (resdir);
+
+create table if not exists conf (
+    run_id integer references runs (id),
+    key text,
+    value text
+);
+create index if not exists conf_key on conf (key, value);
+
+create table if not exists samples (
+    run_id integer references runs (id),
+    runnum integer,
+    exectime real,
+    exec real,
+    fetch real,
+    kept integer default 1
+);
+create index if not exists samples_run on samples (run_id);
+
+create table if not exists metrics (
+    run_id integer references runs (id),
+    runnum integer,
+    name text,
+    value real
+);
+create index if not exists metrics_run on metrics (run_id, name);
+
+create table if not exists plans (
+    run_id integer references runs (id),
+    analyzed integer,
+    fingerprint text,
+    plan text
+);
+create index if not exists plans_run on plans (run_id);
+
+create table if not exists summaries (
+    run_id integer primary key references runs (id),
+    nsamples integer,
+    median real,
+    min real,
+    avg real,
+    ci_low real,
+    ci_high real
+);
+"""
+
+
+# Describe the machine, Postgres and physical layout of the TPC-H tables we
+# are running on. conn is psycopg2 connection, pg_bin is directory with
+# Postgres binaries.
+def env_metadata(conn, pg_bin):
+    env = {
+        "hostname": socket.gethostname(),
+        "kernel": platform.release(),
+        "platform": platform.platform(),
+        "python": sys.version.split()[0],
+        "cpus": os.cpu_count(),
+        "server_version": conn.server_version,
+        "layout": layout.detect(conn),
+    }
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    env["cpu"] = line.split(':', 1)[1].strip()
+                    break
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal"):
+                    env["memtotal"] = line.split(':', 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    pg_config = os.path.join(pg_bin, "pg_config")
+    if os.path.isfile(pg_config):
+        for opt in ("version", "configure"):
+            env["pg_config_" + opt] = subprocess.check_output(
+                [pg_config, "--" + opt], universal_newlines=True).strip()
+    return env
+
+
+class ResStore(object):
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # several run.py might write to the same store
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    # Register new run of query with results in resdir, returns its id
+    def add_run(self, conf, query, resdir, env):
+        with self.conn:
+            run_id = self.conn.execute(
+                "insert into runs (prefix, testname, query, scale, runner, resdir,"
+                " started, conf, env) values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (conf.get("resdir_prefix"), conf.get("testname"), query,
+                 str(conf.get("scale")), conf.get("runner"), resdir, time.time(),
+                 json.dumps(conf, sort_keys=True), json.dumps(env, sort_keys=True))
+            ).lastrowid
+            self.conn.executemany(
+                "insert into conf (run_id, key, value) values (?, ?, ?)",
+                [(run_id, key, str(value)) for key, value in conf.items()])
+        return run_id
+
+    # times are in secs
+    def add_sample(self, run_id, runnum, exectime, exec_time, fetch_time):
+        with self.conn:
+            self.conn.execute(
+                "insert into samples (run_id, runnum, exectime, exec, fetch)"
+                " values (?, ?, ?, ?, ?)",
+                (run_id, runnum, exectime, exec_time, fetch_time))
+
+    # metrics is dict name -> number
+    def add_metrics(self, run_id, runnum, metrics):
+        with self.conn:
+            self.conn.executemany(
+                "insert into metrics (run_id, runnum, name, value) values (?, ?, ?, ?)",
+                [(run_id, runnum, name, value) for name, value in metrics.items()])
+
+    # Returns dict runnum -> dict name -> value of the run's metrics
+    def metrics(self, run_id):
+        res = {}
+        for row in self.conn.execute(
+                "select runnum, name, value from metrics where run_id = ?", (run_id,)):
+            res.setdefault(row["runnum"], {})[row["name"]] = row["value"]
+        return res
+
+    # plan is parsed EXPLAIN (FORMAT JSON) output
+    def add_plan(self, run_id, fingerprint, plan, analyzed):
+        with self.conn:
+            self.conn.execute(
+                "insert into plans (run_id, analyzed, fingerprint, plan) values (?, ?, ?, ?)",
+                (run_id, int(analyzed), fingerprint, json.dumps(plan)))
+
+    # Fingerprint of the plan of the run, combined over the plans of all
+    # variants of the query, see plans.combine_fingerprints; fingerprint of
+    # the analyzed plan if only it was saved, or None if none was captured
+    def plan_fingerprint(self, run_id):
+        rows = self.conn.execute(
+            "select analyzed, fingerprint from plans where run_id = ? order by analyzed, rowid",
+            (run_id,)).fetchall()
+        if not rows:
+            return None
+        fps = [r[1] for r in rows if r[0] == rows[0][0]]
+        return plans.combine_fingerprints(fps) if rows[0][0] == 0 else fps[0]
+
+    # Time limit at which runs of the query were cancelled, None if they
+    # weren't
+    def timeout(self, run_id):
+        rows = self.conn.execute(
+            "select value from metrics where run_id = ? and name = 'timeout' limit 1",
+            (run_id,)).fetchall()
+        return rows[0][0] if rows else None
+
+    # Mark the run finished; first nwarmups samples are not kept
+    def finish_run(self, run_id, nwarmups, stopreason):
+        with self.conn:
+            self.conn.execute("update samples set kept = 0 where run_id = ? and runnum <= ?",
+                              (run_id, nwarmups))
+            self.conn.execute("update runs set finished = ?, stopreason = ? where id = ?",
+                              (time.time(), stopreason, run_id))
+
+    # Find runs; all arguments are optional filters. testname and query are
+    # LIKE patterns, prefix is matched by its beginning, so '2017-04' finds
+    # all runs started in April 2017, conf is dict key -> value. Returns list
+    # of rows of runs, latest last.
+    def find_runs(self, testname=None, query=None, scale=None, prefix=None,
+                  conf=None, finished=True):
+        where, params = [], []
+        if testname is not None:
+            where.append("testname like ?")
+            params.append(testname)
+        if query is not None:
+            where.append("query like ?")
+            params.append(query)
+        if scale is not None:
+            where.append("scale = ?")
+            params.append(str(scale))
+        if prefix is not None:
+            where.append("prefix like ?")
+            params.append(prefix + '%')
+        for key, value in (conf or {}).items():
+            where.append("id in (select run_id from conf where key = ? and value = ?)")
+            params.extend([key, str(value)])
+        if finished:
+            where.append("finished is not null")
+        sql = "select * from runs"
+        if where:
+            sql += " where " + " and ".join(where)
+        return self.conn.execute(sql + " order by started, id", params).fetchall()
+
+    # Returns exec times of the run; only kept ones unless all is true
+    def samples(self, run_id, all=False):
+        sql = "select exectime from samples where run_id = ?"
+        if not all:
+            sql += " and kept = 1"
+        return [r[0] for r in self.conn.execute(sql + " order by runnum", (run_id,))]
+
+    # Latest finished run with results in directory named resdir_name; the
+    # name is compared as is, not as LIKE pattern, as test names contain '_'
+    def run_by_resdir(self, resdir_name):
+        rows = self.conn.execute(
+            "select * from runs where finished is not null and"
+            " (resdir = ? or substr(resdir, -length(?)) = ?)"
+            " order by started desc, id desc limit 1",
+            (resdir_name, '/' + resdir_name, '/' + resdir_name)).fetchall()
+        return rows[0] if rows else None
+
+    # Compute summaries of finished runs which don't have one yet or got new
+    # samples since. summarize is function getting list of samples and
+    # returning (median, min, avg, ci_low, ci_high). Returns number of updated
+    # summaries.
+    def update_summaries(self, summarize):
+        stale = self.conn.execute("""
+        select r.id, count(s.run_id) as n from runs r
+        join samples s on s.run_id = r.id and s.kept = 1
+        left join summaries sm on sm.run_id = r.id
+        where r.finished is not null
+        group by r.id, sm.nsamples
+        having sm.nsamples is null or sm.nsamples != count(s.run_id)
+        """).fetchall()
+        with self.conn:
+            for row in stale:
+                stats = summarize(self.samples(row["id"]))
+                self.conn.execute(
+                    "insert or replace into summaries (run_id, nsamples, median, min,"
+                    " avg, ci_low, ci_high) values (?, ?, ?, ?, ?, ?, ?)",
+                    (row["id"], row["n"]) + tuple(stats))
+        return len(stale)
+
+    def summary(self, run_id):
+        rows = self.conn.execute("select * from summaries where run_id = ?",
+                                 (run_id,)).fetchall()
+        return rows[0] if rows else None
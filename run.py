@@ -1,18 +1,40 @@
 #!/usr/bin/python3
 
 import os
+import sys
+import time
+import random
+import queue
+import statistics
+import threading
 import subprocess
 import json
 import argparse
 import pprint
 import datetime
 
+from slices import make_slices, format_cpulist
+from sweep import run_sweep
+from campaign import Campaign
+
 # The only job of this script is for each conf:
 # * Dump this config to ./tmp_conf.json
 # * Set proper LD_LIBRARY_PATH, as different tests
 #   potentially can use different libpq versions, and psycopg2 depends on it.
 #   In future we should probably add automatic recompilation of psycopg2.
 # * Invoke run_single.py to do the rest.
+# Or, with --schedule query or run, start run_single.py of all configs at once
+# and interleave them, see Worker and interleave below. Or, with --slices,
+# run configs concurrently, each pinned to its own part of the machine, see
+# run_slices below and slices.py. All configs are recorded to a durable work
+# queue first, so that an interrupted campaign can be resumed, see
+# campaign.py.
+
+# prefix of run_single.py replies, see StandardRunner.serve there
+REPLY_PREFIX = "pgtpch-reply: "
+
+# options saved with the campaign and restored when it is resumed
+CAMPAIGN_OPTIONS = ["schedule", "order", "seed", "slices", "split_queries"]
 
 # parse default values in pgtpch.conf
 def parse_default_conf():
@@ -29,6 +51,273 @@ def parse_default_conf():
     return conf
 
 
+# Queries of merged conf, like PgtpchConf does
+def conf_queries(conf):
+    if conf["queries"] == "all":
+        return ["q{:02d}".format(q) for q in range(1, 23)]
+    return conf["queries"].split()
+
+
+# Interleaved configs run at the same time, so they must not share the port
+# and the working copy of pgdatadir. Returns list of problems.
+def check_interleavable(confs):
+    problems = []
+    ports, workdirs = {}, {}
+    for conf in confs:
+        if conf.get("runner") == "throughput":
+            problems.append("{}: throughput runner can't be interleaved".format(
+                conf["testname"]))
+        port = str(conf["pgport"])
+        if port in ports:
+            problems.append("{0} and {1} use the same pgport {2}".format(
+                ports[port], conf["testname"], port))
+        ports[port] = conf["testname"]
+        if conf.get("copydir") is not None and conf.get("restart") != "never":
+            # see Snapshot in snapshot.py; pgdatadir from the cluster cache is
+            # not known yet, so assume they all collide
+            if conf.get("clustercache") is not None:
+                workdir = os.path.join(conf["copydir"], "<clustercache>")
+            else:
+                workdir = os.path.join(conf["copydir"],
+                                       os.path.basename(os.path.normpath(conf["pgdatadir"])))
+            if workdir in workdirs:
+                problems.append("{0} and {1} use the same working copy {2}, set "
+                                "different copydir".format(workdirs[workdir],
+                                                           conf["testname"], workdir))
+            workdirs[workdir] = conf["testname"]
+    return problems
+
+
+# run_single.py --serve process of one config
+class Worker(object):
+    def __init__(self, conf, conf_path, script, env):
+        self.testname = conf["testname"]
+        self.queries = conf_queries(conf)
+        with open(conf_path, 'w') as f:
+            json.dump(conf, f)
+        self.proc = subprocess.Popen([script, "--conf", conf_path, "--serve"],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     universal_newlines=True, env=env)
+        self.alive = True
+
+    # Send command, if any, and wait for the reply, echoing everything else
+    # the worker prints. Returns the reply, or None if the worker is dead.
+    def call(self, cmd=None):
+        if not self.alive:
+            return None
+        try:
+            if cmd is not None:
+                self.proc.stdin.write(cmd + "\n")
+                self.proc.stdin.flush()
+            for line in self.proc.stdout:
+                if line.startswith(REPLY_PREFIX):
+                    return line[len(REPLY_PREFIX):].strip()
+                print("[{0}] {1}".format(self.testname, line), end='')
+        except BrokenPipeError:
+            pass
+        self.alive = False
+        print("WARN: run_single.py of {0} exited with code {1}".format(
+            self.testname, self.proc.wait()))
+        return None
+
+    def quit(self):
+        self.call("quit")
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+
+
+# Order of configs in block number i: random permutation, or forward and
+# backward alternately (ABBA: A B, B A, A B...)
+def block_order(workers, i, order, rng):
+    if order == "random":
+        return rng.sample(workers, len(workers))
+    return list(workers) if i % 2 == 0 else list(workers)[::-1]
+
+
+# Run the queries of all workers interleaved. With 'query' granularity, for
+# each query the configs run it completely one after another; with 'run', the
+# configs make one run of the query each in turns, until each of them has
+# done all its runs. Each step is logged to schedule file as (time, query,
+# test name, reply).
+def interleave(workers, granularity, order, rng, schedule_path):
+    queries = []
+    for w in workers:
+        queries.extend(q for q in w.queries if q not in queries)
+    block = 0
+    with open(schedule_path, 'w') as schedule:
+        schedule.write("time\tquery\ttestname\tcommand\treply\n")
+
+        def call(w, query, cmd):
+            reply = w.call(cmd)
+            schedule.write("{0:.3f}\t{1}\t{2}\t{3}\t{4}\n".format(
+                time.time(), query, w.testname, cmd.split()[0], reply))
+            schedule.flush()
+            return reply
+
+        for query in queries:
+            qworkers = [w for w in workers if query in w.queries and w.alive]
+            if granularity == "query":
+                for w in block_order(qworkers, block, order, rng):
+                    call(w, query, "query {}".format(query))
+                block += 1
+                continue
+            active = []
+            for w in block_order(qworkers, block, order, rng):
+                reply = call(w, query, "begin {}".format(query))
+                if reply == "ok":
+                    active.append(w)
+                elif reply is not None:
+                    print("{0}: {1}".format(w.testname, reply))
+            while active:
+                for w in block_order(active, block, order, rng):
+                    reply = call(w, query, "run")
+                    if reply is None or reply.startswith("done"):
+                        active.remove(w)
+                block += 1
+
+
+# True if the campaign time budget, see --budget, is used up
+def budget_used_up(conf):
+    deadline = float(conf.get("deadline", 0))
+    return deadline > 0 and time.time() >= deadline
+
+
+# Run merged conf with run_single.py, setting LD_LIBRARY_PATH for it
+def run_conf(conf, script, old_ld_lib_path):
+    if budget_used_up(conf):
+        print("Campaign time budget is used up, {} skipped".format(conf["testname"]))
+        return
+    with open('tmp_conf.json', 'w') as f:
+        json.dump(conf, f)
+
+    pglib_path = os.path.join(conf["pginstdir"], "lib")
+    os.environ['LD_LIBRARY_PATH'] = "{0}:{1}".format(pglib_path, old_ld_lib_path)
+    print("LD_LIBRARY_PATH set to {0}".format(os.environ['LD_LIBRARY_PATH']))
+
+    subprocess.call([script])
+
+
+# Run cmd, echoing its output prefixed with tag; returns exit code
+def run_tagged(cmd, env, tag):
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True, env=env)
+    for line in proc.stdout:
+        print("[{0}] {1}".format(tag, line), end='', flush=True)
+    return proc.wait()
+
+
+# conf adjusted to run on slice: own port and working copy in its own
+# subdirectory of copydir
+def slice_conf(conf, slc):
+    conf = dict(conf)
+    conf["pgport"] = str(slc.port)
+    conf["copydir"] = os.path.join(conf["copydir"], slc.name)
+    conf["slice"] = str(slc)
+    os.makedirs(conf["copydir"], exist_ok=True)
+    return conf
+
+
+# Run run_single.py with conf on slice, keeping per-config LD_LIBRARY_PATH
+def run_on_slice(conf, slc, script, old_ld_lib_path):
+    if budget_used_up(conf):
+        print("Campaign time budget is used up, {} skipped".format(conf["testname"]))
+        return
+    conf = slice_conf(conf, slc)
+    conf_path = "tmp_conf-{}.json".format(slc.name)
+    with open(conf_path, 'w') as f:
+        json.dump(conf, f)
+    pglib_path = os.path.join(conf["pginstdir"], "lib")
+    env = dict(os.environ, LD_LIBRARY_PATH="{0}:{1}".format(pglib_path, old_ld_lib_path))
+    code = run_tagged(slc.wrap([script, "--conf", conf_path]), env,
+                      "{0} {1}".format(slc.name, conf["testname"]))
+    if code != 0:
+        print("WARN: {0} on {1} exited with code {2}".format(conf["testname"], slc.name, code))
+
+
+# Run confs on slices, each slice takes the next conf when it is done with
+# the previous one
+def run_slices(confs, slcs, script, old_ld_lib_path):
+    jobs = queue.Queue()
+    for conf in confs:
+        jobs.put(conf)
+
+    def slice_worker(slc):
+        while True:
+            try:
+                conf = jobs.get_nowait()
+            except queue.Empty:
+                return
+            run_on_slice(conf, slc, script, old_ld_lib_path)
+
+    threads = [threading.Thread(target=slice_worker, args=(slc,)) for slc in slcs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def median_exectime(conf, query):
+    path = os.path.join("res", "{0}-{1}-{2}-{3}".format(
+        conf["resdir_prefix"], conf["testname"], query, conf["scale"]), "exectime.txt")
+    try:
+        with open(path) as f:
+            return statistics.median(float(line) for line in f if line.strip())
+    except (OSError, statistics.StatisticsError):
+        return None
+
+
+# Check that slices don't contend: run the first query of conf alone on the
+# first slice, then on all slices at once, and compare median times. Results
+# go to res/<prefix>-calibration.tsv; returns list of slices slower than solo
+# by more than tol (relative).
+def calibrate(conf, slcs, script, old_ld_lib_path, tol):
+    query = conf_queries(conf)[0]
+
+    def calib_conf(suffix):
+        c = dict(conf)
+        c["queries"] = query
+        c["testname"] = "{0}_calib_{1}".format(conf["testname"], suffix)
+        # not a job of the campaign
+        c.pop("campaign", None)
+        c.pop("campaign_job", None)
+        return c
+
+    print("Calibration: {0} {1} alone on {2}".format(conf["testname"], query, slcs[0].name))
+    solo = calib_conf("solo")
+    run_on_slice(solo, slcs[0], script, old_ld_lib_path)
+    solo_time = median_exectime(solo, query)
+    if solo_time is None:
+        print("WARN: calibration run failed, slices are not checked")
+        return []
+
+    print("Calibration: {0} {1} on all slices at once".format(conf["testname"], query))
+    confs = [calib_conf(slc.name) for slc in slcs]
+    threads = [threading.Thread(target=run_on_slice, args=(c, slc, script, old_ld_lib_path))
+               for c, slc in zip(confs, slcs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    contended = []
+    with open(os.path.join("res", "{}-calibration.tsv".format(conf["resdir_prefix"])), 'w') as f:
+        f.write("slice\tnode\tcpus\tmedian\tslowdown\n")
+        f.write("solo\t{0}\t{1}\t{2:.6f}\t0\n".format(
+            slcs[0].node, format_cpulist(slcs[0].cpus), solo_time))
+        for c, slc in zip(confs, slcs):
+            t = median_exectime(c, query)
+            slowdown = (t - solo_time) / solo_time if t is not None else float('nan')
+            f.write("{0}\t{1}\t{2}\t{3}\t{4:.4f}\n".format(
+                slc.name, slc.node, format_cpulist(slc.cpus), '' if t is None else "{:.6f}".format(t),
+                slowdown))
+            print("Calibration: {0} median {1}, {2:+.2f}% against solo".format(
+                slc.name, t, slowdown * 100))
+            if not slowdown <= tol:
+                contended.append(slc.name)
+    return contended
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="""
     Run some queries against Postgres and does something with them.
@@ -50,6 +339,73 @@ if __name__ == "__main__":
     """)
     parser.add_argument("--rc", default="runconf.json",
                         help="json file with configs to test, see runconf.json.example")
+    parser.add_argument("--sweep",
+                        help="""
+                        json spec of GUC sweep to run instead of --rc
+                        configs, see sweep.py; the per-query response surface
+                        is written to res/<timestamp>-surface.tsv
+                        """)
+    parser.add_argument("--schedule", choices=["config", "query", "run"],
+                        default="config",
+                        help="""
+                        config (default): run configs one after another.
+                        query, run: start all configs at once, each with its
+                        own run_single.py and server, and interleave them per
+                        query or per run of the query, so machine drift during
+                        the session affects all configs equally. Results are
+                        written as usual. Configs must use different pgport,
+                        and different copydir if they share pgdatadir; with
+                        restart = config all servers are up during the
+                        session, so mind the memory.
+                        """)
+    parser.add_argument("--order", choices=["random", "abba"], default="random",
+                        help="""
+                        order of configs in each block (query or round of
+                        runs) when interleaving: random permutation (default)
+                        or forward and backward alternately
+                        """)
+    parser.add_argument("--seed", type=int,
+                        help="seed of random order, the current time by default")
+    parser.add_argument("--slices", type=int, default=0,
+                        help="""
+                        Split the machine into this many slices of whole
+                        cores of one NUMA node each, see slices.py, and run
+                        configs concurrently, one per slice. Slice i runs
+                        Postgres on port <pgport> + i, with working copy in
+                        <copydir>/slice<i>, so copydir is required and
+                        restart can't be 'never'. Mind that cold cachemode
+                        drops OS caches of the whole machine, and that
+                        parallel workers should fit into the slice.
+                        """)
+    parser.add_argument("--split-queries", action="store_true",
+                        help="with --slices, run each query of a config as a separate job")
+    parser.add_argument("--calibrate", action="store_true",
+                        help="""
+                        with --slices, first run the first query of the first
+                        config alone and then on all slices at once, and stop
+                        if any slice is slower than alone by more than
+                        --calib-tol
+                        """)
+    parser.add_argument("--calib-tol", type=float, default=0.03,
+                        help="relative slowdown tolerated by --calibrate, 0.03 by default")
+    parser.add_argument("--resume", metavar="PREFIX",
+                        help="""
+                        Continue the interrupted campaign started at PREFIX
+                        timestamp, i.e. res/PREFIX-campaign.db, see
+                        campaign.py. Configs and the options above are taken
+                        from there, not from the command line and --rc;
+                        finished configs and queries are skipped, and
+                        interrupted queries continue from the first
+                        unfinished run.
+                        """)
+    parser.add_argument("--budget", type=float, default=0,
+                        help="""
+                        Campaign time budget in seconds. When it is used up,
+                        the running query is cancelled and the rest of
+                        queries and configs are skipped; runs of each query
+                        are limited to what is left of it. See also
+                        querytimeout in pgtpch.conf.example.
+                        """)
     args = parser.parse_args()
     this_script_dir = os.path.dirname(os.path.realpath(__file__))
 
@@ -58,20 +414,128 @@ if __name__ == "__main__":
     default_conf = parse_default_conf()
     # set current datetime as prefix to all res dirs
     curdt = '{0:%Y-%m-%d_%H-%M-%S}'.format(datetime.datetime.now())
+    # run_single.py stops at this time too
+    deadline = str(time.time() + args.budget) if args.budget > 0 else None
+
+    if args.sweep is not None:
+        if args.resume is not None:
+            print("--resume can't be used with --sweep")
+            sys.exit(1)
+        with open(args.sweep) as f:
+            spec = json.load(f)
+        script = os.path.join(this_script_dir, "run_single.py")
+        os.makedirs("res", exist_ok=True)
+        if deadline is not None:
+            default_conf["deadline"] = deadline
+        run_sweep(spec, default_conf, curdt,
+                  lambda conf: run_conf(conf, script, old_ld_lib_path))
+        sys.exit(0)
 
-    with open(args.rc) as f:
-        confs = json.load(f)
+    os.makedirs("res", exist_ok=True)
+    campaign = None
+    if args.resume is None:
+        with open(args.rc) as f:
+            confs = json.load(f)
+        if args.seed is None:
+            args.seed = int(time.time())
+        merged_confs = []
         for conf in confs:
             # roll configuration given conf over default one on pgtpch.conf
             merged_conf = default_conf.copy()
             merged_conf.update(conf)
             merged_conf["resdir_prefix"] = curdt
+            if args.schedule != "config":
+                merged_conf["schedule"] = "{0} {1}".format(args.schedule, args.order)
+            if args.slices > 0 and args.split_queries and \
+               merged_conf.get("runner") != "throughput":
+                for query in conf_queries(merged_conf):
+                    job_conf = dict(merged_conf)
+                    job_conf["queries"] = query
+                    merged_confs.append(job_conf)
+            else:
+                merged_confs.append(merged_conf)
+    else:
+        campaign_path = os.path.join("res", "{}-campaign.db".format(args.resume))
+        if not os.path.isfile(campaign_path):
+            print("Campaign {} not found".format(campaign_path))
+            sys.exit(1)
+        campaign = Campaign(campaign_path)
+        for key, value in campaign.options().items():
+            setattr(args, key, value)
+        curdt = args.resume
+        print("Resuming campaign {0}: {1} jobs, {2} finished, {3} queries and {4} runs "
+              "done".format(curdt, *campaign.progress()))
+        merged_confs = campaign.pending_confs()
+
+    if args.slices > 0:
+        if args.schedule != "config":
+            print("--slices can't be used with --schedule")
+            sys.exit(1)
+        for merged_conf in merged_confs:
+            if merged_conf.get("copydir") is None or merged_conf.get("restart") == "never":
+                print("{}: --slices requires copydir and restart other than 'never'".format(
+                    merged_conf["testname"]))
+                sys.exit(1)
+    if args.schedule != "config":
+        problems = check_interleavable(merged_confs)
+        if problems:
+            print("Configs can't be interleaved:\n" + "\n".join(problems))
+            sys.exit(1)
+
+    if campaign is None:
+        campaign = Campaign(os.path.join("res", "{}-campaign.db".format(curdt)))
+        campaign.create(merged_confs, {k: getattr(args, k) for k in CAMPAIGN_OPTIONS})
+        merged_confs = campaign.pending_confs()
+    campaign.close()
+    for merged_conf in merged_confs:
+        if args.resume is not None:
+            merged_conf["resume"] = "true"
+        if deadline is not None:
+            merged_conf["deadline"] = deadline
+    if not merged_confs:
+        print("Nothing to run")
+        sys.exit(0)
+
+    if args.slices > 0:
+        slcs = make_slices(args.slices, int(merged_confs[0]["pgport"]))
+        for slc in slcs:
+            print(slc)
+        if any(c.get("cachemode", "cold") == "cold" for c in merged_confs):
+            print("WARN: cold cachemode drops OS caches of the whole machine, "
+                  "affecting the other slices")
+        script = os.path.join(this_script_dir, "run_single.py")
+        if args.calibrate and args.resume is None:
+            contended = calibrate(merged_confs[0], slcs, script, old_ld_lib_path,
+                                  args.calib_tol)
+            if contended:
+                print("Slices {} contend with each other, use less slices".format(
+                    ', '.join(contended)))
+                sys.exit(1)
+        run_slices(merged_confs, slcs, script, old_ld_lib_path)
+        sys.exit(0)
 
-            with open('tmp_conf.json', 'w') as f:
-                json.dump(merged_conf, f)
+    if args.schedule != "config":
+        print("Interleaving configs per {0}, {1} order, seed {2}".format(
+            args.schedule, args.order, args.seed))
 
-            pglib_path = os.path.join(merged_conf["pginstdir"], "lib")
-            os.environ['LD_LIBRARY_PATH'] = "{0}:{1}".format(pglib_path, old_ld_lib_path)
-            print("LD_LIBRARY_PATH set to {0}".format(os.environ['LD_LIBRARY_PATH']))
+        workers = []
+        try:
+            for i, merged_conf in enumerate(merged_confs):
+                pglib_path = os.path.join(merged_conf["pginstdir"], "lib")
+                env = dict(os.environ,
+                           LD_LIBRARY_PATH="{0}:{1}".format(pglib_path, old_ld_lib_path))
+                worker = Worker(merged_conf, "tmp_conf-{}.json".format(i),
+                                os.path.join(this_script_dir, "run_single.py"), env)
+                workers.append(worker)
+                worker.call()  # wait until it is ready
+            interleave([w for w in workers if w.alive], args.schedule, args.order,
+                       random.Random(args.seed),
+                       os.path.join("res", "{}-schedule.tsv".format(curdt)))
+        finally:
+            for worker in workers:
+                worker.quit()
+        sys.exit(0)
 
-            subprocess.call([os.path.join(this_script_dir, "run_single.py")])
+    for merged_conf in merged_confs:
+        run_conf(merged_conf, os.path.join(this_script_dir, "run_single.py"),
+                 old_ld_lib_path)
@@ -6,6 +6,8 @@
 # run must be in ./tmp_conf.json
 
 import os
+import re
+import sys
 import datetime
 import time
 import signal
@@ -13,32 +15,110 @@ import pathlib
 import shutil
 import subprocess
 import json
+import shlex
+import argparse
 import psycopg2
 import math
 import getpass
+import statistics
+import threading
+import multiprocessing
 from glob import glob
 
 import plumbum
-from plumbum import local
-from plumbum.cmd import cp, rm, cat, echo, sudo, tee, perf, kill, sync, chmod, chown
+from plumbum.cmd import rm, echo, sudo, tee, kill, sync, chown
+
+from snapshot import make_snapshot
+from slices import parse_cpulist
+from clustercache import ClusterCache, budget_bytes
+from refresh import RefreshSets, rf1, rf2
+from campaign import Campaign
+import paramsets
+import answers
+from resstore import ResStore, env_metadata
+import folded
+import plans
+from ossampler import OsSampler
+from pgsampler import PgSampler
 
 # check for scipy and numpy availability to calc confidence intervals
 try:
     from scipy.stats import t
-    from numpy import average, std
+    from numpy import average, std, median
     scipy_loaded = True
 except ImportError:
     scipy_loaded = False
     print("scipy or numpy is not available, results will not be summarized")
 
+# when to restart Postgres: before each query, once per config or never, i.e.
+# use already running server
+RESTART_POLICIES = ["query", "config", "never"]
+# cold: drop caches before each query; hot: preload relations the query touches
+CACHE_MODES = ["cold", "hot"]
+# TPC-H refresh functions: none; interleaved: refresh pair around each run of
+# a query (standard and perfer runners); stream: RF1 and RF2 in the power
+# test and refresh stream in the throughput test (throughput runner)
+REFRESH_MODES = ["none", "interleaved", "stream"]
+
+
+# prefix of replies to run.py's scheduler on stdout, see StandardRunner.serve
+REPLY_PREFIX = "pgtpch-reply: "
+
+
 class QueryNotFoundError(Exception):
     pass
 
 
-# convert any unknown types to string in json.dumps
-class Stringifier(json.JSONEncoder):
-    def default(self, obj):
-        return str(obj)
+class ConfError(Exception):
+    pass
+
+
+class ServerNotReadyError(Exception):
+    pass
+
+
+# run.py --budget is used up, no more queries are run
+class BudgetExhaustedError(Exception):
+    pass
+
+
+# Index of the first run in the steady state: leading runs whose time differs
+# from the median of the following ones by more than tol (relative) are
+# considered warmups. At least minruns runs are always left.
+def steady_state_start(times, tol, minruns):
+    start = 0
+    while len(times) - start > minruns:
+        rest_median = median(times[start + 1:])
+        if abs(times[start] - rest_median) <= tol * rest_median:
+            break
+        start += 1
+    return start
+
+
+# Relative half-width of 0.95 confidence interval of the mean, assuming
+# T-student distribution
+def ci_rel_halfwidth(times):
+    if len(times) < 2:
+        return math.inf
+    halfwidth = t.ppf(0.975, len(times) - 1) * std(times, ddof=1) / math.sqrt(len(times))
+    return halfwidth / average(times)
+
+
+# Split query text into statements before the main one, the main one, whose
+# answer is fetched, and statements after it, e.g. q15 creates a view, selects
+# from it and drops it. The main statement is the last one returning rows,
+# i.e. select, with, values or table, or None if there is no such statement.
+def split_query(query_text):
+    # drop the comments; TPC-H queries don't have ';' and '--' in literals
+    text = '\n'.join(re.sub(r'--.*', '', line) for line in query_text.splitlines())
+    stmts = [stmt.strip() for stmt in text.split(';') if stmt.strip()]
+    main_idx = None
+    for idx, stmt in enumerate(stmts):
+        if re.match(r'(select|with|values|table)\b', stmt, re.IGNORECASE):
+            main_idx = idx
+    if main_idx is None:
+        return stmts, None, []
+    return stmts[:main_idx], stmts[main_idx], stmts[main_idx + 1:]
 
 
 # parsed conf values
@@ -53,20 +133,109 @@ class PgtpchConf:
         self.conf_dict["warmups"] = int(self["warmups"])
         self.numruns = self["warmups"] + 1
 
+        # sequential sampling: run the query until CI of the mean is tight
+        # enough, see 'adaptive' in pgtpch.conf.example
+        self.adaptive = self.get("adaptive") == "true"
+        self.minruns = int(self.get("minruns", 5))
+        self.maxruns = int(self.get("maxruns", 50))
+        self.maxtime = float(self.get("maxtime", 0))
+        self.citarget = float(self.get("citarget", 0.01))
+        self.warmuptol = float(self.get("warmuptol", 0.05))
+        if self.adaptive and not scipy_loaded:
+            raise ConfError("adaptive mode requires scipy and numpy")
+        if self.adaptive and self.minruns < 2:
+            raise ConfError("minruns must be at least 2")
+
         if self.get("pguser") is None:
             self.conf_dict["pguser"] = getpass.getuser()
 
         self.pg_bin = os.path.join(self["pginstdir"], "bin")
-        if self.get("copydir") is None:
+        # work queue of run.py campaign this config is a job of, see
+        # campaign.py; resume is set when the campaign is resumed
+        self.campaign = self.get("campaign")
+        self.campaign_job = int(self.get("campaign_job", 0))
+        self.resume = self.get("resume") == "true"
+        # take pgdatadir from the cache of prepared clusters, building it if
+        # needed, see clustercache.py
+        if self.get("clustercache") is not None:
+            pgdatadir, key = ClusterCache(self["clustercache"]).resolve(
+                self.conf_dict, budget_bytes(self.conf_dict))
+            self.conf_dict["pgdatadir"] = pgdatadir
+            self.conf_dict["clusterkey"] = key
+
+        self.restart = self.get("restart", "query")
+        if self.restart not in RESTART_POLICIES:
+            raise ConfError("Wrong restart policy: {}".format(self.restart))
+        self.cachemode = self.get("cachemode", "cold")
+        if self.cachemode not in CACHE_MODES:
+            raise ConfError("Wrong cachemode: {}".format(self.cachemode))
+        # the server is already running on its own data dir with restart =
+        # never, so don't make a snapshot which wouldn't be used
+        if self.restart == "never" and self.get("copydir") is not None:
+            print("WARN: restart is 'never', copydir is ignored")
+        if self.get("copydir") is None or self.restart == "never":
+            self.snapshot = None
             self.real_pgdatadir = self["pgdatadir"]
         else:
-            pgdd_name = os.path.basename(os.path.normpath(self["pgdatadir"]))
-            self.real_pgdatadir = os.path.join(self["copydir"], pgdd_name)
+            self.snapshot = make_snapshot(self.get("snapshot", "auto"),
+                                          self["pgdatadir"], self["copydir"],
+                                          self.get("extconffile"), self.resume)
+            self.real_pgdatadir = self.snapshot.workdir
+        if self.restart == "never" and self.server_gucs():
+            print("WARN: restart is 'never', srv.* options are ignored")
+        if self.restart != "query" and self.cachemode == "cold":
+            print("WARN: restart is not 'query', cold mode will drop only OS caches, not shared buffers")
+        # seconds to wait for the server to accept connections
+        self.starttimeout = float(self.get("starttimeout", 60))
+        # pause between runs of a query, in seconds
+        self.runpause = float(self.get("runpause", 1))
+        # rows fetched from the server-side cursor at once
+        self.fetchbatch = int(self.get("fetchbatch", 10000))
+        self.recordanswers = self.get("recordanswers", "true") == "true"
+        self.verifyanswers = self.get("verifyanswers", "true") == "true"
+        self.dbgen_dir = os.path.abspath(self.get("dbgenpath", "."))
+        self.explain = self.get("explain", "true") == "true"
+        self.explainanalyze = self.get("explainanalyze", "false") == "true"
+        self.refresh = self.get("refresh", "none")
+        if self.refresh not in REFRESH_MODES:
+            raise ConfError("Wrong refresh mode: {}".format(self.refresh))
+        if (self.refresh == "stream") != (self["runner"] == "throughput") and \
+           self.refresh != "none":
+            raise ConfError("refresh {0} can't be used with {1} runner".format(
+                self.refresh, self["runner"]))
+        # refresh pairs of every run would accumulate in pgdatadir, or in the
+        # cluster shared via clustercache, without a working copy to reset
+        if self.refresh == "interleaved" and self.snapshot is None:
+            raise ConfError("refresh interleaved requires copydir and restart other than 'never'")
+        # update sets generated by prepare.sh -U, see refresh.py
+        self.updates_dir = self.get("updatesdir", os.path.join(self["pgdatadir"], "updates"))
+        # limit on time of one run of a query, secs, 0 is none; can be set per
+        # query with querytimeout.<query>
+        self.querytimeout = float(self.get("querytimeout", 0))
+        # end of the campaign time budget, epoch secs, set by run.py --budget
+        self.deadline = float(self.get("deadline", 0))
+        # sqlite database all results are recorded to, see resstore.py
+        self.resstore = self.get("resstore", os.path.join("res", "results.db"))
+
+        # variants of the config differing only in testname and session GUCs,
+        # run one after another on the same server; see sweep.py
+        self.variants = self.conf_dict.pop("variants", None) or [{}]
+        for variant in self.variants:
+            for key in variant:
+                if key != "testname" and not key.startswith("set."):
+                    raise ConfError("variant can change only testname and set.* options")
+        self.variant_keys = []
 
         if self["queries"] == "all":
-            self.queries = ["q{}".format(xx.zfill(2)) for xx in range(1, 23)]
+            self.queries = ["q{:02d}".format(q) for q in range(1, 23)]
         else:
             self.queries = self["queries"].split()
+        # number of substitution parameter variants of each query to rotate
+        # through and seed of the first one, see paramsets.py
+        self.paramsets = int(self.get("paramsets", 0))
+        self.paramseed = int(self.get("paramseed", 1))
+        # query -> list of (seed, path) of its variants
+        self.query_variants = {}
 
     def __getitem__(self, key):
         return self.conf_dict[key]
@@ -105,45 +274,141 @@ class PgtpchConf:
             return local_path
         raise QueryNotFoundError(query)
 
-    # if 'copydir' option is set, copy pgdatadir to the specified directory
+    # if 'copydir' option is set, reset the working copy of pgdatadir in it to
+    # the pristine state, see snapshot.py
     def copydir(self):
-        if self.get("copydir") is not None:
-            print("Copying {0} to {1} ...".format(self["pgdatadir"], self.real_pgdatadir))
-            (rm["-rf", self.real_pgdatadir])()
-            (cp["-r", self["pgdatadir"], self.real_pgdatadir])()
-            print("Copy done")
-            if self.get("extconffile") is not None:
-                if os.path.isfile(self["extconffile"]):
-                    (cat[self["extconffile"]] >> os.path.join(self.real_pgdatadir, "postgresql.conf"))()
-                    print("extconffile appended")
-                else:
-                    print("WARN: extconffile specified, but doesn't exists")
-            # postgres will complain if permissions are too wide
-            (chmod["0700", self.real_pgdatadir])()
+        if self.snapshot is not None:
+            self.snapshot.restore()
+
+    # Time limit of one run of query in secs, 0 if there is none
+    def query_timeout(self, query):
+        return float(self.get("querytimeout.{}".format(query), self.querytimeout))
+
+    # Secs left of the campaign time budget, None if there is no budget
+    def budget_left(self):
+        if self.deadline == 0:
+            return None
+        return self.deadline - time.time()
+
+    # Limit of one run of query starting now: (secs, by_budget), by_budget is
+    # true if it is what is left of the campaign budget rather than the query
+    # timeout; secs is 0 if there is no limit
+    def run_limit(self, query):
+        limit, by_budget = self.query_timeout(query), False
+        budget_left = self.budget_left()
+        if budget_left is not None and (limit == 0 or budget_left < limit):
+            limit, by_budget = max(budget_left, 0.001), True
+        return limit, by_budget
+
+    # Generate variants of TPC-H queries among queries which are not cached
+    # yet, in parallel
+    def prepare_variants(self, queries):
+        queries = [q for q in queries if paramsets.query_number(q) is not None and
+                   q not in self.query_variants]
+        if self.paramsets == 0 or not queries:
+            return
+        directory = paramsets.params_dir(os.path.join(self["pgdatadir"], "queries"),
+                                         self.dbgen_dir, self["scale"])
+        self.query_variants.update(paramsets.ensure_variants(
+            directory, self.dbgen_dir, self["scale"], queries, self.paramsets,
+            self.paramseed))
+
+    # Returns list of (seed, path) of the variants of query to rotate through
+    # across runs; without paramsets, or for queries not generated by qgen,
+    # the only one is (None, path of the query)
+    def get_query_variants(self, query):
+        self.prepare_variants([query])
+        if query in self.query_variants:
+            return self.query_variants[query]
+        return [(None, self.get_query_path(query))]
+
+    # remove everything created in copydir; call when all queries are done
+    def cleanup(self):
+        if self.snapshot is not None:
+            self.snapshot.destroy()
+
+    def drop_caches(self):
+        print("Dropping caches")
+        sync()
+        (echo["3"] | sudo[tee["/proc/sys/vm/drop_caches"]] > "/dev/null")()
 
     # start postgres, copying pgdatadir if needed
     def postgres_start(self, drop_caches=True):
-        if drop_caches:
-            print("Dropping caches")
-            sync()
-            (echo["3"] | sudo[tee["/proc/sys/vm/drop_caches"]] > "/dev/null")()
         self.copydir()
+        if drop_caches:
+            self.drop_caches()
         subprocess.check_call([os.path.join(self.pg_bin, "pg_ctl"),
                                "-w",
                                "-D", self.real_pgdatadir,
-                               '-o "-p {}"'.format(self["pgport"]),
+                               "-o", self.server_options(),
                                "start"])
-        time.sleep(2)
-
-    # stop postgres, removing pgdatadir if needed
+        self.wait_ready()
+
+    # postgres command line options: port and srv.<name> GUCs; pg_ctl passes
+    # them through shell
+    def server_options(self):
+        opts = ["-p", str(self["pgport"])]
+        for name, value in sorted(self.server_gucs().items()):
+            opts.extend(["-c", shlex.quote("{0}={1}".format(name, value))])
+        return ' '.join(opts)
+
+    def server_gucs(self):
+        return {key[len("srv."):]: value for key, value in self.conf_dict.items()
+                if key.startswith("srv.")}
+
+    def session_gucs(self):
+        return {key[len("set."):]: value for key, value in self.conf_dict.items()
+                if key.startswith("set.")}
+
+    # SET set.<name> GUCs on conn
+    def set_gucs(self, conn):
+        gucs = self.session_gucs()
+        if not gucs:
+            return
+        with conn.cursor() as curs:
+            for name, value in sorted(gucs.items()):
+                curs.execute("select set_config(%s, %s, false)", (name, str(value)))
+        conn.commit()
+
+    # Make variant current: variant is dict of options replacing the config's
+    # ones, see 'variants' in pgtpch.conf.example
+    def apply_variant(self, variant):
+        for key in self.variant_keys:
+            self.conf_dict.pop(key, None)
+        self.conf_dict.update(variant)
+        self.variant_keys = list(variant)
+
+    # Poll the server until it accepts connections: pg_ctl -w might return
+    # while it is still 'starting up'. Uses pg_isready, if available, and
+    # connection attempts otherwise.
+    def wait_ready(self):
+        pg_isready = os.path.join(self.pg_bin, "pg_isready")
+        deadline = time.monotonic() + self.starttimeout
+        while True:
+            if os.path.isfile(pg_isready):
+                ready = subprocess.call(
+                    [pg_isready, "-q", "-h", "localhost", "-p", str(self["pgport"]),
+                     "-U", self["pguser"], "-d", self["tpchdbname"]]) == 0
+            else:
+                try:
+                    self.connect().close()
+                    ready = True
+                except psycopg2.OperationalError:
+                    ready = False
+            if ready:
+                return
+            if time.monotonic() > deadline:
+                raise ServerNotReadyError("server on port {0} is not ready after {1} s".format(
+                    self["pgport"], self.starttimeout))
+            time.sleep(0.05)
+
+    # stop postgres; the working copy of pgdatadir is kept until cleanup()
     def postgres_stop(self):
         subprocess.check_call([os.path.join(self.pg_bin, "pg_ctl"),
                                "-w",
                                "-D", self.real_pgdatadir,
                                '-o "-p {}"'.format(self["pgport"]),
                                "stop"])
-        if self["copydir"] is not None:
-            (rm["-rf", self.real_pgdatadir])()
 
     # open connection, returns psycopg2 connection object
     def connect(self):
@@ -152,6 +417,39 @@ class PgtpchConf:
                                                                  self["pguser"],
                                                                  self["tpchdbname"]))
 
+# Cancels the current query of backend pid with pg_cancel_backend from a
+# separate connection unless stopped within timeout secs. statement_timeout
+# alone doesn't bound a run, as a query may consist of several statements.
+class CancelWatchdog(threading.Thread):
+    def __init__(self, pc, pid, timeout):
+        super().__init__()
+        self.pc = pc
+        self.pid = pid
+        self.timeout = timeout
+        self.stop_event = threading.Event()
+        self.fired = False
+        self.error = None
+
+    def run(self):
+        if self.stop_event.wait(self.timeout):
+            return
+        try:
+            conn = self.pc.connect()
+            conn.autocommit = True
+            try:
+                with conn.cursor() as curs:
+                    curs.execute("select pg_cancel_backend(%s)", (self.pid,))
+                self.fired = True
+            finally:
+                conn.close()
+        except Exception as e:
+            self.error = e
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+
 class StandardRunner(object):
     def __init__(self, pc):
         assert (isinstance(pc, PgtpchConf))
@@ -160,82 +458,672 @@ class StandardRunner(object):
         # per-query state
         self.query = None
         self.exectime_path = None
+        # list of (exec, fetch) times of runs in ns
+        self.phases = []
+        # monotonic time when the first run of the query started
+        self.sampling_start = None
+        self.store = ResStore(self.pc.resstore)
+        self.campaign = Campaign(self.pc.campaign) if self.pc.campaign is not None else None
+        # id of the current query's run in the store
+        self.run_id = None
+        # pid of the backend running the query
+        self.leader_pid = None
+        self.os_sampler = None
+        self.pg_sampler = None
+        # update sets for refresh functions
+        self.refresh_sets = RefreshSets(self.pc.updates_dir, int(self.pc.get("refreshset", 1)))
+        # limit on one run of the current query, secs, 0 is none, and whether
+        # a run hit it
+        self.timeout = 0
+        self.timed_out = False
+        # connection, text and number of the last run of the current query
+        self.conn = None
+        self.query_text = None
+        self.runnum = 0
+        # list of (seed, text) of the current query's parameter variants and
+        # seeds used by its runs, see paramsets.py
+        self.variant_texts = []
+        self.run_seeds = []
 
         print("Disabling transparent hugepages")
         (echo["never"] | sudo[tee["/sys/kernel/mm/transparent_hugepage/defrag"]] > "/dev/null")()
 
     def run(self):
-        print("Queries are {}".format(pc.queries))
-        for query in pc.queries:
+        try:
+            self.start()
             try:
-                self.run_query(query)
-            except QueryNotFoundError as e:
-                print("Query not found: {}".format(e.args[0]))
+                for variant in self.pc.variants:
+                    self.pc.apply_variant(variant)
+                    for query in self.pc.queries:
+                        if self.query_done(query):
+                            continue
+                        try:
+                            self.run_query(query)
+                        except QueryNotFoundError as e:
+                            print("Query not found: {}".format(e.args[0]))
+                self.finish_job()
+            except BudgetExhaustedError:
+                print("Campaign time budget is used up, the rest of queries is skipped")
+            finally:
+                self.stop()
+        finally:
+            self.pc.cleanup()
+            self.store.close()
+
+        self.postrun()
+
+    # True if query of the current variant was done before the campaign was
+    # resumed
+    def query_done(self, query):
+        if self.campaign is None:
+            return False
+        reason = self.campaign.query_stopreason(self.pc.campaign_job, self.pc["testname"], query)
+        if reason is not None:
+            print("Query {0} of {1} is done already: {2}".format(
+                query, self.pc["testname"], reason))
+        return reason is not None
+
+    # All queries of the config are run; mark the job finished in the
+    # campaign queue
+    def finish_job(self):
+        if self.campaign is not None:
+            self.campaign.finish_job(self.pc.campaign_job)
+
+    # Serve commands of run.py's interleaving scheduler, see run.py, instead
+    # of running all queries at once. Commands are read one per line from
+    # stdin, and each is answered with one line prefixed with REPLY_PREFIX on
+    # stdout:
+    #   * begin <query>: prepare to run the query, see begin_query; replies
+    #     'ok' or 'error <message>';
+    #   * run: run the current query once more; replies 'more' or 'done <stop
+    #     reason>', the query is finished then;
+    #   * query <query>: run the query completely, replies 'done';
+    #   * quit: replies 'bye' and exits.
+    # The server is started once before the first command, if restart is
+    # 'config', so switching between configs costs nothing.
+    def serve(self):
+        def reply(msg):
+            print("{0}{1}".format(REPLY_PREFIX, msg), flush=True)
+
+        try:
+            self.start()
+            try:
+                reply("ready")
+                for line in sys.stdin:
+                    cmd = line.split(None, 1)
+                    if not cmd:
+                        continue
+                    if cmd[0] == "quit":
+                        break
+                    elif cmd[0] == "begin":
+                        if self.query_done(cmd[1].strip()):
+                            reply("error query is done already")
+                            continue
+                        try:
+                            self.begin_query(cmd[1].strip())
+                            reply("ok")
+                        except QueryNotFoundError as e:
+                            reply("error query not found: {}".format(e.args[0]))
+                        except BudgetExhaustedError:
+                            reply("error campaign time budget is used up")
+                    elif cmd[0] == "run":
+                        try:
+                            stop_reason = self.run_once()
+                            if stop_reason is not None:
+                                self.end_query(stop_reason)
+                        except BaseException:
+                            self.query_stopped()
+                            raise
+                        if stop_reason is None:
+                            reply("more")
+                        else:
+                            self.query_stopped()
+                            reply("done {}".format(stop_reason))
+                    elif cmd[0] == "query":
+                        if self.query_done(cmd[1].strip()):
+                            reply("done")
+                            continue
+                        try:
+                            self.run_query(cmd[1].strip())
+                        except QueryNotFoundError as e:
+                            print("Query not found: {}".format(e.args[0]))
+                        except BudgetExhaustedError:
+                            print("Campaign time budget is used up, {} skipped".format(
+                                cmd[1].strip()))
+                        reply("done")
+                    else:
+                        reply("error unknown command {}".format(cmd[0]))
+                if self.campaign is not None and all(
+                        self.campaign.query_stopreason(self.pc.campaign_job,
+                                                       self.pc["testname"], q) is not None
+                        for q in self.pc.queries):
+                    self.finish_job()
+            finally:
+                self.stop()
+        finally:
+            self.pc.cleanup()
+            self.store.close()
 
         self.postrun()
+        reply("bye")
+
+    # Called before the first query: start Postgres if it is restarted once
+    # per config
+    def start(self):
+        print("Queries are {}".format(self.pc.queries))
+        self.pc.prepare_variants(self.pc.queries)
+        if self.pc.restart == "config":
+            self.pc.postgres_start(drop_caches=False)
+        elif self.pc.restart == "never":
+            self.pc.wait_ready()
+
+    # Called after the last query, even if it failed
+    def stop(self):
+        if self.pc.restart == "config":
+            self.pc.postgres_stop()
 
     # Run one query (several times)
     def run_query(self, query):
+        self.begin_query(query)
+        try:
+            stop_reason = None
+            while stop_reason is None:
+                stop_reason = self.run_once()
+            self.end_query(stop_reason)
+        finally:
+            self.query_stopped()
+
+    # Prepare to run query: create its results dir, start Postgres if it is
+    # restarted for each query, connect and warm up caches as configured.
+    # query_stopped() must be called when the query is finished. Raises
+    # BudgetExhaustedError if the campaign time budget is used up.
+    def begin_query(self, query):
+        budget_left = self.pc.budget_left()
+        if budget_left is not None and budget_left <= 0:
+            raise BudgetExhaustedError()
         print("Running query {}".format(query))
         self.query = query
+        self.timeout = self.pc.query_timeout(query)
+        self.timed_out = False
 
-        # Ensure that res dir exists and empty
+        # runs done before the campaign was interrupted
+        done_units = []
+        if self.campaign is not None and self.pc.resume:
+            done_units = self.campaign.units(self.pc.campaign_job, self.pc["testname"], query)
+            done_units = [u for i, u in enumerate(done_units) if u[0] == i + 1]
+
+        # Ensure that res dir exists and empty, unless we continue the query
         res_dir = self.get_res_dir()
-        print("Creating directory {}".format(res_dir))
-        shutil.rmtree(res_dir, True)
-        os.makedirs(res_dir)
+        if done_units:
+            print("Continuing in directory {}".format(res_dir))
+            os.makedirs(res_dir, exist_ok=True)
+        else:
+            print("Creating directory {}".format(res_dir))
+            shutil.rmtree(res_dir, True)
+            os.makedirs(res_dir)
 
         self.exectime_path = os.path.join(res_dir, "exectime.txt")
-
-        # prepare the query
-        ready_query_path = os.path.join(res_dir, "{}.sql".format(query))
-        (cat[self.pc.get_query_path(query)] > ready_query_path)()
-
-        self.pc.postgres_start()
+        self.phases = []
+
+        # prepare the query; the texts are read once here, so no file access
+        # happens while timing
+        self.variant_texts = []
+        self.run_seeds = []
+        for seed, path in self.pc.get_query_variants(query):
+            with open(path) as f:
+                text = f.read()
+            if seed is None:
+                ready_query_path = os.path.join(res_dir, "{}.sql".format(query))
+            else:
+                ready_query_path = os.path.join(res_dir, "{0}-s{1}.sql".format(query, seed))
+            with open(ready_query_path, 'w') as f:
+                f.write(text)
+            self.variant_texts.append((seed, text))
+        self.query_text = self.variant_texts[0][1]
+
+        cold = self.pc.cachemode == "cold"
+        if self.pc.restart == "query":
+            self.pc.postgres_start(drop_caches=cold)
+            # the working copy is pristine again
+            if self.pc.snapshot is not None:
+                self.refresh_sets.reset()
+        elif cold:
+            self.pc.drop_caches()
         try:
-            conn = self.pc.connect()
-            self.conn_created_hook(conn)
-
-            if (pc.get("precmdfile") is not None):
-                self.log("Running precmdfile {}".format(pc["precmdfile"]))
-                with conn.cursor() as curs:
-                    curs.execute(cat[pc["precmdfile"]]())
-                conn.commit()
-
-            for runnum in range(1, self.pc.numruns + 1):
-                self.log("Run {}...".format(runnum))
-                self.preexecute_hook(runnum)
-
-                starttime = time.time()
-                with conn.cursor() as curs:
-                    curs.execute(cat[ready_query_path]())
-                    if runnum != self.pc.numruns:
-                        # not last run, don't record the answer
-                        conn.commit()
-                    else:
-                        # last run, record the answer
-                        answer = curs.fetchall()
-                        answer_json = json.dumps(answer, indent=4, cls=Stringifier)
-                        (echo[answer_json] > os.path.join(res_dir, "answer.json"))()
-                # log exectime
-                exectime = time.time() - starttime
-                (echo[exectime] >> self.exectime_path)()
-
-                self.postexecute_hook(runnum)
-                time.sleep(1)  # small pause
-
-            conn.close()
-            self.conn_closed_hook()
+            self.conn = self.pc.connect()
+            self.conn_created_hook(self.conn)
+            env = env_metadata(self.conn, self.pc.pg_bin)
+            self.run_id = self.store.add_run(self.pc.conf_dict, query, res_dir, env)
+            # for aggregate.py working without the store
+            if env["layout"] is not None:
+                with open(os.path.join(res_dir, "layout.txt"), 'w') as f:
+                    f.write("{}\n".format(env["layout"]))
+
+            if (self.pc.get("precmdfile") is not None):
+                self.log("Running precmdfile {}".format(self.pc["precmdfile"]))
+                with open(self.pc["precmdfile"]) as f, self.conn.cursor() as curs:
+                    curs.execute(f.read())
+                self.conn.commit()
+            self.pc.set_gucs(self.conn)
+
+            if self.pc.cachemode == "hot":
+                self.prewarm(self.conn, self.query_text)
+        except BaseException:
+            self.query_stopped()
+            raise
+
+        self.sampling_start = time.monotonic()
+        self.runnum = 0
+        if done_units:
+            self.restore_runs(done_units)
+
+    # Continue the query after runs done_units, list of (runnum, exec,
+    # fetch), recorded in the campaign queue: rewrite exectime.txt and
+    # phases.tsv with them, dropping the run which was interrupted, and add
+    # them to the new run in the results store
+    def restore_runs(self, done_units):
+        for path in (self.exectime_path, os.path.join(self.get_res_dir(), "phases.tsv")):
+            if os.path.isfile(path):
+                os.remove(path)
+        for runnum, exec_time, fetch_time in done_units:
+            self.runnum = runnum
+            self.run_seeds.append(self.variant_texts[(runnum - 1) % len(self.variant_texts)][0])
+            self.record_exectime(runnum, int(exec_time * 1e9), int(fetch_time * 1e9))
+        self.log("Resuming after {} runs done before the campaign was interrupted".format(
+            self.runnum))
+
+    # Run the current query once more. Returns None if it must be run again,
+    # or the reason to stop.
+    def run_once(self):
+        self.runnum += 1
+        runnum = self.runnum
+        self.log("Run {}...".format(runnum))
+        if self.pc.refresh == "interleaved":
+            num = self.refresh_sets.take()
+            rf1_res = rf1(self.conn, self.refresh_sets, num)
+        # rotate through the parameter variants
+        seed, self.query_text = self.variant_texts[(runnum - 1) % len(self.variant_texts)]
+        self.run_seeds.append(seed)
+        if seed is not None:
+            self.log("Parameters seed {}".format(seed))
+            self.store.add_metrics(self.run_id, runnum, {"paramseed": seed})
+        self.preexecute_hook(runnum)
+
+        # the run is limited by the query timeout and what is left of the
+        # campaign budget
+        limit, by_budget = self.pc.run_limit(self.query)
+        watchdog = None
+        if limit > 0:
+            watchdog = CancelWatchdog(self.pc, self.leader_pid, limit)
+            watchdog.start()
+        cancelled = False
+        try:
+            exec_ns, fetch_ns = self.execute_query(self.conn, self.query_text, limit)
+        except psycopg2.extensions.QueryCanceledError:
+            self.conn.rollback()
+            cancelled = True
         finally:
+            if watchdog is not None:
+                watchdog.stop()
+                if watchdog.error is not None:
+                    self.log("WARN: cancelling the query failed: {}".format(watchdog.error))
+        if not cancelled:
+            self.record_exectime(runnum, exec_ns, fetch_ns)
+        elif by_budget:
+            self.log("Run {0} cancelled after {1:.1f} s, campaign time budget is used up".format(
+                runnum, limit))
+        else:
+            self.timed_out = True
+            self.record_timeout(runnum, limit)
+
+        self.postexecute_hook(runnum)
+        if self.pc.refresh == "interleaved":
+            rf2_res = rf2(self.conn, self.refresh_sets, num)
+            self.record_refresh(runnum, num, rf1_res, rf2_res)
+        if cancelled:
+            # the next runs would be cancelled as well, don't waste time on them
+            if by_budget:
+                return "campaign time budget is used up"
+            return "timeout {0:g} s in run {1}".format(limit, runnum)
+        stop_reason = self.stop_reason(runnum)
+        if stop_reason is None:
+            time.sleep(self.pc.runpause)  # small pause
+        return stop_reason
+
+    # Run runnum hit the query timeout limit, secs: write it to timeout.txt and
+    # the results store, so aggregate.py knows the query didn't finish
+    def record_timeout(self, runnum, limit):
+        self.log("Run {0} cancelled: timeout {1:g} s, the rest of runs are skipped".format(
+            runnum, limit))
+        with open(os.path.join(self.get_res_dir(), "timeout.txt"), 'w') as f:
+            f.write("{0:g}\nrun\t{1}\n".format(limit, runnum))
+        self.store.add_metrics(self.run_id, runnum, {"timeout": limit})
+
+    # Save times of refresh pair made around run runnum with update set num
+    # to refresh.tsv and to the results store; rf1_res and rf2_res are (secs,
+    # rows)
+    def record_refresh(self, runnum, num, rf1_res, rf2_res):
+        path = os.path.join(self.get_res_dir(), "refresh.tsv")
+        new = not os.path.isfile(path)
+        with open(path, 'a') as f:
+            if new:
+                f.write("run\tset\trf1\trf2\tinserted\tdeleted\n")
+            f.write("{0}\t{1}\t{2:.6f}\t{3:.6f}\t{4}\t{5}\n".format(
+                runnum, num, rf1_res[0], rf2_res[0], rf1_res[1], rf2_res[1]))
+        self.store.add_metrics(self.run_id, runnum, {
+            "refresh_set": num, "refresh_rf1": rf1_res[0], "refresh_rf2": rf2_res[0],
+            "refresh_inserted": rf1_res[1], "refresh_deleted": rf2_res[1]})
+        self.log("Refresh set {0}: RF1 {1:.3f} s, RF2 {2:.3f} s".format(
+            num, rf1_res[0], rf2_res[0]))
+
+    # The current query is done: summarize the runs, record the answer,
+    # capture plans and close the connection
+    def end_query(self, stop_reason):
+        self.finish_sampling(stop_reason)
+        self.record_answer(self.conn, self.query_text)
+        self.capture_plans(self.conn)
+
+        self.conn.close()
+        self.conn = None
+        self.conn_closed_hook()
+        if self.campaign is not None:
+            self.campaign.finish_query(self.pc.campaign_job, self.pc["testname"],
+                                       self.query, stop_reason)
+
+    # Stop Postgres if it is restarted for each query
+    def query_stopped(self):
+        if self.pc.restart == "query":
             self.pc.postgres_stop()
 
+    # Execute the query once as a plain query, like any client does, so that
+    # it gets the same plan, parallel included; the answer of its main
+    # statement is fetched as a whole. Two phases are timed separately: exec
+    # is execution on the server and getting all rows, including other
+    # statements of the query, fetch is converting rows to python objects.
+    # libpq returns only after the whole result has arrived, so execution and
+    # transfer of the result can't be told apart and both are in exec. Returns
+    # (exec, fetch) in ns. If timeout (secs) is given, each statement is
+    # limited by statement_timeout.
+    def execute_query(self, conn, query_text, timeout=0):
+        before, main, after = split_query(query_text)
+        fetch_ns = 0
+        with conn.cursor() as curs:
+            if timeout > 0:
+                curs.execute("select set_config('statement_timeout', %s, true)",
+                             (str(max(1, int(timeout * 1000))),))
+            exec_start = time.perf_counter_ns()
+            for stmt in before:
+                curs.execute(stmt)
+            if main is not None:
+                curs.execute(main)
+                fetch_start = time.perf_counter_ns()
+                curs.fetchall()
+                fetch_ns = time.perf_counter_ns() - fetch_start
+            for stmt in after:
+                curs.execute(stmt)
+            exec_end = time.perf_counter_ns()
+        conn.commit()
+        return exec_end - exec_start - fetch_ns, fetch_ns
+
+    # Run the query once more after the timed runs and write the answer of
+    # its main statement to answer.out, see answers.py, then verify it. The
+    # answer is streamed through a server-side cursor in batches of
+    # <fetchbatch> rows, so it is never held in memory as a whole. Postgres
+    # never runs a cursor with a parallel plan, so this run is not timed.
+    # Skipped unless recordanswers or verifyanswers is on, or if the query
+    # timed out or the campaign budget is used up.
+    def record_answer(self, conn, query_text):
+        if not self.pc.recordanswers and not self.pc.verifyanswers:
+            return
+        budget_left = self.pc.budget_left()
+        if self.timed_out or (budget_left is not None and budget_left <= 0):
+            return
+        before, main, after = split_query(query_text)
+        writer = answers.AnswerWriter(self.get_res_dir())
+        description = None
+        try:
+            with conn.cursor() as curs:
+                # plan the cursor for fetching all rows
+                curs.execute("set local cursor_tuple_fraction = 1")
+                if self.timeout > 0:
+                    curs.execute("select set_config('statement_timeout', %s, true)",
+                                 (str(max(1, int(self.timeout * 1000))),))
+                for stmt in before:
+                    curs.execute(stmt)
+            if main is not None:
+                with conn.cursor(name="pgtpch_answer") as curs:
+                    curs.execute(main)
+                    rows = curs.fetchmany(self.pc.fetchbatch)
+                    while rows:
+                        writer.write(curs.description, rows)
+                        rows = curs.fetchmany(self.pc.fetchbatch)
+                    description = curs.description
+            with conn.cursor() as curs:
+                for stmt in after:
+                    curs.execute(stmt)
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            self.log("WARN: recording the answer failed: {}".format(e))
+            return
+        finally:
+            checksum, nrows = writer.close(description)
+        self.log("Answer: {0} rows, sha256 {1}".format(nrows, checksum))
+        self.verify_answer(writer.path)
+
+    # Compare answer.out with the reference answer from dbgen, if there is one
+    # for this query and scale, and write mismatches to verify.txt
+    def verify_answer(self, answer_path):
+        if not self.pc.verifyanswers:
+            return
+        if self.pc.refresh == "interleaved":
+            self.log("Refresh functions changed the data, answer is not verified")
+            return
+        if self.run_seeds and self.run_seeds[-1] is not None:
+            self.log("Answer with random parameters, it is not verified")
+            return
+        match = re.match(r'^q(\d+)$', self.query)
+        if match is None or not 1 <= int(match.group(1)) <= 22:
+            return
+        if not answers.numpy_loaded:
+            self.log("numpy is not available, answer is not verified")
+            return
+        mismatches = answers.verify(answer_path, self.pc.dbgen_dir,
+                                    int(match.group(1)), self.pc["scale"])
+        if mismatches is None:
+            self.log("No reference answer for scale {}".format(self.pc["scale"]))
+            return
+        with open(os.path.join(self.get_res_dir(), "verify.txt"), 'w') as f:
+            for m in mismatches:
+                f.write(m + "\n")
+        if mismatches:
+            self.log("WARN: answer differs from the reference in {} places, see "
+                     "verify.txt. References are computed with the default "
+                     "substitution parameters, see prepare.sh -V".format(len(mismatches)))
+        else:
+            self.log("Answer matches the reference")
+
+    # Save plan of the query to plan.json and its fingerprint to
+    # plan.fingerprint and the results store; with explainanalyze, also run
+    # EXPLAIN (ANALYZE, BUFFERS) once and save it to plan-analyze.json.
+    # Called after the timed runs, so they are not affected, on the same
+    # connection with the same settings, and the statement is planned as a
+    # plain query like in execute_query, so the plan is the one timed. With
+    # several variants of substitution parameters, each of them is explained
+    # and saved to plan-s<seed>.json, plan.json being the first one, and
+    # plan.fingerprint combines their fingerprints, see
+    # plans.combine_fingerprints; EXPLAIN ANALYZE is made of the variant of
+    # the last run only.
+    def capture_plans(self, conn):
+        if not self.pc.explain:
+            return
+        fps = []
+        for i, (seed, query_text) in enumerate(self.variant_texts):
+            before, main, after = split_query(query_text)
+            if main is None:
+                return
+            try:
+                plan = plans.explain(conn, before, main)
+            except psycopg2.Error as e:
+                self.log("WARN: EXPLAIN failed: {}".format(e))
+                return
+            fps.append(plans.fingerprint(plan))
+            self.store.add_plan(self.run_id, fps[-1], plan, False)
+            fnames = ["plan.json"] if i == 0 else []
+            if len(self.variant_texts) > 1:
+                fnames.append("plan-s{}.json".format(seed))
+                self.log("Plan fingerprint of parameters {0}: {1}".format(seed, fps[-1]))
+            for fname in fnames:
+                with open(os.path.join(self.get_res_dir(), fname), 'w') as f:
+                    json.dump(plan, f, indent=2)
+        fp = plans.combine_fingerprints(fps)
+        with open(os.path.join(self.get_res_dir(), "plan.fingerprint"), 'w') as f:
+            f.write(fp + "\n")
+        self.log("Plan fingerprint {}".format(fp))
+
+        # don't run the query which timed out to the end
+        if not self.pc.explainanalyze or self.timed_out:
+            return
+        before, main, after = split_query(self.query_text)
+        try:
+            plan = plans.explain(conn, before, main, True)
+        except psycopg2.Error as e:
+            self.log("WARN: EXPLAIN failed: {}".format(e))
+            return
+        with open(os.path.join(self.get_res_dir(), "plan-analyze.json"), 'w') as f:
+            json.dump(plan, f, indent=2)
+        self.store.add_plan(self.run_id, plans.fingerprint(plan), plan, True)
+        self.log("EXPLAIN ANALYZE: {0:.3f} ms".format(plan[0].get("Execution Time", 0)))
+
+    # Returns None if the query must be run once more, or the reason to stop
+    def stop_reason(self, runnum):
+        budget_left = self.pc.budget_left()
+        if budget_left is not None and budget_left <= 0:
+            return "campaign time budget is used up"
+        if not self.pc.adaptive:
+            return "fixed number of runs" if runnum >= self.pc.numruns else None
+        times = self.steady_exectimes()
+        if len(times) >= self.pc.minruns:
+            halfwidth = ci_rel_halfwidth(times)
+            if halfwidth <= self.pc.citarget:
+                return "CI half-width {0:.4f} of the mean, target {1}".format(
+                    halfwidth, self.pc.citarget)
+        if runnum >= self.pc.maxruns:
+            return "maxruns {} reached".format(self.pc.maxruns)
+        if self.pc.maxtime > 0 and \
+           time.monotonic() - self.sampling_start >= self.pc.maxtime:
+            return "maxtime {} s reached".format(self.pc.maxtime)
+        return None
+
+    # Exec times of runs after warmups: at least <warmups> first runs are
+    # discarded, and in adaptive mode also the ones before the steady state
+    def steady_exectimes(self):
+        times = [(p[0] + p[1]) / 1e9 for p in self.phases]
+        skip = min(self.pc["warmups"], len(times))
+        return times[skip + steady_state_start(times[skip:], self.pc.warmuptol,
+                                               self.pc.minruns):]
+
+    # Write why we stopped to stopreason.txt; in adaptive mode also leave only
+    # the steady state runs in exectime.txt and move the rest to warmups.txt
+    def finish_sampling(self, reason):
+        self.log("Stopped after {0} runs: {1}".format(len(self.phases), reason))
+        nwarmups = 0
+        if self.pc.adaptive:
+            times = [(p[0] + p[1]) / 1e9 for p in self.phases]
+            nwarmups = len(times) - len(self.steady_exectimes())
+            with open(os.path.join(self.get_res_dir(), "warmups.txt"), 'w') as f:
+                for exectime in times[:nwarmups]:
+                    f.write("{:.6f}\n".format(exectime))
+            with open(self.exectime_path, 'w') as f:
+                for exectime in times[nwarmups:]:
+                    f.write("{:.6f}\n".format(exectime))
+            self.log("{0} warmup runs discarded, {1} kept".format(
+                nwarmups, len(times) - nwarmups))
+        with open(os.path.join(self.get_res_dir(), "stopreason.txt"), 'w') as f:
+            f.write("{0}\nruns\t{1}\n".format(reason, len(self.phases)))
+        self.store.finish_run(self.run_id, nwarmups, reason)
+        if len(self.variant_texts) > 1:
+            self.summary_variants()
+
+    # Write exec time stats of runs after warmups per parameter variant and
+    # pooled over all of them to variants.tsv and log them
+    def summary_variants(self):
+        times = self.steady_exectimes()
+        seeds = self.run_seeds[len(self.run_seeds) - len(times):]
+        by_seed = {}
+        for seed, exectime in zip(seeds, times):
+            by_seed.setdefault(seed, []).append(exectime)
+        rows = [(str(seed), by_seed[seed]) for seed, text in self.variant_texts
+                if seed in by_seed]
+        if times:
+            rows.append(("all", times))
+        with open(os.path.join(self.get_res_dir(), "variants.tsv"), 'w') as f:
+            f.write("seed\truns\tmean\tmedian\tmin\tmax\n")
+            for name, vtimes in rows:
+                f.write("{0}\t{1}\t{2:.6f}\t{3:.6f}\t{4:.6f}\t{5:.6f}\n".format(
+                    name, len(vtimes), statistics.mean(vtimes), statistics.median(vtimes),
+                    min(vtimes), max(vtimes)))
+                self.log("Parameters {0}: {1} runs, median {2:.4f} s".format(
+                    name, len(vtimes), statistics.median(vtimes)))
+
+    # Append exec + fetch time in seconds to exectime.txt and all phases to
+    # phases.tsv
+    def record_exectime(self, runnum, exec_ns, fetch_ns):
+        self.phases.append((exec_ns, fetch_ns))
+        with open(self.exectime_path, 'a') as f:
+            f.write("{:.6f}\n".format((exec_ns + fetch_ns) / 1e9))
+        phases_path = os.path.join(self.get_res_dir(), "phases.tsv")
+        new = not os.path.isfile(phases_path)
+        with open(phases_path, 'a') as f:
+            if new:
+                f.write("run\texec\tfetch\n")
+            f.write("{0}\t{1:.6f}\t{2:.6f}\n".format(runnum, exec_ns / 1e9, fetch_ns / 1e9))
+        self.store.add_sample(self.run_id, runnum, (exec_ns + fetch_ns) / 1e9,
+                              exec_ns / 1e9, fetch_ns / 1e9)
+        if self.campaign is not None:
+            self.campaign.add_unit(self.pc.campaign_job, self.pc["testname"], self.query,
+                                   runnum, exec_ns / 1e9, fetch_ns / 1e9)
+
+    # Load tables mentioned in the query text and all their indexes into
+    # shared buffers with pg_prewarm. Partitioned tables, see layout.py, are
+    # empty themselves, so their leaf partitions and the partitions' indexes
+    # are loaded instead.
+    def prewarm(self, conn, query_text):
+        words = set(re.findall(r'\w+', query_text.lower()))
+        with conn.cursor() as curs:
+            curs.execute("create extension if not exists pg_prewarm")
+            curs.execute("""
+            select c.relname::text from pg_class c
+            join pg_namespace n on n.oid = c.relnamespace
+            where c.relkind in ('r', 'p') and n.nspname = 'public'""")
+            tables = [r[0] for r in curs.fetchall() if r[0] in words]
+            curs.execute("""
+            with recursive rels (rel) as (
+              select c.oid from pg_class c
+              join pg_namespace n on n.oid = c.relnamespace
+              where c.relname = any(%s) and n.nspname = 'public'
+              union all
+              select i.inhrelid from pg_inherits i join rels on i.inhparent = rels.rel
+            ), leaves as (
+              select rels.rel from rels join pg_class c on c.oid = rels.rel
+              where c.relkind = 'r'
+            )
+            select rel::regclass::text, pg_prewarm(rel) from (
+              select rel from leaves
+              union all
+              select i.indexrelid from pg_index i join leaves on leaves.rel = i.indrelid) r""",
+                         (tables,))
+            for relname, blocks in curs.fetchall():
+                self.log("Prewarmed {0}: {1} blocks".format(relname, blocks))
+        conn.commit()
+
     # Executed after running all queries
     def postrun(self):
         pass
 
     # Executed when connection was created, conn is psycopg2 conn object
     def conn_created_hook(self, conn):
-        pass
+        self.leader_pid = conn.get_backend_pid()
 
     # Executed when connection was closed
     def conn_closed_hook(self):
@@ -243,11 +1131,83 @@ class StandardRunner(object):
 
     # Executed before the query execution
     def preexecute_hook(self, runnum):
-        pass
+        if self.pc.get("ossampler") == "true":
+            self.os_sampler = OsSampler(
+                self.leader_pid, float(self.pc.get("osinterval", 0.1)),
+                os.path.join(self.get_res_dir(), "os-{}.tsv".format(runnum)))
+            self.os_sampler.start()
+        if self.pc.get("pgsampler") == "true":
+            self.pg_sampler = PgSampler(self.pc.connect(), self.leader_pid,
+                                        float(self.pc.get("pginterval", 0.01)),
+                                        float(self.pc.get("statdelay", 1)))
+            self.pg_sampler.start()
 
     # Executed after the query execution
     def postexecute_hook(self, runnum):
-        pass
+        if self.os_sampler is not None:
+            stats = self.os_sampler.stop()
+            if self.os_sampler.error is not None:
+                self.log("WARN: OS sampler failed: {}".format(self.os_sampler.error))
+            self.os_sampler = None
+            self.record_metrics(runnum, "os", stats)
+            self.log("CPU {0} s, read {1} bytes, written {2} bytes, peak RSS {3} bytes, "
+                     "{4} major faults".format(stats["cpu"], stats["read_bytes"],
+                                              stats["write_bytes"], stats["peak_rss"],
+                                              stats["major_faults"]))
+        if self.pg_sampler is not None:
+            stats, waits, pgss = self.pg_sampler.stop()
+            if self.pg_sampler.error is not None:
+                self.log("WARN: wait events sampling failed: {}".format(
+                    self.pg_sampler.error))
+            self.pg_sampler = None
+            self.record_metrics(runnum, "pg", stats)
+            self.record_waits(runnum, waits)
+            self.record_pgss(runnum, pgss)
+            self.log("Buffers hit {0:.0f}, read {1:.0f}, temp files {2:.0f} of {3:.0f} bytes".format(
+                stats.get("db_blks_hit", 0), stats.get("db_blks_read", 0),
+                stats.get("db_temp_files", 0), stats.get("db_temp_bytes", 0)))
+
+    # Save wait event samples of run runnum to waits-<runnum>.tsv, and share
+    # of each wait event type to the results store
+    def record_waits(self, runnum, waits):
+        total = max(1, sum(waits.values()))
+        shares = {}
+        with open(os.path.join(self.get_res_dir(), "waits-{}.tsv".format(runnum)), 'w') as f:
+            f.write("role\twait_event_type\twait_event\tsamples\tshare\n")
+            for (role, wtype, wevent), samples in sorted(waits.items(), key=lambda w: -w[1]):
+                f.write("{0}\t{1}\t{2}\t{3}\t{4:.4f}\n".format(
+                    role, wtype, wevent, samples, samples / total))
+                key = "pgwait_{}".format(wtype)
+                shares[key] = shares.get(key, 0) + samples / total
+        self.store.add_metrics(self.run_id, runnum, shares)
+        if shares:
+            self.log("Wait event types: {}".format(', '.join(
+                "{0} {1:.1f}%".format(k[len("pgwait_"):], v * 100)
+                for k, v in sorted(shares.items(), key=lambda kv: -kv[1]))))
+
+    # Save pg_stat_statements deltas of run runnum to pgss-<runnum>.tsv
+    def record_pgss(self, runnum, pgss):
+        if not pgss:
+            return
+        cols = sorted({col for queryid, query, d in pgss for col in d})
+        with open(os.path.join(self.get_res_dir(), "pgss-{}.tsv".format(runnum)), 'w') as f:
+            f.write('\t'.join(["queryid"] + cols + ["query"]) + '\n')
+            for queryid, query, d in pgss:
+                f.write('\t'.join([str(queryid)] + ["{:g}".format(d.get(c, 0)) for c in cols] +
+                                  [' '.join(query.split())[:200]]) + '\n')
+
+    # Save dict of numbers describing run runnum to <kind>.tsv, one row per
+    # run, and to the results store, names prefixed with kind
+    def record_metrics(self, runnum, kind, metrics):
+        names = sorted(metrics)
+        path = os.path.join(self.get_res_dir(), "{}.tsv".format(kind))
+        new = not os.path.isfile(path)
+        with open(path, 'a') as f:
+            if new:
+                f.write('\t'.join(["run"] + names) + '\n')
+            f.write('\t'.join(str(v) for v in [runnum] + [metrics[n] for n in names]) + '\n')
+        self.store.add_metrics(self.run_id, runnum, {
+            "{0}_{1}".format(kind, name): value for name, value in metrics.items()})
 
     # get res dir of current query
     def get_res_dir(self):
@@ -264,11 +1224,12 @@ class StandardRunner(object):
     def log(self, msg):
         msg_fmt = '{0:%Y-%m-%d %H:%M:%S} '.format(datetime.datetime.now()) + msg
         print(msg_fmt)
-        (echo[msg_fmt] >> os.path.join(self.get_res_dir(), "log.txt"))()
+        with open(os.path.join(self.get_res_dir(), "log.txt"), 'a') as f:
+            f.write(msg_fmt + "\n")
 
     # Calculate avg and error and log them
     def summary_exectime(self):
-        if not scipy_loaded:
+        if not scipy_loaded or not self.phases:
             return
         exectimes = []
         with open(self.exectime_path) as f:
@@ -282,14 +1243,136 @@ class StandardRunner(object):
         ci = [exectimes_mean + crit_val * standard_deviation / math.sqrt(len(exectimes))
               for crit_val in t_bounds]
         self.log("Mean exec time: {0:.2f}".format(exectimes_mean))
+        if self.phases:
+            means = [average([p[i] for p in self.phases]) / 1e9 for i in range(2)]
+            self.log("Mean phases: exec {0:.4f}, fetch {1:.4f}".format(means[0], means[1]))
         self.log("0.95 confidence interval, assuming T-student distribution: {0:.2f}, {1:.2f}\n".format(ci[0], ci[1]))
 
 
+# Initializer of post-processing processes of PerfRunner: they work while the
+# next runs are timed, so they get niceness and, if cpus are given, are
+# pinned to them, off the cores Postgres runs on. perf script and other
+# commands they start inherit both.
+def postproc_init(niceness, cpus):
+    os.nice(niceness)
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+
+
+# Post-processing of perf data of one run, runs in PerfRunner's pool. perfdatas
+# is list of (perf data path, pid, role), role is 'leader' or 'worker'. perf
+# script output of each is folded, with the role as the root frame, saving it
+# too if script_prefix is given, and the stacks are summed into folded_path.
+# Samples per process are written to procs_path. Flamegraph of the run is
+# rendered if svg is given. Returns list of messages for fg_log.txt.
+def postprocess_run(perfdatas, folded_path, procs_path, script_prefix, rmperfdata,
+                    fg_path, svg):
+    msgs = []
+    counts = {}
+    procs = []
+    for perfdata, pid, role in perfdatas:
+        script_path = None
+        if script_prefix is not None:
+            script_path = "{0}{1}.perf-script".format(
+                script_prefix, "" if role == "leader" else ".w{}".format(pid))
+        proc_counts, script_stderr = folded.fold_perfdata(perfdata, script_path,
+                                                          rmperfdata, role)
+        if script_stderr:
+            msgs.append(script_stderr)
+        folded.add_counts(counts, proc_counts)
+        procs.append((pid, role, sum(proc_counts.values())))
+    folded.write_folded(counts, folded_path)
+    total = max(1, sum(p[2] for p in procs))
+    with open(procs_path, 'w') as f:
+        f.write("pid\trole\tsamples\tshare\n")
+        for pid, role, samples in procs:
+            f.write("{0}\t{1}\t{2}\t{3:.4f}\n".format(pid, role, samples, samples / total))
+    if svg is not None:
+        try:
+            msgs.append(folded.render_flamegraph(fg_path, folded_path, svg))
+        except subprocess.CalledProcessError as e:
+            msgs.append("flamegraph of {0} failed: {1}".format(folded_path, e.stderr))
+    return msgs
+
+
+# Thread attaching perf record to parallel workers of the leader backend as
+# they appear. Workers are found by polling pg_stat_activity on a separate
+# connection: by leader_pid since Postgres 13, and as all parallel workers
+# before that, since nothing else runs during the measurement. Workers of
+# very short Gather nodes might be missed or caught partially, as perf needs
+# some time to attach.
+class WorkerWatcher(threading.Thread):
+    # perf_cmd(pid) returns (perf record command, perf data path)
+    def __init__(self, pc, leader_pid, perf_cmd, perf_log, poll):
+        super().__init__()
+        self.pc = pc
+        self.leader_pid = leader_pid
+        self.perf_cmd = perf_cmd
+        self.perf_log = perf_log
+        self.poll = poll
+        self.stop_event = threading.Event()
+        # pid -> (perf Popen, perf data path)
+        self.workers = {}
+        self.error = None
+
+    def run(self):
+        try:
+            conn = self.pc.connect()
+            conn.autocommit = True
+            try:
+                with conn.cursor() as curs:
+                    if conn.server_version >= 130000:
+                        sql = "select pid from pg_stat_activity where leader_pid = %s and pid != %s"
+                        params = (self.leader_pid, self.leader_pid)
+                    else:
+                        sql = "select pid from pg_stat_activity where backend_type = 'parallel worker'"
+                        params = None
+                    while not self.stop_event.is_set():
+                        curs.execute(sql, params)
+                        for (pid,) in curs.fetchall():
+                            if pid not in self.workers:
+                                self.attach(pid)
+                        self.stop_event.wait(self.poll)
+            finally:
+                conn.close()
+        except Exception as e:
+            self.error = e
+
+    def attach(self, pid):
+        cmd, perfdata = self.perf_cmd(pid)
+        self.workers[pid] = (subprocess.Popen(cmd, stdout=self.perf_log,
+                                              stderr=subprocess.STDOUT),
+                             perfdata)
+
+    # stop watching and perf records of workers still alive; returns list of
+    # (pid, perf data path)
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        for pid, (popen, perfdata) in self.workers.items():
+            if popen.poll() is None:
+                sudo[kill["-2", popen.pid]](retcode=None)
+            popen.wait()
+        return [(pid, perfdata) for pid, (popen, perfdata) in self.workers.items()
+                if os.path.isfile(perfdata)]
+
+
 class PerfRunner(StandardRunner):
     def __init__(self, pc):
         self.backend_pid = None
         self.perf_record_log = None
         self.perf_popen = None
+        self.watcher = None
+        # perf script and folding of each run is done in background, so that
+        # the next run doesn't wait for it, at low priority, so that it
+        # doesn't compete with it. Created before any connections are opened.
+        postproc_cpus = None
+        if pc.get("postproccpus") is not None:
+            postproc_cpus = parse_cpulist(pc["postproccpus"])
+        self.pool = multiprocessing.Pool(int(pc.get("postprocjobs", 2)), postproc_init,
+                                         (int(pc.get("postprocnice", 19)), postproc_cpus))
+        # list of (query, res dir, list of AsyncResults of postprocess_run)
+        self.postproc = []
 
         print("Exposing kernel pointers for seamless perfing")
         (echo["0"] | sudo[tee["/proc/sys/kernel/kptr_restrict"]] > "/dev/null")()
@@ -301,41 +1384,151 @@ class PerfRunner(StandardRunner):
         self.backend_pid = str(conn.get_backend_pid())
         perf_record_log_path  = os.path.join(self.get_res_dir(), "perf_record_log.txt")
         self.perf_record_log = open(perf_record_log_path, 'w')
+        self.postproc.append((self.query, self.get_res_dir(), []))
         print("Backend pid is {0}".format(self.backend_pid))
 
-    # start perf
+    def perf_record_cmd(self, pid, perfdata):
+        perf_record_cmd = ["sudo", "perf", "record", "-p", str(pid), "-o", perfdata]
+        if (self.pc.get("perfrecopts") is not None):
+            perf_record_cmd.extend(self.pc["perfrecopts"].split())
+        return perf_record_cmd
+
+    # start perf, and the watcher attaching it to parallel workers
     def preexecute_hook(self, runnum):
         super(PerfRunner, self).preexecute_hook(runnum)
         assert(self.backend_pid is not None)
-        perf_record_cmd = ["sudo", "perf", "record", "-p", self.backend_pid,
-                           "-o", self.get_perfdata_path(runnum)]
-        if (self.pc.get("perfrecopts") is not None):
-            perf_record_cmd.extend(self.pc["perfrecopts"].split())
+        perf_record_cmd = self.perf_record_cmd(self.backend_pid,
+                                               self.get_perfdata_path(runnum))
         self.log("Running {}".format(' '.join(perf_record_cmd)))
         self.perf_popen = subprocess.Popen(perf_record_cmd,
                                            stdout=self.perf_record_log,
                                            stderr=subprocess.STDOUT)
+        if self.pc.get("perfworkers", "true") == "true":
+            def worker_perf_cmd(pid):
+                perfdata = self.get_perfdata_path(runnum, pid)
+                return self.perf_record_cmd(pid, perfdata), perfdata
+            self.watcher = WorkerWatcher(self.pc, int(self.backend_pid),
+                                         worker_perf_cmd, self.perf_record_log,
+                                         float(self.pc.get("workerpoll", 0.01)))
+            self.watcher.start()
         time.sleep(1)  # let perf start up
 
-    # stop perf
+    # stop perf and queue post-processing of its data
     def postexecute_hook(self, runnum):
         super(PerfRunner, self).postexecute_hook(runnum)
         assert(self.backend_pid is not None)
         sudo[kill["-2", self.perf_popen.pid]]()
         self.perf_popen.wait()
+        perfdatas = [(self.get_perfdata_path(runnum), int(self.backend_pid), "leader")]
+        if self.watcher is not None:
+            workers = self.watcher.stop()
+            if self.watcher.error is not None:
+                self.log("WARN: watching parallel workers failed: {}".format(
+                    self.watcher.error))
+            self.watcher = None
+            perfdatas.extend((perfdata, pid, "worker") for pid, perfdata in workers)
+            self.log("Profiled {} parallel workers".format(len(workers)))
         self.log("Perf record stopped")
-        if (self.pc.get("perfscript") == "true" or self.pc.get("flamegraph") == "true"):
-            self.generate_perfscript(runnum)
-            if (self.pc.get("flamegraph") == "true"):
-                self.generate_flamegraph(runnum)
-
+        if self.folding_enabled():
+            for perfdata, pid, role in perfdatas:
+                (sudo[chown[getpass.getuser(), perfdata]])()
+            script_prefix = None
+            if self.pc.get("perfscript") == "true":
+                script_prefix = os.path.join(self.get_res_dir(), "perf-{}".format(runnum))
+            svg = None
+            if self.pc.get("flamegraph") == "true":
+                svg = os.path.join(self.get_res_dir(),
+                                   "{0}-{1}.svg".format(self.query, runnum))
+            self.postproc[-1][2].append(self.pool.apply_async(
+                postprocess_run,
+                (perfdatas, self.get_folded_path(runnum),
+                 self.get_procs_path(runnum), script_prefix,
+                 self.pc.get("rmperfdata") == "true", self.pc.get("fg_path"), svg)))
+
+    def folding_enabled(self):
+        return self.pc.get("perfscript") == "true" or \
+            self.pc.get("flamegraph") == "true" or \
+            self.pc.get("foldedprofiles") == "true"
 
     # close perf log
     def conn_closed_hook(self):
         super(PerfRunner, self).conn_closed_hook()
         self.perf_record_log.close()
 
-    def get_res_dir(self):
+    # wait for post-processing of all queries and merge their profiles
+    def postrun(self):
+        super(PerfRunner, self).postrun()
+        self.pool.close()
+        for query, res_dir, results in self.postproc:
+            self.query = query
+            self.finish_postprocessing(res_dir, results)
+        self.pool.join()
+
+    # Merge folded profiles of all runs of the current query into
+    # <query>.folded and render it, and differential flamegraph against the
+    # same query of <perfref> test, if its profile exists
+    def finish_postprocessing(self, res_dir, results):
+        fl_log = os.path.join(res_dir, "fg_log.txt")
+        for result in results:
+            try:
+                for msg in result.get():
+                    self.append_log(fl_log, msg)
+            except Exception as e:
+                self.log("perf data post-processing failed: {}".format(e))
+        folded_paths = sorted(glob(os.path.join(res_dir, "perf-*.folded")))
+        if not folded_paths:
+            return
+        merged = folded.merge_folded(folded_paths, self.get_merged_folded_path())
+        self.log("Folded profiles of {0} runs merged into {1}".format(
+            len(folded_paths), merged))
+        self.summarize_procs(res_dir)
+        if self.pc.get("flamegraph") != "true":
+            return
+        self.render(merged, os.path.join(res_dir, "{}.svg".format(self.query)),
+                    fl_log)
+        ref_test = self.pc.get("perfref")
+        if ref_test is not None and ref_test != self.pc["testname"]:
+            ref_merged = self.get_merged_folded_path(ref_test)
+            if not os.path.isfile(ref_merged):
+                self.log("No profile of {0} for {1} to diff with".format(
+                    ref_test, self.query))
+                return
+            diff = folded.diff_folded(ref_merged, merged, os.path.join(
+                res_dir, "{0}-diff-{1}.folded".format(self.query, ref_test)))
+            self.render(diff, os.path.join(res_dir, "{0}-diff-{1}.svg".format(
+                self.query, ref_test)), fl_log)
+
+    # Sum samples per process role over all runs into <query>.procs.tsv, so
+    # it is seen how much of the query CPU time went to parallel workers
+    def summarize_procs(self, res_dir):
+        roles = {}
+        for path in glob(os.path.join(res_dir, "perf-*.procs.tsv")):
+            with open(path) as f:
+                next(f)  # header
+                for line in f:
+                    pid, role, samples, share = line.split('\t')
+                    st = roles.setdefault(role, [0, 0])
+                    st[0] += 1
+                    st[1] += int(samples)
+        total = max(1, sum(st[1] for st in roles.values()))
+        with open(os.path.join(res_dir, "{}.procs.tsv".format(self.query)), 'w') as f:
+            f.write("role\tprocesses\tsamples\tshare\n")
+            for role, (nprocs, samples) in sorted(roles.items()):
+                f.write("{0}\t{1}\t{2}\t{3:.4f}\n".format(role, nprocs, samples,
+                                                          samples / total))
+                self.log("{0}: {1} processes, {2:.1f}% of samples".format(
+                    role, nprocs, samples / total * 100))
+
+    def render(self, folded_path, svg, fl_log):
+        self.log("Rendering {}".format(svg))
+        try:
+            self.append_log(fl_log, folded.render_flamegraph(
+                self.pc["fg_path"], folded_path, svg))
+        except subprocess.CalledProcessError as e:
+            self.append_log(fl_log, e.stderr)
+            self.log("flamegraph failed, check out fg_log.txt")
+
+    def get_res_dir(self, testname=None):
         if self.pc.get("resdir_prefix") is not None:
             prefix = "{}-".format(self.pc["resdir_prefix"])
         else:
@@ -343,72 +1536,337 @@ class PerfRunner(StandardRunner):
 
         return os.path.join("perf_res", "{0}{1}-{2}-{3}".format(
             prefix,
-            self.pc["testname"], self.query, self.pc["scale"]))
+            testname if testname is not None else self.pc["testname"],
+            self.query, self.pc["scale"]))
+
+    def append_log(self, path, text):
+        with open(path, 'a') as f:
+            f.write(text + "\n")
+
+    # perf.data file path for run number runnum, of the leader or of parallel
+    # worker with pid worker
+    def get_perfdata_path(self, runnum, worker=None):
+        if worker is None:
+            return os.path.join(self.get_res_dir(), "perf-{}.data".format(runnum))
+        return os.path.join(self.get_res_dir(), "perf-{0}.w{1}.data".format(runnum, worker))
+
+    # samples per process of run number runnum
+    def get_procs_path(self, runnum):
+        return os.path.join(self.get_res_dir(), "perf-{}.procs.tsv".format(runnum))
+
+    # folded profile of run number runnum
+    def get_folded_path(self, runnum):
+        return os.path.join(self.get_res_dir(), "perf-{}.folded".format(runnum))
+
+    # folded profile of all runs of the current query of testname, by default
+    # of the current test
+    def get_merged_folded_path(self, testname=None):
+        return os.path.join(self.get_res_dir(testname), "{}.folded".format(self.query))
+
+
+# Run one stream of the throughput test: execute the queries one after another
+# on a separate connection. stream_queries is a list of (query name, query
+# text); refresh functions are given as ("RF1" or "RF2", update set number) and
+# run with update sets sets. Each query is limited like a run of standard
+# runner, see PgtpchConf.run_limit; if one is cancelled, the rest of the
+# stream is skipped. Runs in a pool worker, returns (list of (query name,
+# start, exec time), cancel), start is relative to stream_start, cancel is
+# (query name, limit, by_budget) of the cancelled query or None.
+def run_stream(pc, stream_queries, sets=None):
+    res = []
+    conn = pc.connect()
+    try:
+        if pc.get("precmdfile") is not None:
+            with open(pc["precmdfile"]) as f, conn.cursor() as curs:
+                curs.execute(f.read())
+            conn.commit()
+        pc.set_gucs(conn)
+        pid = conn.get_backend_pid()
+        stream_start = time.perf_counter()
+        for query, query_text in stream_queries:
+            limit, by_budget = pc.run_limit(query)
+            watchdog = None
+            if limit > 0:
+                watchdog = CancelWatchdog(pc, pid, limit)
+                watchdog.start()
+            starttime = time.perf_counter()
+            try:
+                if query == "RF1":
+                    rf1(conn, sets, query_text)
+                elif query == "RF2":
+                    rf2(conn, sets, query_text)
+                else:
+                    with conn.cursor() as curs:
+                        if limit > 0:
+                            curs.execute("select set_config('statement_timeout', %s, true)",
+                                         (str(max(1, int(limit * 1000))),))
+                        curs.execute(query_text)
+                    conn.commit()
+            except psycopg2.extensions.QueryCanceledError:
+                conn.rollback()
+                return res, (query, limit, by_budget)
+            finally:
+                if watchdog is not None:
+                    watchdog.stop()
+                    if watchdog.error is not None:
+                        print("WARN: cancelling {0} failed: {1}".format(query, watchdog.error))
+            res.append((query, starttime - stream_start,
+                        time.perf_counter() - starttime))
+    finally:
+        conn.close()
+    return res, None
+
+
+# TPC-H power and throughput tests. Power test runs the 22 queries of stream 0
+# alone; throughput test then runs <streams> concurrent streams, each with its
+# own connection, permutation of queries and qgen seed. With refresh = stream,
+# power test is preceded by RF1 and followed by RF2, and throughput test also
+# runs the refresh stream of <streams> refresh pairs, as the spec requires.
+class ThroughputRunner(StandardRunner):
+    def __init__(self, pc):
+        super().__init__(pc)
+        self.streams = int(self.pc.get("streams", 2))
+        self.dbgen_dir = os.path.abspath(self.pc["dbgenpath"])
+        if self.pc.get("seed") is not None:
+            self.seed = int(self.pc["seed"])
+        else:
+            # like the spec proposes, timestamp in mmddhhmmss format
+            self.seed = int('{0:%m%d%H%M%S}'.format(datetime.datetime.now()))
+        self.permutations = self.read_permutations()
+        self.query = "throughput"
+        self.with_refresh = self.pc.refresh == "stream"
+
+    # Parse the spec's per-stream permutations of queries from dbgen's permute.h
+    def read_permutations(self):
+        with open(os.path.join(self.dbgen_dir, "permute.h")) as f:
+            text = f.read()
+        table = text[text.index("permutation["):]
+        rows = re.findall(r'\{([\d\s,]+)\}', table)
+        return [[int(q) for q in row.split(',')] for row in rows]
+
+    # Generate queries of streams 0..<streams> with qgen in parallel, returns
+    # dict stream -> list of (query name, query text) in the stream order
+    def gen_streams_queries(self):
+        calls = []
+        names = []
+        for stream in range(self.streams + 1):
+            permutation = self.permutations[stream % len(self.permutations)]
+            for pos, qnum in enumerate(permutation, 1):
+                # with stream, qgen generates query at position pos of the
+                # stream permutation and uses stream number in the names of
+                # views
+                calls.append({"qnum": pos, "stream": stream, "seed": self.seed + stream})
+                names.append((stream, "q{:02d}".format(qnum)))
+        texts = paramsets.qgen_many(self.dbgen_dir, self.pc["scale"], calls)
+        all_queries = {}
+        for (stream, query), query_text in zip(names, texts):
+            all_queries.setdefault(stream, []).append((query, query_text))
+        return all_queries
 
-    # perf.data file path for run number runnum
-    def get_perfdata_path(self, runnum):
-        return os.path.join(self.get_res_dir(), "perf-{}.data".format(runnum))
-
-    # run perf script and put it to out-<runnum>.perf-script
-    def generate_perfscript(self, runnum):
-        fl_log = os.path.join(self.get_res_dir(), "fg_log.txt")
-        perfdata = self.get_perfdata_path(runnum)
-
-        (sudo[chown[getpass.getuser(), perfdata]])()
-        cmd = (perf["script", "-i", perfdata] > "out-{0}.perf-script".format(runnum))
-        self.log("Running {}".format(cmd))
-        # seemingly plumbum doesn't allows to append-redirect stderr to file,
-        # so we will capture it and send to log manually
-        retcode, out, script_stderr = cmd.run(retcode=None)
-        (echo[script_stderr] >> fl_log)()
-
-    # generate flamegraph and put it to <query>-<runnum>.svg
-    def generate_flamegraph(self, runnum):
-        fl_log = os.path.join(self.get_res_dir(), "fg_log.txt")
-
-        # stackcollapse
-        st_pl = os.path.join(self.pc["fg_path"], "stackcollapse-perf.pl")
-        perfdata = self.get_perfdata_path(runnum)
-        folded = "out.perf-folded"
-
-        fold = cat["out-{0}.perf-script".format(runnum)] | local[st_pl] > folded
-        self.log("Running {}".format(fold))
-        # seemingly plumbum doesn't allows to append-redirect stderr to file,
-        # so we will capture it and send to log manually
-        retcode, out, fold_stderr = fold.run(retcode=None)
-        (echo[fold_stderr] >> fl_log)()
-
-        # remove perf.data, if needed
-        if (self.pc.get("rmperfdata")  == "true"):
-            rm("-f", perfdata)
-        if retcode != 0:
-            self.log("stackcollapse-perf failed, check out fg_log.txt")
-            return
+    def run(self):
+        res_dir = self.get_res_dir()
+        print("Creating directory {}".format(res_dir))
+        shutil.rmtree(res_dir, True)
+        os.makedirs(res_dir)
 
-        # and generate
-        fl_pl = os.path.join(self.pc["fg_path"], "flamegraph.pl")
-        svg = os.path.join(self.get_res_dir(), "{0}-{1}.svg".format(self.query, runnum))
-        fl = local[fl_pl][folded] > svg
-        self.log("Running {}".format(fl))
-        retcode, out, fl_stderr = fl.run(retcode=None)
-        (echo[fl_stderr] >> fl_log)()
-        rm(folded)
-        if retcode != 0:
-            self.log("flamegraph failed, check out fg_log.txt")
+        all_queries = self.gen_streams_queries()
+        for stream in range(self.streams + 1):
+            with open(os.path.join(res_dir, "stream-{}.sql".format(stream)), 'w') as f:
+                for query, query_text in all_queries[stream]:
+                    f.write("-- {}\n{}\n".format(query, query_text))
+
+        if self.pc.restart == "never":
+            self.pc.wait_ready()
+        else:
+            self.pc.postgres_start(drop_caches=self.pc.cachemode == "cold")
+        streams_args = [(self.pc, all_queries[s]) for s in range(1, self.streams + 1)]
+        power_queries = all_queries[0]
+        if self.with_refresh:
+            # take all sets upfront to fail early if there are not enough
+            sets = self.refresh_sets
+            nums = [sets.take() for i in range(self.streams + 1)]
+            power_queries = [("RF1", nums[0])] + power_queries + [("RF2", nums[0])]
+            refresh_queries = [(rf, num) for num in nums[1:] for rf in ("RF1", "RF2")]
+            streams_args.append((self.pc, refresh_queries, sets))
+        try:
+            try:
+                conn = self.pc.connect()
+                try:
+                    self.run_id = self.store.add_run(self.pc.conf_dict, self.query, res_dir,
+                                                     env_metadata(conn, self.pc.pg_bin))
+                finally:
+                    conn.close()
+
+                self.log("Power test, seed {}".format(self.seed))
+                power_res, cancel = run_stream(self.pc, power_queries, self.refresh_sets)
+                self.write_stream_res(0, power_res)
+                # (stream, cancel) of cancelled streams; the power test is 0
+                cancels = [(0, cancel)] if cancel is not None else []
+
+                # without the power test the metrics can't be computed anyway
+                if not cancels:
+                    self.log("Throughput test, {} streams".format(self.streams))
+                    tput_start = time.perf_counter()
+                    with multiprocessing.Pool(len(streams_args)) as pool:
+                        streams_res = pool.starmap(run_stream, streams_args)
+                    tput_elapsed = time.perf_counter() - tput_start
+                    tput_res = [stream_res for stream_res, cancel in streams_res]
+                    cancels = [(stream, cancel) for stream, (stream_res, cancel)
+                               in enumerate(streams_res, 1) if cancel is not None]
+                    for stream, stream_res in enumerate(tput_res[:self.streams], 1):
+                        self.write_stream_res(stream, stream_res)
+                    if self.with_refresh:
+                        self.write_stream_res("refresh", tput_res[-1])
+            finally:
+                if self.pc.restart != "never":
+                    self.pc.postgres_stop()
+                self.pc.cleanup()
+
+            if cancels:
+                self.record_cancels(cancels)
+            else:
+                self.store_results(power_res, tput_res,
+                                   self.summary(power_res, tput_res, tput_elapsed))
+        finally:
+            self.store.close()
+        self.finish_job()
+        self.postrun()
+
+    # Queries were cancelled, cancels is list of (stream, (query, limit,
+    # by_budget)), stream 0 being the power test and <streams> + 1 the refresh
+    # stream: the tests are incomplete and the metrics are not computed. Hit
+    # timeouts are written to timeout.txt and the results store, like
+    # StandardRunner.record_timeout does.
+    def record_cancels(self, cancels):
+        timeouts = []
+        for stream, (query, limit, by_budget) in cancels:
+            if by_budget:
+                self.log("Stream {0}: {1} cancelled after {2:.1f} s, campaign time budget "
+                         "is used up".format(stream, query, limit))
+            else:
+                self.log("Stream {0}: {1} cancelled: timeout {2:g} s, the rest of the stream "
+                         "is skipped".format(stream, query, limit))
+                timeouts.append((stream, query, limit))
+                self.store.add_metrics(self.run_id, stream, {"timeout": limit})
+        if timeouts:
+            with open(os.path.join(self.get_res_dir(), "timeout.txt"), 'w') as f:
+                f.write("{0:g}\n".format(max(t[2] for t in timeouts)))
+                for stream, query, limit in timeouts:
+                    f.write("stream\t{0}\t{1}\t{2:g}\n".format(stream, query, limit))
+            reason = "timeout of {0} in stream {1}".format(timeouts[0][1], timeouts[0][0])
+        else:
+            reason = "campaign time budget is used up"
+        self.store.finish_run(self.run_id, 0, reason)
+        self.log("Tests are incomplete, metrics are not computed")
+
+    # Save the tests to the results store as one run of query 'throughput':
+    # run 0 is the power test, runs 1..<streams> are the query streams of the
+    # throughput test, each with its time as the sample, and run <streams> + 1
+    # is the refresh stream, if any. Times of queries are metrics named after
+    # them, repeated names get _<n> suffix, e.g. RF1_2; metrics of run 0 also
+    # include the summary.
+    def store_results(self, power_res, tput_res, summary):
+        for runnum, stream_res in enumerate([power_res] + tput_res):
+            metrics = {}
+            for query, start, exectime in stream_res:
+                name, n = query, 1
+                while name in metrics:
+                    n += 1
+                    name = "{0}_{1}".format(query, n)
+                metrics[name] = exectime
+            if 1 <= runnum <= self.streams:
+                stream_time = sum(r[2] for r in stream_res)
+                self.store.add_sample(self.run_id, runnum, stream_time, stream_time, 0)
+            self.store.add_metrics(self.run_id, runnum, metrics)
+        self.store.add_metrics(self.run_id, 0, dict(summary, seed=self.seed))
+        self.store.finish_run(self.run_id, 0, "throughput test done")
+
+    # Save (query, start, exectime) of stream to stream-<stream>.tsv
+    def write_stream_res(self, stream, stream_res):
+        path = os.path.join(self.get_res_dir(), "stream-{}.tsv".format(stream))
+        with open(path, 'w') as f:
+            for query, start, exectime in stream_res:
+                f.write("{0}\t{1:.6f}\t{2:.6f}\n".format(query, start, exectime))
+        self.log("Stream {0} done in {1:.2f} s".format(
+            stream, sum(r[2] for r in stream_res)))
+
+    # Compute TPC-H Power@Size, Throughput@Size and QphH@Size and log them
+    # along with per-query latencies across the streams. Without refresh
+    # functions, Power@Size is geometric mean over the queries only. Returns
+    # the metrics as dict.
+    def summary(self, power_res, tput_res, tput_elapsed):
+        scale = float(self.pc["scale"])
+        nqueries = len([r for r in power_res if r[0] not in ("RF1", "RF2")])
+        timings = [r[2] for r in power_res]
+        # as the spec says, if the longest query is more than 1000 times
+        # longer than the shortest, the short ones are increased
+        floor = max(timings) / 1000
+        timings = [max(t, floor) for t in timings]
+        geomean = math.exp(sum(math.log(t) for t in timings) / len(timings))
+        power = 3600 * scale / geomean
+        throughput = self.streams * nqueries * 3600 / tput_elapsed * scale
+        qphh = math.sqrt(power * throughput)
+
+        per_query = {}
+        for stream_res in tput_res:
+            for query, start, exectime in stream_res:
+                per_query.setdefault(query, []).append(exectime)
+        with open(os.path.join(self.get_res_dir(), "queries.tsv"), 'w') as f:
+            f.write("query\tpower\tstreams min\tstreams avg\tstreams max\n")
+            for query, start, exectime in sorted(power_res):
+                times = per_query.get(query, [])
+                f.write("{0}\t{1:.6f}\t{2:.6f}\t{3:.6f}\t{4:.6f}\n".format(
+                    query, exectime, min(times), sum(times) / len(times), max(times)))
+
+        with open(os.path.join(self.get_res_dir(), "summary.txt"), 'w') as f:
+            f.write("scale\t{}\n".format(self.pc["scale"]))
+            f.write("streams\t{}\n".format(self.streams))
+            f.write("seed\t{}\n".format(self.seed))
+            f.write("refresh\t{}\n".format("true" if self.with_refresh else "false"))
+            f.write("throughput interval\t{:.6f}\n".format(tput_elapsed))
+            f.write("Power@Size\t{:.2f}\n".format(power))
+            f.write("Throughput@Size\t{:.2f}\n".format(throughput))
+            f.write("QphH@Size\t{:.2f}\n".format(qphh))
+        self.log("Throughput interval: {:.2f} s".format(tput_elapsed))
+        self.log("Power@Size: {:.2f}".format(power))
+        self.log("Throughput@Size: {:.2f}".format(throughput))
+        self.log("QphH@Size: {:.2f}\n".format(qphh))
+        return {"power_size": power, "throughput_size": throughput, "qphh_size": qphh,
+                "throughput_interval": tput_elapsed}
 
 
 if __name__ == "__main__":
-    with open("tmp_conf.json") as f:
+    parser = argparse.ArgumentParser(description="""
+    Test single Postgres installation, see the top of this file.
+    """)
+    parser.add_argument("--conf", default="tmp_conf.json",
+                        help="config to run, removed after reading")
+    parser.add_argument("--serve", action="store_true",
+                        help="""
+                        Run queries as commanded on stdin by run.py's
+                        interleaving scheduler instead of all at once, see
+                        StandardRunner.serve
+                        """)
+    args = parser.parse_args()
+    with open(args.conf) as f:
         conf = json.load(f)
-    rm("tmp_conf.json")
+    rm(args.conf)
     pc = PgtpchConf(conf)
 
     if pc["runner"] == "standard":
         runner = StandardRunner(pc)
     elif pc["runner"] == "perfer":
         runner = PerfRunner(pc)
+    elif pc["runner"] == "throughput":
+        runner = ThroughputRunner(pc)
     else:
         print("Wrong runner: {}".format(pc["runner"]))
         sys.exit(1)
 
-    runner.run()
+    if args.serve:
+        if pc["runner"] == "throughput":
+            print("Runner {} can't be interleaved".format(pc["runner"]))
+            sys.exit(1)
+        runner.serve()
+    else:
+        runner.run()
@@ -0,0 +1,102 @@
+# Splitting the machine into isolated slices for run.py --slices: each slice
+# gets its own set of whole cores of one NUMA node, so hyperthread siblings
+# and memory controllers are not shared between slices. Commands are pinned to
+# the slice with numactl (cpus and local memory) if it is installed, or with
+# taskset (cpus only) otherwise; everything they start, including Postgres
+# started by pg_ctl, inherits the binding.
+
+import os
+import glob
+import shutil
+
+
+# Parse cpulist like '0-3,8,10-11'
+def parse_cpulist(cpulist):
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus):
+    return ','.join(str(c) for c in sorted(cpus))
+
+
+# Returns dict NUMA node -> list of cores, each core is a sorted tuple of
+# its cpus (hyperthreads). Only cpus we are allowed to run on are included.
+def numa_cores():
+    allowed = os.sched_getaffinity(0)
+    nodes = {}
+    node_dirs = glob.glob("/sys/devices/system/node/node[0-9]*")
+    if node_dirs:
+        for node_dir in node_dirs:
+            with open(os.path.join(node_dir, "cpulist")) as f:
+                cpus = [c for c in parse_cpulist(f.read()) if c in allowed]
+            if cpus:
+                nodes[int(os.path.basename(node_dir)[len("node"):])] = cpus
+    else:
+        nodes[0] = sorted(allowed)
+    res = {}
+    for node, cpus in nodes.items():
+        cores = set()
+        for cpu in cpus:
+            try:
+                with open("/sys/devices/system/cpu/cpu{}/topology/thread_siblings_list".format(cpu)) as f:
+                    siblings = [c for c in parse_cpulist(f.read()) if c in allowed]
+            except OSError:
+                siblings = [cpu]
+            cores.add(tuple(sorted(siblings)))
+        res[node] = sorted(cores)
+    return res
+
+
+class Slice(object):
+    def __init__(self, num, node, cpus, port):
+        self.num = num
+        self.node = node
+        self.cpus = cpus
+        self.port = port
+        self.name = "slice{}".format(num)
+
+    # cmd pinned to the slice
+    def wrap(self, cmd):
+        if shutil.which("numactl") is not None:
+            return ["numactl", "--physcpubind={}".format(format_cpulist(self.cpus)),
+                    "--membind={}".format(self.node)] + cmd
+        return ["taskset", "-c", format_cpulist(self.cpus)] + cmd
+
+    def __str__(self):
+        return "{0}: node {1}, cpus {2}, port {3}".format(
+            self.name, self.node, format_cpulist(self.cpus), self.port)
+
+
+# Split the machine into n slices: slices are spread over NUMA nodes evenly,
+# and cores of each node are split evenly between its slices. Slice i uses
+# port base_port + i. Raises ValueError if there are less cores than slices.
+def make_slices(n, base_port):
+    cores = numa_cores()
+    nodes = sorted(cores)
+    per_node = {node: n // len(nodes) + (1 if i < n % len(nodes) else 0)
+                for i, node in enumerate(nodes)}
+    slices = []
+    for node in nodes:
+        k = per_node[node]
+        if k == 0:
+            continue
+        if len(cores[node]) < k:
+            raise ValueError("node {0} has {1} cores, can't make {2} slices of it".format(
+                node, len(cores[node]), k))
+        chunk, extra = divmod(len(cores[node]), k)
+        start = 0
+        for j in range(k):
+            size = chunk + (1 if j < extra else 0)
+            cpus = [c for core in cores[node][start:start + size] for c in core]
+            start += size
+            slices.append(Slice(len(slices), node, cpus, base_port + len(slices)))
+    return slices
@@ -0,0 +1,198 @@
+# Snapshots of pgdatadir used when 'copydir' option is set. The cluster is run
+# from a working copy in copydir, which is reset to the pristine state before
+# each query. Methods of doing that, from cheapest to most expensive:
+#   * reflink: pgdatadir is copied to copydir once per config, and the working
+#     copy is a reflink clone of it (cp --reflink), which takes no time and
+#     space. Requires filesystem supporting reflinks (xfs, btrfs) at copydir.
+#   * overlay: the working copy is overlayfs mount with the pristine copy as
+#     the lower layer; resetting it means just dropping the upper layer.
+#     Requires sudo mount/umount.
+#   * rsync: the working copy is synced with pgdatadir by rsync, so only the
+#     files changed by the previous query are copied.
+#   * full: the whole pgdatadir is copied each time, as before.
+# 'auto' picks reflink if copydir supports it, then rsync if it is installed,
+# and full otherwise.
+#
+# In all cases extconffile is appended to postgresql.conf of the working copy
+# and its permissions are set to 0700.
+#
+# When a campaign is resumed (run.py --resume), the pristine copy left by the
+# interrupted run is reused if it was copied completely.
+
+import os
+import abc
+import shutil
+import tempfile
+
+from plumbum import local
+from plumbum.cmd import cp, rm, cat, chmod, sudo
+
+SNAPSHOT_METHODS = ["auto", "reflink", "overlay", "rsync", "full"]
+
+
+class SnapshotError(Exception):
+    pass
+
+
+# Check whether dirpath supports reflinks by cloning a small file there
+def reflink_supported(dirpath):
+    os.makedirs(dirpath, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=dirpath)
+    try:
+        src = os.path.join(tmpdir, "src")
+        with open(src, 'w') as f:
+            f.write("reflink probe")
+        retcode, out, err = cp["--reflink=always", src,
+                               os.path.join(tmpdir, "dst")].run(retcode=None)
+        return retcode == 0
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+
+# Base of the methods; they only define how the working copy is reset
+class Snapshot(abc.ABC):
+    # workdir is path of the working copy Postgres will be run from
+    def __init__(self, pgdatadir, copydir, extconffile, resume=False):
+        self.pgdatadir = pgdatadir
+        self.copydir = copydir
+        self.extconffile = extconffile
+        self.name = os.path.basename(os.path.normpath(pgdatadir))
+        self.workdir = os.path.join(copydir, self.name)
+        self.resume = resume
+        self.created = False
+
+    # Called once per config before the first restore
+    def create(self):
+        pass
+
+    # Make workdir pristine copy of pgdatadir
+    def restore(self):
+        if not self.created:
+            os.makedirs(self.copydir, exist_ok=True)
+            self.create()
+            self.created = True
+        self.reset_workdir()
+        self.finish(self.workdir)
+
+    # Make workdir a copy of pgdatadir, extconffile is appended by restore
+    @abc.abstractmethod
+    def reset_workdir(self):
+        pass
+
+    # Remove everything we have created in copydir
+    def destroy(self):
+        (rm["-rf", self.workdir])()
+
+    # append extconffile and fix the permissions
+    def finish(self, datadir):
+        if self.extconffile is not None:
+            if os.path.isfile(self.extconffile):
+                (cat[self.extconffile] >> os.path.join(datadir, "postgresql.conf"))()
+                print("extconffile appended")
+            else:
+                print("WARN: extconffile specified, but doesn't exists")
+        # postgres will complain if permissions are too wide
+        (chmod["0700", datadir])()
+
+
+class FullSnapshot(Snapshot):
+    def reset_workdir(self):
+        print("Copying {0} to {1} ...".format(self.pgdatadir, self.workdir))
+        (rm["-rf", self.workdir])()
+        (cp["-r", self.pgdatadir, self.workdir])()
+        print("Copy done")
+
+
+class RsyncSnapshot(Snapshot):
+    def reset_workdir(self):
+        print("Syncing {0} to {1} ...".format(self.pgdatadir, self.workdir))
+        # trailing slashes: sync contents, not the dir itself. Since
+        # postgresql.conf with appended extconffile differs from the
+        # original, it is restored too.
+        (local["rsync"]["-a", "--delete",
+                        os.path.join(self.pgdatadir, ""),
+                        os.path.join(self.workdir, "")])()
+        print("Sync done")
+
+
+# Base for methods working from pristine copy of pgdatadir in copydir
+class PristineSnapshot(Snapshot):
+    def __init__(self, pgdatadir, copydir, extconffile, resume=False):
+        super().__init__(pgdatadir, copydir, extconffile, resume)
+        self.pristine = os.path.join(copydir, self.name + ".pristine")
+        # exists if the pristine copy is complete
+        self.complete_mark = self.pristine + ".complete"
+
+    def create(self):
+        if self.resume and os.path.isfile(self.complete_mark):
+            print("Reusing pristine copy {}".format(self.pristine))
+            return
+        print("Copying {0} to {1} ...".format(self.pgdatadir, self.pristine))
+        (rm["-rf", self.pristine, self.complete_mark])()
+        # clone if pgdatadir and copydir happen to be on the same filesystem
+        (cp["-r", "--reflink=auto", self.pgdatadir, self.pristine])()
+        open(self.complete_mark, 'w').close()
+        print("Copy done")
+
+    def destroy(self):
+        super().destroy()
+        (rm["-rf", self.pristine, self.complete_mark])()
+
+
+class ReflinkSnapshot(PristineSnapshot):
+    def reset_workdir(self):
+        (rm["-rf", self.workdir])()
+        (cp["-r", "--reflink=always", self.pristine, self.workdir])()
+        print("Reflink clone of {0} created at {1}".format(self.pristine,
+                                                            self.workdir))
+
+
+class OverlaySnapshot(PristineSnapshot):
+    def __init__(self, pgdatadir, copydir, extconffile, resume=False):
+        super().__init__(pgdatadir, copydir, extconffile, resume)
+        self.upper = os.path.join(copydir, self.name + ".upper")
+        self.ovwork = os.path.join(copydir, self.name + ".ovwork")
+
+    def umount(self):
+        if os.path.isdir(self.workdir) and \
+           local["mountpoint"]["-q", self.workdir].run(retcode=None)[0] == 0:
+            (sudo["umount", self.workdir])()
+
+    def reset_workdir(self):
+        self.umount()
+        (rm["-rf", self.upper, self.ovwork])()
+        for d in (self.upper, self.ovwork, self.workdir):
+            os.makedirs(d, exist_ok=True)
+        (sudo["mount", "-t", "overlay", "overlay", "-o",
+              "lowerdir={0},upperdir={1},workdir={2}".format(
+                  self.pristine, self.upper, self.ovwork),
+              self.workdir])()
+        print("Overlay of {0} mounted at {1}".format(self.pristine,
+                                                     self.workdir))
+
+    def destroy(self):
+        self.umount()
+        (rm["-rf", self.upper, self.ovwork])()
+        super().destroy()
+
+
+# Create snapshot of pgdatadir in copydir using the given method; with resume,
+# the pristine copy of an interrupted run is reused
+def make_snapshot(method, pgdatadir, copydir, extconffile, resume=False):
+    if method not in SNAPSHOT_METHODS:
+        raise SnapshotError("Wrong snapshot method: {}".format(method))
+    if method == "auto":
+        if reflink_supported(copydir):
+            method = "reflink"
+        elif shutil.which("rsync") is not None:
+            method = "rsync"
+        else:
+            method = "full"
+    print("Using {} snapshots of pgdatadir".format(method))
+    classes = {
+        "reflink": ReflinkSnapshot,
+        "overlay": OverlaySnapshot,
+        "rsync": RsyncSnapshot,
+        "full": FullSnapshot,
+    }
+    return classes[method](pgdatadir, copydir, extconffile, resume)
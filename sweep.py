@@ -0,0 +1,218 @@
+# GUC sweeps for run.py --sweep: expand a spec into the matrix of configs,
+# optionally prune clearly bad settings by successive halving, and write a
+# per-query response surface.
+#
+# The spec is json:
+# {
+#     "base": {"pginstdir": "...", "testname": "sweep", "queries": "q01 q03"},
+#     "gucs": {"work_mem": ["4MB", "64MB"], "jit": ["on", "off"],
+#              "shared_buffers": ["128MB", "1GB"]},
+#     "halving": {"runs": 2, "keep": 0.5, "rounds": 3}
+# }
+# base is a config like an entry of runconf.json, rolled over pgtpch.conf.
+# Each GUC is classified by its context from postgres --describe-config:
+# user-settable ones become set.<name> options, applied with SET after
+# connecting, others become srv.<name> options, passed to the server on start.
+# Configs differing only in set.* options are run by one run_single.py as
+# variants, so switching between them needs neither restart nor resetting of
+# the working copy.
+#
+# With halving, the sweep is run in rounds: round k runs each query of every
+# surviving config runs * (1 / keep)^k times (no adaptive sampling), with
+# resdir_prefix <prefix>_r<k>, then only the keep share of configs with the
+# best geometric mean of median times survive. Without it, the configs are
+# run once as usual.
+#
+# A query which hit querytimeout, see timeout.txt in its results dir, scores
+# as its limit, which is a lower bound of its time. Configs of a round are
+# compared over the same queries: those which finished or timed out with all
+# of them.
+
+import os
+import re
+import glob
+import json
+import math
+import itertools
+import statistics
+import subprocess
+
+# contexts of GUCs which can be changed with SET
+SESSION_CONTEXTS = ["user", "superuser"]
+
+
+class SweepError(Exception):
+    pass
+
+
+# Returns dict GUC name -> context, asking postgres binary in pg_bin
+def guc_contexts(pg_bin):
+    out = subprocess.check_output([os.path.join(pg_bin, "postgres"), "--describe-config"],
+                                  universal_newlines=True)
+    contexts = {}
+    for line in out.splitlines():
+        fields = line.split('\t')
+        if len(fields) > 1:
+            contexts[fields[0].lower()] = fields[1]
+    return contexts
+
+
+# part of test name describing the values, e.g. work_mem4MB_jitoff
+def point_name(point):
+    return '_'.join(re.sub(r'[^A-Za-z0-9._]', '', "{0}{1}".format(name, value))
+                    for name, value in point)
+
+
+# Expand the spec into list of (point, conf), point is list of (GUC, value)
+def expand(spec, default_conf):
+    base = default_conf.copy()
+    base.update(spec["base"])
+    names = list(spec["gucs"])
+    contexts = guc_contexts(os.path.join(base["pginstdir"], "bin"))
+    for name in names:
+        if name.lower() not in contexts:
+            raise SweepError("unknown GUC {}".format(name))
+        if contexts[name.lower()] == "internal":
+            raise SweepError("GUC {} can't be set".format(name))
+    res = []
+    for values in itertools.product(*[spec["gucs"][name] for name in names]):
+        point = list(zip(names, [str(v) for v in values]))
+        conf = dict(base)
+        conf["testname"] = "{0}_{1}".format(base["testname"], point_name(point))
+        for name, value in point:
+            if contexts[name.lower()] in SESSION_CONTEXTS:
+                conf["set.{}".format(name)] = value
+            else:
+                conf["srv.{}".format(name)] = value
+        res.append((point, conf))
+    return res
+
+
+# Group confs which differ only in testname and set.* options into one conf
+# with the differing part in 'variants', see PgtpchConf in run_single.py
+def group_variants(confs):
+    groups = {}
+    for conf in confs:
+        server = {k: v for k, v in conf.items()
+                  if k != "testname" and not k.startswith("set.")}
+        key = json.dumps(server, sort_keys=True)
+        groups.setdefault(key, (server, []))[1].append(
+            {k: v for k, v in conf.items() if k == "testname" or k.startswith("set.")})
+    res = []
+    for server, variants in groups.values():
+        conf = dict(server)
+        if len(variants) == 1 or conf.get("runner") == "throughput":
+            for variant in variants:
+                res.append(dict(conf, **variant))
+        else:
+            conf["testname"] = variants[0]["testname"]
+            conf["variants"] = variants
+            res.append(conf)
+    return res
+
+
+# Returns dict query -> (exec times, timeout) of conf's results; timeout is
+# the limit in secs the query was cancelled at, None if it finished
+def results(conf):
+    res = {}
+    pattern = os.path.join("res", "{0}-{1}-*-{2}".format(
+        conf["resdir_prefix"], conf["testname"], conf["scale"]))
+    for resdir in glob.glob(pattern):
+        query = os.path.basename(resdir)[len("{0}-{1}-".format(
+            conf["resdir_prefix"], conf["testname"])):-len("-{}".format(conf["scale"]))]
+        times = []
+        try:
+            with open(os.path.join(resdir, "exectime.txt")) as f:
+                times = [float(line) for line in f if line.strip()]
+        except OSError:
+            pass
+        timeout = None
+        try:
+            with open(os.path.join(resdir, "timeout.txt")) as f:
+                timeout = float(f.readline())
+        except (OSError, ValueError):
+            pass
+        if times or timeout is not None:
+            res[query] = (times, timeout)
+    return res
+
+
+# Time of the query to score: median of its times, or the limit if it timed
+# out
+def query_score(times, timeout):
+    if timeout is not None:
+        return timeout
+    return statistics.median(times)
+
+
+# Geometric mean of query scores over queries, all queries of query_times by
+# default; inf if there are none
+def score(query_times, queries=None):
+    if queries is None:
+        queries = query_times.keys()
+    if not queries:
+        return float('inf')
+    return math.exp(statistics.mean(math.log(max(query_score(*query_times[q]), 1e-9))
+                                    for q in queries))
+
+
+# Run the sweep; run_conf runs one merged conf like run.py does for an entry
+# of runconf.json. Writes res/<prefix>-surface.tsv.
+def run_sweep(spec, default_conf, prefix, run_conf):
+    points = expand(spec, default_conf)
+    halving = spec.get("halving")
+    # testname -> (round, query -> (times, timeout), queries it was scored
+    # over) of the last round the conf was run in
+    last_res = {}
+    survivors = [conf for point, conf in points]
+    rnd = 0
+    while True:
+        round_confs = []
+        for conf in survivors:
+            conf = dict(conf)
+            if halving is None:
+                conf["resdir_prefix"] = prefix
+            else:
+                runs = int(halving.get("runs", 2) * (1 / halving.get("keep", 0.5)) ** rnd)
+                conf["resdir_prefix"] = "{0}_r{1}".format(prefix, rnd)
+                conf["warmups"] = max(runs, 1) - 1
+                conf["adaptive"] = "false"
+            round_confs.append(conf)
+        print("Sweep round {0}: {1} configs".format(rnd, len(round_confs)))
+        for conf in group_variants(round_confs):
+            run_conf(conf)
+        round_res = {conf["testname"]: results(conf) for conf in round_confs}
+        # compare configs only over queries all of them have results of
+        common = set.intersection(*(set(r) for r in round_res.values()))
+        missing = set.union(*(set(r) for r in round_res.values())) - common
+        if missing:
+            print("Sweep: scoring round {0} without {1}, not all configs have them".format(
+                rnd, ' '.join(sorted(missing))))
+        scores = []
+        for name, query_times in round_res.items():
+            last_res[name] = (rnd, query_times, common)
+            scores.append((score(query_times, common), name))
+        if halving is None or rnd + 1 >= halving.get("rounds", 3) or len(survivors) <= 1:
+            break
+        keep = max(1, int(math.ceil(len(survivors) * halving.get("keep", 0.5))))
+        kept = {name for s, name in sorted(scores)[:keep]}
+        for s, name in sorted(scores)[keep:]:
+            print("Sweep: dropping {0}, score {1:.4f}".format(name, s))
+        survivors = [conf for conf in survivors if conf["testname"] in kept]
+        rnd += 1
+
+    names = list(spec["gucs"])
+    with open(os.path.join("res", "{}-surface.tsv".format(prefix)), 'w') as f:
+        f.write('\t'.join(names + ["query", "round", "runs", "median", "min", "timeout"]) + '\n')
+        for point, conf in points:
+            rnd, query_times, common = last_res[conf["testname"]]
+            values = [value for name, value in point]
+            for query in sorted(query_times):
+                times, timeout = query_times[query]
+                f.write('\t'.join(values + [
+                    query, str(rnd), str(len(times)),
+                    "{:.6f}".format(statistics.median(times)) if times else '',
+                    "{:.6f}".format(min(times)) if times else '',
+                    "{:g}".format(timeout) if timeout is not None else '']) + '\n')
+            f.write('\t'.join(values + ["geomean", str(rnd), '',
+                                        "{:.6f}".format(score(query_times, common)), '', '']) + '\n')